@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Compare frame decode throughput of the dense read loop and sparse decoding.
+
+Usage:
+    python benchmarks/decode_benchmark.py path/to/video.mp4 [--frames-per-minute 60]
+"""
+import argparse
+import time
+from pathlib import Path
+
+import cv2
+
+from video_analyzer.frame import VideoProcessor
+
+
+def sampling_plan(video_path: Path, frames_per_minute: int):
+    """Return (total_frames, sample_interval) the same way extract_keyframes computes them."""
+    cap = cv2.VideoCapture(str(video_path))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    target_frames = max(1, min(int((total_frames / fps / 60) * frames_per_minute), total_frames))
+    return total_frames, max(1, total_frames // (target_frames * 2))
+
+
+def dense_decode(video_path: Path, total_frames: int, sample_interval: int) -> int:
+    """Original loop: read() every frame, keep every sample_interval-th one."""
+    cap = cv2.VideoCapture(str(video_path))
+    sampled = 0
+    for frame_count in range(total_frames):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        if frame_count % sample_interval == 0:
+            sampled += 1
+    cap.release()
+    return sampled
+
+
+def sparse_decode(video_path: Path, total_frames: int, sample_interval: int, seek_interval: int) -> int:
+    """grab() skipped frames, retrieve() sampled ones, seek over large gaps."""
+    processor = VideoProcessor(video_path, Path("."), "", seek_interval=seek_interval)
+    cap = cv2.VideoCapture(str(video_path))
+    sampled = 0
+    position = 0
+    for frame_count in range(0, total_frames, sample_interval):
+        if processor._read_frame_at(cap, position, frame_count) is None:
+            break
+        position = frame_count + 1
+        sampled += 1
+    cap.release()
+    return sampled
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark keyframe decode loops")
+    parser.add_argument("video_path", type=str)
+    parser.add_argument("--frames-per-minute", type=int, default=60)
+    args = parser.parse_args()
+
+    video_path = Path(args.video_path)
+    total_frames, sample_interval = sampling_plan(video_path, args.frames_per_minute)
+    print(f"{video_path}: {total_frames} frames, sample interval {sample_interval}")
+
+    runs = [
+        ("dense read", lambda: dense_decode(video_path, total_frames, sample_interval)),
+        ("sparse grab", lambda: sparse_decode(video_path, total_frames, sample_interval, 0)),
+        ("sparse seek", lambda: sparse_decode(video_path, total_frames, sample_interval, VideoProcessor.SEEK_INTERVAL)),
+    ]
+
+    for name, run in runs:
+        start = time.perf_counter()
+        sampled = run()
+        elapsed = time.perf_counter() - start
+        print(f"{name:12s}: {elapsed:7.2f}s  {total_frames / elapsed:9.1f} video fps  {sampled} frames sampled")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""Keyframe extraction benchmark on synthetic videos.
+
+Generates test videos with cv2.VideoWriter at several resolutions, lengths and
+motion levels, then runs VideoProcessor.extract_keyframes with every decoder /
+mode combination, each in a fresh process, and reports:
+
+    decode fps      video frames covered per second of wall time
+    scored/s        frames scored per second
+    peak RSS        peak resident memory of the extraction process during the run
+    worker RSS      peak resident memory of the largest worker or ffmpeg child process
+    selected        number of frames selected
+
+Usage:
+    python benchmarks/frame_extraction.py [--quick] [--seconds 120 ...] [--workers 4] [--video my.mp4] [--json results.json]
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from video_analyzer.frame import VideoProcessor
+
+RESOLUTIONS = {"480p": (854, 480), "1080p": (1920, 1080), "4k": (3840, 2160)}
+LENGTHS = (30, 120, 600) # seconds
+MOTION_LEVELS = ("static", "low", "high")
+FPS = 30
+
+
+def make_video(path: Path, size, seconds: int, motion: str):
+    """Write a synthetic video: a textured background with moving shapes and periodic cuts."""
+    width, height = size
+    rng = np.random.default_rng(0)
+    texture = rng.integers(0, 255, (height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    background = cv2.resize(texture, (width, height), interpolation=cv2.INTER_NEAREST)
+
+    speed = {"static": 0, "low": 2, "high": 24}[motion]
+    cut_every = {"static": 0, "low": 20 * FPS, "high": 3 * FPS}[motion]
+    box = max(16, width // 10)
+
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), FPS, size)
+    frame = np.empty_like(background)
+    for i in range(seconds * FPS):
+        shift = (i // cut_every) * 37 % 256 if cut_every else 0
+        np.add(background, np.uint8(shift), out=frame) # wraps around
+        x = (i * speed) % max(1, width - box)
+        y = (i * speed // 2) % max(1, height - box)
+        cv2.rectangle(frame, (x, y), (x + box, y + box), (0, 0, 255), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def scored_frames(processor: VideoProcessor, frames_per_minute: int) -> int:
+    """Number of frames extract_keyframes scores with the processor's settings."""
+    total_frames, _, sample_interval = processor._plan(frames_per_minute, None, None)
+    if processor.mode == "iframes":
+        return len(processor._keyframe_numbers(total_frames))
+    return len(range(0, total_frames, sample_interval))
+
+
+def reset_peak_rss() -> bool:
+    """Reset the process's peak RSS (Linux 4.0+), so it covers only what runs next.
+
+    Without it the peak includes the imports and, with spawn, the parent process
+    the child was started from.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb(reset: bool) -> float:
+    """Peak resident memory of this process since the last reset_peak_rss, in MB."""
+    if reset:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    # ru_maxrss is in KiB on Linux, and covers the whole life of the process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_extraction(video_path: str, options: dict, frames_per_minute: int, results):
+    """Child process: run one extraction and report timing and peak memory."""
+    with tempfile.TemporaryDirectory() as output_dir:
+        processor = VideoProcessor(Path(video_path), Path(output_dir), "benchmark", persist=False, **options)
+        reset = reset_peak_rss()
+        start = time.perf_counter()
+        frames = processor.extract_keyframes(frames_per_minute=frames_per_minute)
+        elapsed = time.perf_counter() - start
+
+        total_frames = int(cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FRAME_COUNT))
+        peak_rss = peak_rss_mb(reset)
+        worker_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        results.put({
+            "seconds": elapsed,
+            "decode_fps": total_frames / elapsed,
+            "scored_per_second": scored_frames(processor, frames_per_minute) / elapsed,
+            "peak_rss_mb": peak_rss,
+            "worker_rss_mb": worker_rss,
+            "selected": len(frames),
+        })
+
+
+def benchmark(video_path: Path, options: dict, frames_per_minute: int) -> dict:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_extraction, args=(str(video_path), options, frames_per_minute, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {"error": f"exit code {process.exitcode}"}
+    return results.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark keyframe extraction on synthetic videos")
+    parser.add_argument("--quick", action="store_true", help="Only 480p and 1080p, at most 30 second videos")
+    parser.add_argument("--seconds", type=int, action="append",
+                        help="Length of the synthetic videos, repeatable (default: {})".format(
+                            ", ".join(str(s) for s in LENGTHS)))
+    parser.add_argument("--frames-per-minute", type=int, default=60)
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes for the parallel runs")
+    parser.add_argument("--video", action="append", default=[], help="Also benchmark an existing video")
+    parser.add_argument("--video-dir", type=str, help="Keep generated videos here instead of a temp dir")
+    parser.add_argument("--json", type=str, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    resolutions = ["480p", "1080p"] if args.quick else list(RESOLUTIONS)
+    lengths = args.seconds or list(LENGTHS)
+    if args.quick:
+        lengths = sorted({min(seconds, 30) for seconds in lengths})
+
+    configs = {
+        "opencv": {"decoder": "opencv"},
+        "opencv x{}".format(args.workers): {"decoder": "opencv", "workers": args.workers},
+        "opencv full-res score": {"decoder": "opencv", "score_size": 0},
+    }
+    if shutil.which("ffmpeg"):
+        configs["ffmpeg"] = {"decoder": "ffmpeg"}
+        configs["ffmpeg x{}".format(args.workers)] = {"decoder": "ffmpeg", "workers": args.workers}
+        configs["ffmpeg scene"] = {"decoder": "ffmpeg", "scorer": "scene"}
+    if shutil.which("ffprobe"):
+        configs["opencv iframes"] = {"decoder": "opencv", "mode": "iframes"}
+        if shutil.which("ffmpeg"):
+            configs["ffmpeg iframes"] = {"decoder": "ffmpeg", "mode": "iframes"}
+
+    video_dir = Path(args.video_dir) if args.video_dir else Path(tempfile.mkdtemp(prefix="video-analyzer-bench-"))
+    video_dir.mkdir(parents=True, exist_ok=True)
+
+    videos = [Path(v) for v in args.video]
+    for seconds in lengths:
+        for resolution in resolutions:
+            for motion in MOTION_LEVELS:
+                path = video_dir / f"{resolution}_{motion}_{seconds}s.mp4"
+                if not path.exists():
+                    print(f"Generating {path.name}...", file=sys.stderr)
+                    make_video(path, RESOLUTIONS[resolution], seconds, motion)
+                videos.append(path)
+
+    header = f"{'video':28s} {'config':22s} {'seconds':>8s} {'decode fps':>11s} {'scored/s':>9s} {'peak RSS':>9s} {'worker RSS':>10s} {'selected':>8s}"
+    print(header)
+    print("-" * len(header))
+
+    results = []
+    for video_path in videos:
+        for name, options in configs.items():
+            result = benchmark(video_path, options, args.frames_per_minute)
+            results.append({"video": video_path.name, "config": name, **result})
+            if "error" in result:
+                print(f"{video_path.name:28s} {name:22s} {result['error']}")
+                continue
+            print(f"{video_path.name:28s} {name:22s} {result['seconds']:8.2f} {result['decode_fps']:11.1f} "
+                  f"{result['scored_per_second']:9.1f} {result['peak_rss_mb']:7.0f}MB {result['worker_rss_mb']:8.0f}MB {result['selected']:8d}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if not args.video_dir:
+        shutil.rmtree(video_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
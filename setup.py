@@ -23,6 +23,9 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require={
+        "http2": ["httpx[http2]"],
+    },
     entry_points={
         "console_scripts": [
             "video-analyzer=video_analyzer.cli:main",
@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+"""Tests for frame analysis with a fake LLM client."""
+import asyncio
+import base64
+import json
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+from video_analyzer.analyzer import VideoAnalyzer, split_sections
+from video_analyzer.async_analyzer import AsyncVideoAnalyzer
+from video_analyzer.audio_processor import AudioTranscript
+from video_analyzer.clients.cached_client import CachedClient
+from video_analyzer.clients.generic_openai_api import GenericOpenAIAPIClient
+from video_analyzer.clients.mistral_api import MistralAPIClient
+from video_analyzer.clients.ollama import OllamaClient
+from video_analyzer.clients.llm_client import LLMClient, StreamTimer, iter_sse, token_usage
+from video_analyzer.clients.transport import AsyncTransport
+from video_analyzer.frame import FrameTable
+from video_analyzer.planner import RunPlanner, sample_frames
+from video_analyzer.prompt import PromptLoader
+from video_analyzer import cli
+from test_frame_extraction import make_video
+
+PROMPTS = [
+    {"name": "Frame Analysis", "path": "frame_analysis/frame_analysis.txt"},
+    {"name": "Video Reconstruction", "path": "frame_analysis/describe.txt"},
+]
+
+class FakeClient(LLMClient):
+    """Records requests and answers with one "Cell k:" / "Image k:" section per cell or image
+    mentioned in the prompt."""
+    def __init__(self, delay=None):
+        self.requests = []
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def generate(self, prompt, image_path=None, stream=False, model="fake", temperature=0.2,
+                 num_predict=256, image_data=None, on_token=None):
+        with self.lock:
+            self.requests.append({"prompt": prompt, "image_data": image_data})
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if self.delay:
+            time.sleep(self.delay(len(self.requests)))
+        with self.lock:
+            self.in_flight -= 1
+        if image_data is None:
+            return {"response": f"summary {len(self.requests)}", "token_usage": {"total_tokens": 10}}
+        label = "Image" if isinstance(image_data, list) else "Cell"
+        cells = prompt.count(f"\n{label} ")
+        text = "\n".join(f"{label} {k}: description {k}" for k in range(1, cells + 1)) or "description"
+        if stream:
+            timer = StreamTimer(on_token)
+            for word in text.split(" "):
+                timer.add(word + " ")
+            return {"response": timer.text.strip(), "token_usage": {"total_tokens": 10}, "stream": timer.metrics()}
+        return {"response": text, "token_usage": {"total_tokens": 10}}
+
+    def generate_batch(self, prompt, images, model="fake", temperature=0.2, num_predict=256):
+        return self.generate(prompt, model=model, temperature=temperature, num_predict=num_predict,
+                             image_data=list(images))
+
+def make_frames(count: int, size=(320, 240)) -> FrameTable:
+    width, height = size
+    frames = FrameTable()
+    data = [cv2.imencode('.jpg', np.full((height, width, 3), i * 20, np.uint8))[1].tobytes() for i in range(count)]
+    frames.append(np.arange(count), np.arange(count) * 30, np.arange(count, dtype=float), np.zeros(count),
+                  [None] * count, data)
+    return frames
+
+def make_analyzer(client: LLMClient, **kwargs) -> VideoAnalyzer:
+    return VideoAnalyzer(client, "fake", PromptLoader("", PROMPTS), **kwargs)
+
+def test_split_sections():
+    """Numbered sections are split out, with markdown decoration and missing cells tolerated."""
+    text = "Overview\n**Cell 1:** a cat\n\n### Cell 3 - a dog\nstill the dog\nCell 9: out of range"
+    assert split_sections(text, 3) == ["a cat", None, "a dog\nstill the dog"]
+    assert split_sections("no sections here", 2) == [None, None]
+
+def test_image_policy():
+    """Frames are resized to the provider's limits, snapped to tiles and re-encoded only when
+    the policy asks for it; per-model overrides reach the request and the token estimate."""
+    openai = GenericOpenAIAPIClient({"api_key": "key", "api_url": "http://localhost/v1"})
+    assert openai.scaled_size(1920, 1080) == (1365, 768)
+    assert MistralAPIClient({"api_key": "key", "api_url": "http://localhost/v1"}).scaled_size(2048, 1536) == (1024, 768)
+
+    client = FakeClient()
+    client.image_config = {"max_edge": 1100, "tile": 512}
+    # 1100x550 spills less than half a tile on each edge, so it is snapped to 2x1 tiles
+    assert client.scaled_size(2000, 1000) == (1024, 512)
+
+    data = make_frames(1)[0].data
+    encoded, mime_type = FakeClient().prepare_image(image_data=data)
+    assert base64.b64decode(encoded) == data and mime_type == "image/jpeg"
+
+    client.image_config = {"format": "webp", "quality": 80}
+    encoded, mime_type = client.prepare_image(image_data=data)
+    webp = base64.b64decode(encoded)
+    assert mime_type == "image/webp" and webp[:4] == b"RIFF" and webp[8:12] == b"WEBP"
+    assert cv2.imdecode(np.frombuffer(webp, np.uint8), cv2.IMREAD_COLOR).shape == (240, 320, 3)
+
+    low = GenericOpenAIAPIClient({"api_key": "key", "api_url": "http://localhost/v1",
+                                  "image": {"models": {"gpt-4o-mini": {"detail": "low"}}}})
+    assert low.estimate_image_tokens(1920, 1080, "gpt-4o-mini") == 85
+    assert low.estimate_image_tokens(1920, 1080, "gpt-4o") > 85
+    data_request, _ = low._request("describe", [data], False, "gpt-4o-mini", 0.2, 100)
+    assert data_request["messages"][0]["content"][1]["image_url"]["detail"] == "low"
+    data_request, _ = low._request("describe", [data], False, "gpt-4o", 0.2, 100)
+    assert "detail" not in data_request["messages"][0]["content"][1]["image_url"]
+
+def test_mosaic_analysis():
+    """Frames are analyzed in groups with one request each and keep their order."""
+    client = FakeClient()
+    analyzer = make_analyzer(client, mosaic=4)
+    frames = make_frames(6)
+
+    results = list(analyzer.analyze_frames(frames))
+    assert len(client.requests) == 2
+    assert [frame.number for frame, _ in results] == [f.number for f in frames]
+    assert [analysis['response'] for _, analysis in results] == [f"description {k}" for k in (1, 2, 3, 4, 1, 2)]
+    assert sum('token_usage' in analysis for _, analysis in results) == 2
+
+    mosaic = cv2.imdecode(np.frombuffer(client.requests[0]["image_data"], np.uint8), cv2.IMREAD_COLOR)
+    assert mosaic.shape == (480, 640, 3)
+
+def test_batch_analysis():
+    """Frames are sent as separate images of one request and split by "Image k:" sections."""
+    client = FakeClient()
+    analyzer = make_analyzer(client, batch=3)
+    frames = make_frames(5)
+
+    results = list(analyzer.analyze_frames(frames))
+    assert len(client.requests) == 2
+    assert [len(r["image_data"]) for r in client.requests] == [3, 2]
+    assert client.requests[0]["image_data"][1] == frames[1].data
+    assert [analysis['response'] for _, analysis in results] == [f"description {k}" for k in (1, 2, 3, 1, 2)]
+    assert results[4][1]['batch'] == {'index': 2, 'size': 2}
+
+def test_concurrent_analysis():
+    """Requests overlap up to max_in_flight, results stay in frame order and every
+    frame is reported to on_complete."""
+    # later requests finish first
+    client = FakeClient(delay=lambda n: 0.05 * (5 - n % 4))
+    analyzer = make_analyzer(client, max_in_flight=3)
+    frames = make_frames(8)
+
+    completed = []
+    results = list(analyzer.analyze_frames(frames, on_complete=lambda frame, analysis: completed.append(frame.number)))
+    assert [frame.number for frame, _ in results] == [f.number for f in frames]
+    assert sorted(completed) == [f.number for f in frames]
+    assert client.max_in_flight == 3
+    assert [a['frame']['num'] for a in analyzer.previous_analyses] == [f.number for f in frames]
+
+def test_rolling_context():
+    """Analyses leaving the context window are folded into a running summary."""
+    client = FakeClient()
+    analyzer = make_analyzer(client, context_window=2, summary_interval=2)
+    list(analyzer.analyze_frames(make_frames(8)))
+
+    summaries = [r for r in client.requests if r["image_data"] is None]
+    assert len(summaries) == 3
+    assert analyzer.summarized_count == 6
+    last_prompt = [r for r in client.requests if r["image_data"] is not None][-1]["prompt"]
+    assert "Summary of frames 0-3" in last_prompt
+    assert "Frame 4\n" in last_prompt and "Frame 6\n" in last_prompt and "Frame 3\n" not in last_prompt
+
+    analyzer = make_analyzer(FakeClient(), context_tokens=5)
+    list(analyzer.analyze_frames(make_frames(8)))
+    assert analyzer._format_previous_analyses() == "Frame 7\ndescription\n"
+
+def test_adaptive_skipping():
+    """The stride doubles while analyses are redundant and a visual change ends a skip."""
+    client = FakeClient()
+    analyzer = make_analyzer(client, adaptive=True, max_stride=4)
+    results = list(analyzer.analyze_frames(make_frames(12)))
+    assert [frame.number // 30 for frame, _ in results] == [0, 1, 3, 7, 11]
+    assert [analysis['adaptive']['stride'] for _, analysis in results] == [1, 2, 4, 4, 4]
+    assert [number // 30 for number in analyzer.skipped_frames] == [2, 4, 5, 6, 8, 9, 10]
+
+    # a horizontal gradient has a different image hash than the flat frames
+    frames = make_frames(8)
+    gradient = np.tile(np.linspace(0, 255, 320, dtype=np.uint8)[None, :, None], (240, 1, 3))
+    frames.data[5] = cv2.imencode('.jpg', gradient)[1].tobytes()
+    analyzer = make_analyzer(FakeClient(), adaptive=True)
+    results = list(analyzer.analyze_frames(frames))
+    assert [frame.number // 30 for frame, _ in results] == [0, 1, 3, 5, 6, 7]
+    assert results[3][1]['adaptive']['stride'] == 1
+
+def test_streaming():
+    """Streamed text reaches on_token with its frame and analyses record stream metrics,
+    on the first frame of a mosaic only."""
+    chunks = []
+    analyzer = make_analyzer(FakeClient(), mosaic=2, stream=True)
+    results = list(analyzer.analyze_frames(make_frames(4), on_token=lambda frame, text: chunks.append((frame.number, text))))
+    assert "".join(text for number, text in chunks if number == results[0][0].number).strip() == "Cell 1: description 1\nCell 2: description 2"
+    assert {number for number, _ in chunks} == {results[0][0].number, results[2][0].number}
+    assert results[0][1]['stream']['ttft'] is not None and 'stream' not in results[1][1]
+
+    class Events:
+        def iter_lines(self):
+            return iter([b'data: {"choices": [{"delta": {"content": "a"}}]}', b'', b': keep-alive',
+                         b'data: [DONE]', b'data: {"late": true}'])
+    assert list(iter_sse(Events())) == [{"choices": [{"delta": {"content": "a"}}]}]
+
+def test_prompt_prefix_cache():
+    """With prompt_cache every frame prompt starts with the same announced prefix and
+    cached prompt tokens are priced separately."""
+    class PrefixClient(FakeClient):
+        prefixes = []
+        def cache_prompt_prefix(self, prefix, model=None):
+            self.prefixes.append(prefix)
+            return True
+
+    client = PrefixClient()
+    analyzer = make_analyzer(client, prompt_cache=True, user_prompt="who is there")
+    list(analyzer.analyze_frames(make_frames(3)))
+    prefix = analyzer.frame_prompt_prefix()
+    assert client.prefixes == [prefix] and "{PREVIOUS_FRAMES}" not in prefix and "who is there" in prefix
+    assert all(r["prompt"].startswith(prefix) for r in client.requests)
+    assert "Frame 1\ndescription" in client.requests[2]["prompt"][len(prefix):]
+
+    usage = token_usage("gpt-4o", 2000, 100, cached_prompt_tokens=1024)
+    assert usage["uncached_prompt_tokens"] == 976
+    assert abs(usage["cost"] - (976 * 0.0025 + 1024 * 0.00125 + 100 * 0.01) / 1000) < 1e-12
+
+def test_chat_session():
+    """Frames are sent as a conversation: the template once as system message, earlier
+    replies instead of {PREVIOUS_FRAMES} and only the latest image."""
+    class ChatClient(FakeClient):
+        def chat(self, messages, model="fake", temperature=0.2, num_predict=256, stream=False, on_token=None):
+            self.requests.append({"messages": messages})
+            return {"response": f"reply {len(self.requests)}"}
+
+    client = ChatClient()
+    analyzer = make_analyzer(client, chat_session=True, context_window=2)
+    frames = make_frames(4)
+    list(analyzer.analyze_frames(frames))
+    last = client.requests[-1]["messages"]
+    assert last[0]["role"] == "system" and "{PREVIOUS_FRAMES}" not in last[0]["content"]
+    # the window of two frames was trimmed to one after the third
+    assert [m["content"] for m in last[1:-1]] == [f"This is frame {frames[2].number} captured at 2.00 seconds.", "reply 3"]
+    assert last[-1]["images"] == [frames[3].data] and all("images" not in m for m in last[:-1])
+
+    try:
+        make_analyzer(FakeClient(), chat_session=True)
+        assert False, "FakeClient has no chat"
+    except ValueError:
+        pass
+
+def test_pooled_transport():
+    """Clients of one endpoint share a keep-alive connection and count the bytes sent and received."""
+    connections = set()
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, *args):
+            pass
+        def do_POST(self):
+            connections.add(self.client_address)
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = json.dumps({"response": "hi", "prompt_eval_count": 3, "eval_count": 1}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        api_url = f"http://127.0.0.1:{server.server_address[1]}"
+        clients = [OllamaClient({"api_url": api_url}), OllamaClient({"api_url": api_url})]
+        responses = [client.generate("describe") for client in clients * 2]
+        assert [r["response"] for r in responses] == ["hi"] * 4
+        assert clients[0].transport is clients[1].transport and len(connections) == 1
+        stats = clients[0].transport.stats()
+        assert stats["requests"] == 4 and stats["bytes_sent"] > 0 and stats["bytes_received"] > 0
+    finally:
+        server.shutdown()
+
+def test_async_analysis():
+    """Videos analyzed on one event loop share the semaphore bounding requests in flight,
+    and each gets the analyses and context the synchronous analyzer gives."""
+    class AsyncClient(FakeClient):
+        async def agenerate(self, prompt, image_path=None, stream=False, model="fake", temperature=0.2,
+                            num_predict=256, image_data=None, on_token=None):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01)
+            self.in_flight -= 1
+            return self.generate(prompt, image_path, stream, model, temperature, num_predict, image_data, on_token)
+
+    async def analyze(client, videos, semaphore):
+        analyzers = [AsyncVideoAnalyzer(client, "fake", PromptLoader("", PROMPTS), max_in_flight=4,
+                                        semaphore=semaphore) for _ in videos]
+        return await asyncio.gather(*(analyzer.aanalyze_video(frames) for analyzer, frames in zip(analyzers, videos)))
+
+    client = AsyncClient()
+    videos = [make_frames(8), make_frames(6)]
+    results = asyncio.run(analyze(client, videos, asyncio.Semaphore(6)))
+    assert client.max_in_flight == 6 # more than one video's max_in_flight
+    assert [len(analyses) for analyses, _ in results] == [8, 6]
+    assert [a["frame"]["num"] for a in results[0][0]] == [f.number for f in videos[0]]
+    assert results[1][1]["response"].startswith("summary")
+
+    # one request in flight sends the same prompts as the synchronous analyzer
+    sync_client, async_client = FakeClient(), AsyncClient()
+    list(make_analyzer(sync_client, context_window=2).analyze_frames(make_frames(4)))
+    asyncio.run(AsyncVideoAnalyzer(async_client, "fake", PromptLoader("", PROMPTS),
+                                   context_window=2).aanalyze_video(make_frames(4)))
+    assert sync_client.requests == async_client.requests[:4]
+
+    # frames still being extracted are waited for off the event loop
+    def extracted_frames():
+        for frame in make_frames(4):
+            time.sleep(0.05)
+            yield frame
+
+    async def analyze_while_ticking():
+        loop = asyncio.get_running_loop()
+        analysis = asyncio.ensure_future(AsyncVideoAnalyzer(AsyncClient(), "fake", PromptLoader("", PROMPTS))
+                                         .aanalyze_video(extracted_frames()))
+        ticks = [loop.time()]
+        while not analysis.done():
+            await asyncio.sleep(0.005)
+            ticks.append(loop.time())
+        return analysis.result(), max(b - a for a, b in zip(ticks, ticks[1:]))
+
+    (analyses, _), longest_stall = asyncio.run(analyze_while_ticking())
+    assert len(analyses) == 4
+    assert longest_stall < 0.04
+
+def test_async_transport():
+    """Native agenerate streams over the asynchronous transport."""
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, *args):
+            pass
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = b"".join(json.dumps(chunk).encode() + b"\n" for chunk in [
+                {"response": "hello "}, {"response": "there"}, {"done": True, "prompt_eval_count": 3, "eval_count": 2}])
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    async def generate(client, tokens):
+        responses = await asyncio.gather(*(client.agenerate("describe", stream=True, on_token=tokens.append)
+                                           for _ in range(3)))
+        await AsyncTransport.aclose_all()
+        return responses
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = OllamaClient({"api_url": f"http://127.0.0.1:{server.server_address[1]}"})
+        tokens = []
+        responses = asyncio.run(generate(client, tokens))
+        assert [r["response"] for r in responses] == ["hello there"] * 3 and len(tokens) == 6
+        assert responses[0]["token_usage"]["total_tokens"] == 5 and responses[0]["stream"]["completion_tokens"] == 2
+        assert client.async_transport.stats()["requests"] == 3
+    finally:
+        server.shutdown()
+
+def run_cli(temp_dir: str, args: List[str], settings: Optional[Dict[str, Dict[str, Any]]] = None) -> List[str]:
+    """Run the cli on a 6 second video against a local fake Ollama server, with the
+    example config's sections updated from `settings`.
+
+    Returns the frame analysis files that existed whenever a request came in.
+    """
+    output_dir = Path(temp_dir) / "output"
+    written = []
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def log_message(self, *args):
+            pass
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            written.extend(path.name for path in output_dir.glob("*.json"))
+            body = json.dumps({"response": "a box", "prompt_eval_count": 3, "eval_count": 1}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    argv = sys.argv
+    video_path = Path(temp_dir) / "video.mp4"
+    make_video(video_path, seconds=6)
+    with open(Path(__file__).parent / "default_config.example.json") as f:
+        config = json.load(f)
+    config["clients"]["default"] = "ollama"
+    config["clients"]["ollama"]["api_url"] = f"http://127.0.0.1:{server.server_address[1]}"
+    config["prompt_dir"] = ""
+    for section, values in (settings or {}).items():
+        config[section].update(values)
+    config_dir = Path(temp_dir) / "config"
+    config_dir.mkdir()
+    with open(config_dir / "config.json", "w") as f:
+        json.dump(config, f)
+
+    sys.argv = ["video-analyzer", str(video_path), "--config", str(config_dir), "--output", str(output_dir),
+                "--whisper-model", "none"] + args
+    try:
+        cli.main()
+    finally:
+        sys.argv = argv
+        server.shutdown()
+    return written
+
+def test_cli_without_keep_frames():
+    """A default run keeps frames in memory and still writes each frame's analysis."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        written = run_cli(temp_dir, ["--max-frames", "3"])
+        # the frame analyses were written while the run went on, the output is cleaned up after it
+        assert "frame_0.json" in written
+        assert not (Path(temp_dir) / "output").exists()
+
+def test_cli_adaptive_counts():
+    """Frames left out by adaptive skipping still count as extracted, streamed or not."""
+    for stream in (False, True):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            run_cli(temp_dir, ["--keep-frames"], {
+                "frames": {"analysis_threshold": 0, "stream": stream, "stream_window": 2},
+                "analysis": {"adaptive": {"enabled": True, "similarity": 0.8, "hash_distance": 64}}
+            })
+            with open(Path(temp_dir) / "output" / "analysis.json") as f:
+                metadata = json.load(f)["metadata"]
+            assert metadata["frames_skipped"] > 0
+            assert metadata["frames_analyzed"] + metadata["frames_skipped"] == metadata["frames_extracted"]
+
+def test_hierarchical_reconstruction():
+    """Segments are described with their transcript slice, then combined into one description."""
+    client = FakeClient()
+    analyzer = make_analyzer(client, reconstruction="hierarchical", segment_seconds=3)
+    frames = make_frames(8)
+    analyses = [analysis for _, analysis in analyzer.analyze_frames(frames)]
+    client.requests.clear()
+
+    transcript = AudioTranscript(text="hello world", language="en", segments=[
+        {"text": "hello", "start": 0.5, "end": 1.0},
+        {"text": "world", "start": 6.5, "end": 7.0},
+    ])
+    description = analyzer.reconstruct_video(analyses, list(frames), transcript)
+    assert len(client.requests) == 4
+    assert [(s["start"], s["end"]) for s in description["segments"]] == [(0, 3), (3, 6), (6, 9)]
+    assert "hello" in client.requests[0]["prompt"] and "world" not in client.requests[0]["prompt"]
+    assert "Frame 7 (7.00s)" in client.requests[2]["prompt"]
+    assert "Part 3 (6s - 9s)" in client.requests[3]["prompt"]
+    assert description["token_usage"]["total_tokens"] == 40
+
+    # the combined usage keeps the prompt cache split of every request
+    generate = client.generate
+    client.generate = lambda *args, **kwargs: dict(generate(*args, **kwargs),
+                                                   token_usage=token_usage("gpt-4o", 100, 10, cached_prompt_tokens=40))
+    usage = analyzer.reconstruct_video(analyses, list(frames), transcript)["token_usage"]
+    assert usage["cached_prompt_tokens"] == 4 * 40 and usage["uncached_prompt_tokens"] == 4 * 60
+    assert usage["total_tokens"] == 4 * 110
+
+def test_response_cache():
+    """Identical requests are answered from the cache, a different image is not."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fake = FakeClient()
+        client = CachedClient(fake, Path(temp_dir) / 'responses.sqlite')
+        frames = make_frames(2)
+
+        first = client.generate("describe", image_data=frames[0].data, model="fake")
+        again = client.generate("describe", image_data=frames[0].data, model="fake")
+        client.generate("describe", image_data=frames[1].data, model="fake")
+        assert len(fake.requests) == 2
+        assert again["cached"] and again["response"] == first["response"] and "token_usage" not in again
+        assert client.stats()["hits"] == 1 and client.stats()["misses"] == 2
+
+        # the same model behind another endpoint is a different request
+        other = FakeClient()
+        fake.base_url, other.base_url = "http://localhost:8000/v1", "http://localhost:8001/v1"
+        first_endpoint = CachedClient(fake, Path(temp_dir) / 'endpoints.sqlite')
+        second_endpoint = CachedClient(other, Path(temp_dir) / 'endpoints.sqlite')
+        first_endpoint.generate("describe", model="fake")
+        second_endpoint.generate("describe", model="fake")
+        assert first_endpoint.stats()["misses"] == 1 and second_endpoint.stats()["misses"] == 1
+        assert len(other.requests) == 1
+        keys = [CachedClient(GenericOpenAIAPIClient({"api_key": "key", "api_url": url}), Path(temp_dir) / 'keys.sqlite')
+                .key("describe", [], "gpt-4o", 0.2, 100) for url in ("http://a/v1", "http://b/v1")]
+        assert keys[0] != keys[1]
+
+        # a cache too small for one entry keeps nothing
+        small = CachedClient(fake, Path(temp_dir) / 'small.sqlite', max_size_mb=1e-6)
+        small.generate("describe", model="fake")
+        assert small.stats()["entries"] == 0
+
+def test_run_plan():
+    """Plans count one request per frame plus reconstruction, bounded context shrinks
+    prompts and the frame count is reduced to fit a budget."""
+    frames = make_frames(8)
+    plan = RunPlanner(FakeClient(), "gpt-4o", make_analyzer(FakeClient()), transcript=False).estimate(frames, 8.0)
+    assert plan.requests == 9
+    assert plan.image_tokens == 8 * 103 # 320x240 at one token per 750 pixels
+    assert plan.cost > 0
+
+    windowed = RunPlanner(FakeClient(), "gpt-4o", make_analyzer(FakeClient(), context_window=2), transcript=False)
+    assert windowed.estimate(frames, 8.0).prompt_tokens < plan.prompt_tokens
+
+    planner = RunPlanner(FakeClient(), "gpt-4o", make_analyzer(FakeClient(), mosaic=4), transcript=False)
+    budget = planner.estimate(sample_frames(frames, 4), 8.0).cost
+    assert planner.fit_budget(frames, 8.0, budget) == 4
+    assert planner.estimate(frames, 8.0).requests == 3
+
+    # local models are free whatever TOKEN_PRICING lists for their name, a budget keeps every frame
+    ollama = OllamaClient({"api_url": "http://localhost:11434"})
+    local = RunPlanner(ollama, "llama3.2-vision", make_analyzer(ollama), transcript=False)
+    local_plan = local.estimate(frames, 8.0)
+    assert not local_plan.priced and local_plan.cost == 0 and local_plan.to_dict()["cost"] is None
+    assert local.fit_budget(frames, 8.0, 0.0) == len(frames)
+
+if __name__ == "__main__":
+    test_split_sections()
+    test_image_policy()
+    test_mosaic_analysis()
+    test_batch_analysis()
+    test_concurrent_analysis()
+    test_rolling_context()
+    test_adaptive_skipping()
+    test_streaming()
+    test_prompt_prefix_cache()
+    test_chat_session()
+    test_pooled_transport()
+    test_async_analysis()
+    test_async_transport()
+    test_cli_without_keep_frames()
+    test_cli_adaptive_counts()
+    test_hierarchical_reconstruction()
+    test_response_cache()
+    test_run_plan()
+    print("All tests passed!")
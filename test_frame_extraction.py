@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""Tests for keyframe extraction on a synthetic video."""
+import shutil
+import tempfile
+from pathlib import Path
+
+import pytest
+
+import cv2
+import numpy as np
+
+from video_analyzer import frame as frame_module
+from video_analyzer.frame import FrameScorer, VideoProcessor
+from video_analyzer.frame_cache import FrameCache
+
+def make_video(path: Path, seconds: int = 20, fps: int = 30, size=(320, 240)):
+    """Write a video with a moving box and a background change every 3 seconds."""
+    width, height = size
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    for i in range(seconds * fps):
+        frame = np.full((height, width, 3), (i // (3 * fps) * 40) % 255, np.uint8)
+        x = (i * 5) % (width - 40)
+        cv2.rectangle(frame, (x, 60), (x + 40, 140), (0, 0, 255), -1)
+        writer.write(frame)
+    writer.release()
+
+def test_frame_scorer():
+    """Frames are scored on a reused thumbnail buffer against the previous sample."""
+    scorer = FrameScorer(score_size=64)
+    assert scorer.thumbnail_size(320, 240) == (64, 48)
+    assert scorer.thumbnail_size(32, 24) == (32, 24)
+    assert FrameScorer(score_size=0).thumbnail_size(320, 240) == (320, 240)
+
+    still = np.full((240, 320, 3), 80, np.uint8)
+    moved = still.copy()
+    cv2.rectangle(moved, (100, 60), (180, 140), (0, 0, 255), -1)
+    cut = np.full((240, 320, 3), 200, np.uint8)
+
+    assert scorer.score(still) == 0.0
+    assert scorer._gray.shape == (48, 64)
+    buffers = {id(scorer._small), id(scorer._gray), id(scorer._prev), id(scorer._diff)}
+
+    assert scorer.score(still) == 0.0
+    small_change = scorer.score(moved)
+    assert small_change > 0
+    assert scorer.score(cut) > small_change
+    assert {id(scorer._small), id(scorer._gray), id(scorer._prev), id(scorer._diff)} == buffers
+
+    # grayscale thumbnails from the decoder score like the BGR frames they came from
+    scorer.reset()
+    assert scorer.score(cv2.cvtColor(still, cv2.COLOR_BGR2GRAY)) == 0.0
+    assert scorer.score(cv2.cvtColor(cut, cv2.COLOR_BGR2GRAY)) == pytest.approx(120, abs=1)
+
+def test_candidate_heap():
+    """The candidate heap keeps the top scoring frames of a scan, earlier frames first on ties."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = Path(temp_dir) / 'video.mp4'
+        make_video(video_path, seconds=10)
+        processor = VideoProcessor(video_path, Path(temp_dir) / 'frames', 'test', persist=False)
+
+        cap = cv2.VideoCapture(str(video_path))
+        scorer = FrameScorer()
+        candidates, scored = [], []
+        frame_num = 0
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            score = scorer.score(frame)
+            scored.append((score, frame_num))
+            processor._push_candidate(candidates, 5, frame_num, frame, score)
+            frame_num += 1
+        cap.release()
+
+        assert len(candidates) == 5
+        ranked = sorted(candidates, reverse=True)
+        expected = sorted(scored, key=lambda s: (-s[0], s[1]))[:5]
+        assert [(score, -neg_num) for score, neg_num, _ in ranked] == expected
+        # the background changes every 3 seconds are the largest differences
+        assert sorted(num for _, num in expected[:3]) == [90, 180, 270]
+        image = cv2.imdecode(np.frombuffer(ranked[0][2], np.uint8), cv2.IMREAD_COLOR)
+        assert image.shape == (240, 320, 3)
+
+        # frames without a decoded image are kept without their JPEG
+        heap = []
+        for frame_num in range(4):
+            processor._push_candidate(heap, 2, frame_num, None, 1.0)
+        assert sorted(heap, reverse=True) == [(1.0, 0, None), (1.0, -1, None)]
+
+def test_sparse_decoding():
+    """Seeking over large gaps selects the same frames as grabbing through them."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = Path(temp_dir) / 'video.mp4'
+        make_video(video_path)
+
+        grabbed = VideoProcessor(video_path, Path(temp_dir) / 'grab', 'test', seek_interval=0)
+        seeked = VideoProcessor(video_path, Path(temp_dir) / 'seek', 'test', seek_interval=1)
+
+        frames = grabbed.extract_keyframes(frames_per_minute=30)
+        assert frames, "No keyframes extracted"
+        assert len(frames) <= 10
+        assert [f.number for f in frames] == [f.number for f in seeked.extract_keyframes(frames_per_minute=30)]
+        assert all(f.path.exists() for f in frames)
+
+def test_in_memory_frames():
+    """Without persist frames carry their JPEG bytes and nothing is written."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = Path(temp_dir) / 'video.mp4'
+        make_video(video_path)
+
+        output_dir = Path(temp_dir) / 'frames'
+        frames = VideoProcessor(video_path, output_dir, 'test', persist=False).extract_keyframes(frames_per_minute=30)
+        assert frames
+        assert not output_dir.exists()
+        assert all(f.path is None for f in frames)
+        image = cv2.imdecode(np.frombuffer(frames[0].data, np.uint8), cv2.IMREAD_COLOR)
+        assert image.shape == (240, 320, 3)
+
+def test_extraction_cache():
+    """A repeated extraction with the same parameters is served from the cache."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = Path(temp_dir) / 'video.mp4'
+        make_video(video_path)
+        cache = FrameCache(Path(temp_dir) / 'cache')
+
+        first = VideoProcessor(video_path, Path(temp_dir) / 'first', 'test', cache=cache)
+        expected = first.extract_keyframes(frames_per_minute=30)
+
+        second = VideoProcessor(video_path, Path(temp_dir) / 'second', 'test', cache=cache)
+        second._plan = None # any decoding would fail
+        frames = second.extract_keyframes(frames_per_minute=30)
+        assert [(f.number, f.score, f.data) for f in frames] == [(f.number, f.score, f.data) for f in expected]
+
+        # different parameters miss the cache, a cache holding one entry evicts the older one
+        entry_size = sum(f.stat().st_size for f in cache.cache_dir.rglob('*') if f.is_file())
+        small_cache = FrameCache(cache.cache_dir, 1.5 * entry_size / (1024 * 1024))
+        third = VideoProcessor(video_path, Path(temp_dir) / 'third', 'test', cache=small_cache)
+        third.extract_keyframes(frames_per_minute=20)
+        assert len(list(cache.cache_dir.iterdir())) == 1
+
+def test_parallel_segments():
+    """Scanning in parallel segments selects the same frames and scores as a sequential scan."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = Path(temp_dir) / 'video.mp4'
+        make_video(video_path)
+
+        sequential = VideoProcessor(video_path, Path(temp_dir) / 'seq', 'test', workers=1)
+        parallel = VideoProcessor(video_path, Path(temp_dir) / 'par', 'test', workers=4)
+
+        expected = [(f.number, f.score) for f in sequential.extract_keyframes(frames_per_minute=300)]
+        assert expected == [(f.number, f.score) for f in parallel.extract_keyframes(frames_per_minute=300)]
+
+def test_streaming_windows():
+    """Streamed keyframes arrive in frame order with consecutive indices."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = Path(temp_dir) / 'video.mp4'
+        make_video(video_path)
+
+        processor = VideoProcessor(video_path, Path(temp_dir) / 'frames', 'test')
+        frames = list(processor.iter_keyframes(frames_per_minute=30, window=5))
+        assert frames
+        assert len(frames) <= 10
+        assert [f.ix for f in frames] == list(range(len(frames)))
+        assert [f.number for f in frames] == sorted(f.number for f in frames)
+        assert all(f.path.exists() for f in frames)
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg not installed")
+def test_ffmpeg_decoder():
+    """The ffmpeg decoder selects frames from the same samples and writes full size JPEGs."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = Path(temp_dir) / 'video.mp4'
+        make_video(video_path)
+
+        opencv = VideoProcessor(video_path, Path(temp_dir) / 'opencv', 'test')
+        ffmpeg = VideoProcessor(video_path, Path(temp_dir) / 'ffmpeg', 'test', decoder='ffmpeg')
+
+        expected = [f.number for f in opencv.extract_keyframes(frames_per_minute=30)]
+        frames = ffmpeg.extract_keyframes(frames_per_minute=30)
+        assert expected == [f.number for f in frames]
+        assert cv2.imread(str(frames[0].path)).shape == (240, 320, 3)
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg not installed")
+def test_scene_scorer():
+    """ffmpeg's scene score selects the cuts, and segments score like a sequential scan."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = Path(temp_dir) / 'video.mp4'
+        make_video(video_path)
+
+        processor = VideoProcessor(video_path, Path(temp_dir) / 'frames', 'test', decoder='ffmpeg', scorer='scene')
+        frames = processor.extract_keyframes(frames_per_minute=30)
+        # the background changes every 3 seconds outscore the steadily moving box
+        cuts = [f for f in frames if f.number % 90 == 0]
+        assert [f.number for f in cuts] == [90, 180, 270, 360, 450, 540]
+        assert min(f.score for f in cuts) > max(f.score for f in frames if f.number % 90)
+
+        processor.threshold = -1
+        sequential = processor._scan_range_ffmpeg(0, 600, 30, 20)
+        segments = processor._scan_range_ffmpeg(0, 300, 30, 20) + processor._scan_range_ffmpeg(300, 600, 30, 20)
+        assert sorted(segments) == pytest.approx(sorted(sequential))
+
+        with pytest.raises(ValueError):
+            VideoProcessor(video_path, Path(temp_dir) / 'frames', 'test', scorer='scene')
+
+def test_ffmpeg_passthrough_option():
+    """ffmpeg builds older than 5.1 keep frame timestamps with -vsync."""
+    versions = {
+        "ffmpeg version 4.4.2-0ubuntu0.22.04.1 Copyright (c) 2000-2021": "-vsync",
+        "ffmpeg version n5.0.3 Copyright (c) 2000-2022": "-vsync",
+        "ffmpeg version 5.1.2 Copyright (c) 2000-2022": "-fps_mode",
+        "ffmpeg version N-112000-g1234567 Copyright (c) 2000-2023": "-fps_mode",
+    }
+    try:
+        for version, option in versions.items():
+            frame_module.ffmpeg_passthrough_option.cache_clear()
+            with pytest.MonkeyPatch.context() as patch:
+                patch.setattr(frame_module.subprocess, 'run', lambda *args, **kwargs: type('Result', (), {'stdout': version}))
+                assert frame_module.ffmpeg_passthrough_option() == option
+    finally:
+        frame_module.ffmpeg_passthrough_option.cache_clear()
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg not installed")
+def test_iframes_mode():
+    """Only keyframes from the container index are selected."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = Path(temp_dir) / 'video.mp4'
+        make_video(video_path)
+
+        processor = VideoProcessor(video_path, Path(temp_dir) / 'frames', 'test', mode='iframes')
+        processor._plan(30, None, None)
+        keyframes = processor._keyframe_numbers(600)
+        assert len(keyframes) < 600
+
+        # count every frame OpenCV decodes and every frame read from ffmpeg
+        decoded, capture, read_frames = [], cv2.VideoCapture, processor._ffmpeg_thumbnails
+
+        class CountingCapture:
+            def __init__(self, *args):
+                self.cap = capture(*args)
+
+            def grab(self):
+                decoded.append('grab')
+                return self.cap.grab()
+
+            def read(self, *args, **kwargs):
+                decoded.append('read')
+                return self.cap.read(*args, **kwargs)
+
+            def __getattr__(self, name):
+                return getattr(self.cap, name)
+
+        def counting_frames(*args, **kwargs):
+            for frame in read_frames(*args, **kwargs):
+                decoded.append('ffmpeg')
+                yield frame
+
+        with pytest.MonkeyPatch.context() as patch:
+            patch.setattr(cv2, 'VideoCapture', CountingCapture)
+            patch.setattr(processor, '_ffmpeg_thumbnails', counting_frames)
+            frames = processor.extract_keyframes(frames_per_minute=30)
+
+        assert frames
+        assert all(f.number in keyframes for f in frames)
+        # only the keyframes are decoded, by ffmpeg, and the selected ones are not decoded again
+        assert decoded == ['ffmpeg'] * len(keyframes)
+        image = cv2.imdecode(np.frombuffer(frames[0].data, np.uint8), cv2.IMREAD_COLOR)
+        assert image.shape == (240, 320, 3)
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg not installed")
+@pytest.mark.parametrize('decoder', ['opencv', 'ffmpeg'])
+def test_streaming_iframes(decoder):
+    """Streamed keyframes score as in a scan of all keyframes, window starts included."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = Path(temp_dir) / 'video.mp4'
+        make_video(video_path, seconds=30)
+
+        # every keyframe is a candidate and the quotas fit all of them
+        processor = VideoProcessor(video_path, Path(temp_dir) / 'frames', 'test', threshold=-1,
+                                   decoder=decoder, mode='iframes', persist=False)
+        processor._plan(60, None, None)
+        keyframes = processor._keyframe_numbers(900)
+        full_scan = {-neg_num: score for score, neg_num, _ in processor._scan_keyframes(keyframes, len(keyframes))}
+
+        frames = list(processor.iter_keyframes(frames_per_minute=1800, window=5))
+        assert [f.number for f in frames] == keyframes
+        assert [f.score for f in frames] == pytest.approx([full_scan[f.number] for f in frames])
+
+if __name__ == "__main__":
+    test_frame_scorer()
+    test_candidate_heap()
+    test_sparse_decoding()
+    test_in_memory_frames()
+    test_extraction_cache()
+    test_parallel_segments()
+    test_streaming_windows()
+    test_ffmpeg_decoder()
+    test_scene_scorer()
+    test_ffmpeg_passthrough_option()
+    test_iframes_mode()
+    test_streaming_iframes('opencv')
+    test_streaming_iframes('ffmpeg')
+    print("All tests passed!")
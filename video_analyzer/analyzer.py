@@ -1,13 +1,63 @@
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Sequence, Iterable, Iterator, Tuple, Callable, Generator
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import difflib
 import logging
+import math
+import re
+import time
+import cv2
+import numpy as np
 from .clients.llm_client import LLMClient
 from .prompt import PromptLoader
 from .audio_processor import AudioTranscript
+from .frame import Frame, image_hash
 
 logger = logging.getLogger(__name__)
 
+# "Cell 2:", "**Cell 2**:", "### Cell 2 -" ... at the start of a line
+SECTION_PATTERN = r'^[ \t#*>_-]*{label}[ \t]+(\d+)\b[ \t*_]*[:.)-]?[ \t*_]*'
+
+def split_sections(text: str, count: int, label: str = "Cell") -> List[Optional[str]]:
+    """Split a response describing several numbered images into one text per image.
+
+    Sections start with a line like "Cell 1:" (numbered from 1). Returns a list of
+    `count` texts, None for images the response has no section for.
+    """
+    sections: List[Optional[str]] = [None] * count
+    matches = list(re.finditer(SECTION_PATTERN.format(label=label), text, re.MULTILINE | re.IGNORECASE))
+    for match, next_match in zip(matches, matches[1:] + [None]):
+        index = int(match.group(1)) - 1
+        end = next_match.start() if next_match else len(text)
+        section = text[match.end():end].strip()
+        if 0 <= index < count and section and sections[index] is None:
+            sections[index] = section
+    return sections
+
 class VideoAnalyzer:
-    def __init__(self, client: LLMClient, model: str, prompt_loader: PromptLoader, user_prompt: str = ""):
+    MOSAIC_JPEG_QUALITY = 90
+    CHARS_PER_TOKEN = 4 # rough estimate used for the context token budget
+    SUMMARY_WORDS = 200
+    SUMMARY_PROMPT = (
+        "Below are notes on consecutive frames of a video and a summary of the frames before them. "
+        "Write an updated summary of everything that has happened in the video so far, in at most {words} words. "
+        "Keep the people, objects, on-screen text and events that matter, in chronological order.\n\n"
+        "Summary so far:\n{summary}\n\n"
+        "New frame notes:\n{notes}"
+    )
+    # with prompt caching {PREVIOUS_FRAMES} moves after the instructions, it points there instead
+    PREVIOUS_FRAMES_POINTER = "(listed under \"Previous frame notes\" at the end of this prompt)"
+    # in a chat session the previous frame notes are the model's own earlier replies
+    CHAT_PREVIOUS_FRAMES_POINTER = "(your earlier replies in this conversation)"
+    RECONSTRUCTION_MODES = ('single', 'hierarchical')
+    REDUCE_FANOUT = 10 # segment summaries combined per request
+
+    def __init__(self, client: LLMClient, model: str, prompt_loader: PromptLoader, user_prompt: str = "",
+                 mosaic: int = 1, batch: int = 1, max_in_flight: int = 1, context_window: int = 0,
+                 summary_interval: int = 0, context_tokens: int = 0, reconstruction: str = "single",
+                 segment_seconds: float = 300, reconstruction_workers: int = 4, adaptive: bool = False,
+                 redundant_similarity: float = 0.8, redundant_hash_distance: int = 6, max_stride: int = 8,
+                 stream: bool = False, prompt_cache: bool = False, chat_session: bool = False):
         """Initialize the VideoAnalyzer.
         
         Args:
@@ -16,13 +66,81 @@ class VideoAnalyzer:
             prompt_loader: Loader for prompt templates
             user_prompt: Optional user question about the video that will be injected into frame analysis
                         and video description prompts using the {prompt} token
+            mosaic: Number of consecutive frames packed into one grid image per request (1 disables)
+            batch: Number of consecutive frames sent as separate images in one request (1 disables),
+                        needs a client supporting generate_batch
+            max_in_flight: Maximum number of frame analysis requests running concurrently
+            context_window: Number of most recent analyses included verbatim in {PREVIOUS_FRAMES} (0 includes all)
+            summary_interval: Fold analyses leaving the context window into a running summary every this
+                        many frames (0 drops them instead)
+            context_tokens: Approximate token budget of {PREVIOUS_FRAMES} (0 is unlimited)
+            reconstruction: "single" reconstructs the video with one request on all frame notes,
+                        "hierarchical" summarizes time segments in parallel and then combines them
+            segment_seconds: Length of the time segments of hierarchical reconstruction
+            reconstruction_workers: Number of concurrent requests of hierarchical reconstruction
+            adaptive: Skip frames while consecutive analyses are redundant, see analyze_frames
+            redundant_similarity: Word similarity (0-1) above which two responses are redundant
+            redundant_hash_distance: Image hash bits that may differ between redundant frames
+            max_stride: Longest stride over frames while analyses stay redundant
+            stream: Stream frame analysis responses, see analyze_frames
+            prompt_cache: Send the frame analysis template as a prefix that is the same for every
+                        frame, for the provider to cache, see frame_prompt_prefix
+            chat_session: Analyze frames as one conversation with the client's chat, the template as
+                        system message and each frame's note and image as a new message, instead of
+                        resending {PREVIOUS_FRAMES}; context_window caps the conversation length
         """
+        if mosaic < 1:
+            raise ValueError(f"mosaic must be at least 1, got {mosaic}")
+        if batch < 1:
+            raise ValueError(f"batch must be at least 1, got {batch}")
+        if mosaic > 1 and batch > 1:
+            raise ValueError("mosaic and batch can not be combined")
+        if adaptive and (max_in_flight > 1 or max(mosaic, batch) > 1):
+            raise ValueError("adaptive skipping analyzes one frame at a time, it can not be combined with "
+                             "max_in_flight, mosaic or batch")
+        if chat_session and not client.supports_chat():
+            raise ValueError(f"{type(client).__name__} does not support chat sessions")
+        if chat_session and (max_in_flight > 1 or batch > 1 or summary_interval or context_tokens or prompt_cache):
+            raise ValueError("a chat session sends frames one request after the other with the conversation as "
+                             "context, it can not be combined with max_in_flight, batch, summary_interval, "
+                             "context_tokens or prompt_cache")
+        if batch > 1 and not client.supports_batch():
+            raise ValueError(f"{type(client).__name__} does not support several images per request, batch must be 1")
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, got {max_in_flight}")
+        if reconstruction not in self.RECONSTRUCTION_MODES:
+            raise ValueError(f"Unknown reconstruction mode {reconstruction}, expected one of {self.RECONSTRUCTION_MODES}")
+        if segment_seconds <= 0:
+            raise ValueError(f"segment_seconds must be positive, got {segment_seconds}")
         self.client = client
         self.model = model
         self.prompt_loader = prompt_loader
         self.user_prompt = user_prompt  # Store user's question about the video
+        self.mosaic = mosaic
+        self.batch = batch
+        self.group_size = max(mosaic, batch) # frames per request
+        self.max_in_flight = max_in_flight
+        self.context_window = context_window
+        self.summary_interval = summary_interval
+        self.context_tokens = context_tokens
+        self.reconstruction = reconstruction
+        self.segment_seconds = segment_seconds
+        self.reconstruction_workers = max(1, reconstruction_workers)
+        self.adaptive = adaptive
+        self.redundant_similarity = redundant_similarity
+        self.redundant_hash_distance = redundant_hash_distance
+        self.max_stride = max(1, max_stride)
+        self.stream = stream
+        self.prompt_cache = prompt_cache
+        self.chat_session = chat_session
+        self.chat_history: List[Dict[str, Any]] = [] # user and assistant messages of the chat session
+        self.skipped_frames = [] # numbers of frames adaptive skipping left out
         self._load_prompts()
         self.previous_analyses = []
+        # running summary of previous_analyses[:summarized_count], responses of the calls that built it
+        self.context_summary = ""
+        self.summarized_count = 0
+        self.context_summaries = []
         
     def _format_user_prompt(self) -> str:
         """Format the user's prompt by adding prefix if not empty."""
@@ -36,66 +154,520 @@ class VideoAnalyzer:
         self.video_prompt = self.prompt_loader.get_by_index(1)  # Video Reconstruction prompt
 
     def _format_previous_analyses(self) -> str:
-        """Format previous frame analyses for inclusion in prompt."""
-        if not self.previous_analyses:
-            return ""
-            
+        """Format previous frame analyses for inclusion in prompt.
+
+        Includes the running summary, if any, followed by the analyses after it,
+        oldest dropped first to stay within the context window and token budget.
+        With a running summary the analyses after it are all kept, that is up to
+        context_window + summary_interval - 1 of them.
+        """
+        recent = self.previous_analyses[self.summarized_count:]
+        first = self.summarized_count
+        if self.context_window and not self.summary_interval and len(recent) > self.context_window:
+            first += len(recent) - self.context_window
+            recent = recent[-self.context_window:]
+
+        summary = ""
+        if self.context_summary:
+            summary = f"Summary of frames 0-{self.summarized_count - 1}\n{self.context_summary}\n"
+        budget = self.context_tokens * self.CHARS_PER_TOKEN if self.context_tokens else None
+        if budget is not None:
+            summary = summary[:budget]
+            budget -= len(summary)
+
         formatted_analyses = []
-        for i, analysis in enumerate(self.previous_analyses):
+        for i, analysis in reversed(list(enumerate(recent, start=first))):
             formatted_analysis = (
                 f"Frame {i}\n"
                 f"{analysis.get('response', 'No analysis available')}\n"
             )
+            if budget is not None:
+                if len(formatted_analysis) > budget:
+                    break
+                budget -= len(formatted_analysis)
             formatted_analyses.append(formatted_analysis)
-            
+        formatted_analyses.reverse()
+
+        if summary:
+            formatted_analyses.insert(0, summary)
         return "\n".join(formatted_analyses)
 
-    def analyze_frame(self, frame) -> Dict[str, Any]:
-        """Analyze a single frame using the LLM."""
-        # Replace {PREVIOUS_FRAMES} token with formatted previous analyses
-        # Replace tokens in the prompt template
-        prompt = self.frame_prompt.replace("{PREVIOUS_FRAMES}", self._format_previous_analyses())
-        prompt = prompt.replace("{prompt}", self._format_user_prompt())
-        prompt = f"{prompt}\nThis is frame {frame['num']} captured at {frame['timestamp']:.2f} seconds."
+    def _remember(self, analyses: List[Dict[str, Any]]):
+        """Store analyses, in frame order, as context for the frames after them."""
+        self.previous_analyses.extend(analyses)
+        count = self._summary_due()
+        if count is not None:
+            self._update_summary(count)
+
+    def _summary_due(self) -> Optional[int]:
+        """Number of analyses the running summary should cover now, None when it is up to date."""
+        if not self.context_window or not self.summary_interval:
+            return None
+        # refresh the summary once summary_interval analyses beyond the window piled up
+        leaving = len(self.previous_analyses) - self.summarized_count - self.context_window
+        if leaving >= self.summary_interval:
+            return self.summarized_count + leaving
+        return None
+
+    def _summary_prompt(self, count: int) -> str:
+        """Prompt folding previous_analyses[summarized_count:count] into the running summary."""
+        notes = "\n".join(
+            f"Frame {i}\n{analysis.get('response', 'No analysis available')}\n"
+            for i, analysis in enumerate(self.previous_analyses[self.summarized_count:count], start=self.summarized_count)
+        )
+        return self.SUMMARY_PROMPT.format(
+            words=self.SUMMARY_WORDS,
+            summary=self.context_summary or "(none yet)",
+            notes=notes
+        )
+
+    def _update_summary(self, count: int):
+        """Fold previous_analyses[summarized_count:count] into the running summary."""
+        try:
+            response = self.client.generate(prompt=self._summary_prompt(count), model=self.model,
+                                            num_predict=self.SUMMARY_WORDS * 2)
+        except Exception as e:
+            # keep the analyses verbatim and try again with the next ones
+            logger.error(f"Error summarizing frames {self.summarized_count}-{count - 1}: {e}")
+            return
+        self._apply_summary(count, response)
+
+    def _apply_summary(self, count: int, response: Dict[str, Any]):
+        self.context_summaries.append({k: v for k, v in response.items() if k != "context"})
+        self.context_summary = response.get("response", "").strip()
+        self.summarized_count = count
+        logger.debug(f"Summarized previous frames 0-{count - 1}")
+
+    def frame_prompt_prefix(self) -> str:
+        """The frame analysis template with the user prompt filled in and {PREVIOUS_FRAMES}
+        pointing to the end of the prompt: the start of every frame prompt with prompt_cache.
+
+        Providers cache prompt prefixes (OpenAI automatically, Gemini with cachedContents),
+        which only helps when nothing that changes between frames comes before them.
+        """
+        pointer = self.CHAT_PREVIOUS_FRAMES_POINTER if self.chat_session else self.PREVIOUS_FRAMES_POINTER
+        prompt = self.frame_prompt.replace("{PREVIOUS_FRAMES}", pointer)
+        return prompt.replace("{prompt}", self._format_user_prompt())
+
+    def _frame_prompt(self, frame_note: str, context: str) -> str:
+        """Fill the frame analysis template and append the note about the frame(s) shown."""
+        if self.chat_session:
+            # the template is the system message and the previous notes are in the conversation
+            prompt = frame_note
+        elif self.prompt_cache:
+            # everything that changes between frames goes after the stable prefix
+            prompt = f"{self.frame_prompt_prefix()}\n\nPrevious frame notes:\n{context or 'None, this is the first frame.'}\n\n{frame_note}"
+        else:
+            # Replace {PREVIOUS_FRAMES} token with formatted previous analyses
+            # Replace tokens in the prompt template
+            prompt = self.frame_prompt.replace("{PREVIOUS_FRAMES}", context)
+            prompt = prompt.replace("{prompt}", self._format_user_prompt())
+            prompt = f"{prompt}\n{frame_note}"
         
         logger.info(f'prompt : `{prompt[:64]}{"..." if len(prompt) > 64 else ""}`')
+        return prompt
+
+    def analyze_frame(self, frame: Frame) -> Dict[str, Any]:
+        """Analyze a single frame using the LLM."""
+        analysis_result = self._analyze_frame(frame, self._format_previous_analyses())
+        # Store the analysis for future frames
+        self._remember([analysis_result])
+        return analysis_result
+
+    def _analyze_frame(self, frame: Frame, context: str,
+                       on_token: Optional[Callable[[Frame, str], None]] = None) -> Dict[str, Any]:
+        """Analyze a single frame given the formatted analyses of the frames before it."""
+        return self._analyze_group([frame], context, on_token)[0]
 
+    @staticmethod
+    def _mosaic_grid(count: int) -> Tuple[int, int]:
+        """(rows, columns) of the most square grid holding `count` cells."""
+        columns = math.ceil(math.sqrt(count))
+        return math.ceil(count / columns), columns
+
+    def build_mosaic(self, frames: Sequence[Frame]) -> bytes:
+        """Pack frames into one JPEG grid, left to right and top to bottom, each cell
+        labelled with its number and timestamp.
+
+        Cells have the size of the first frame; the client's image policy scales the
+        mosaic down to what the provider accepts.
+        """
+        images = [cv2.imdecode(np.frombuffer(frame.data, dtype=np.uint8), cv2.IMREAD_COLOR) for frame in frames]
+        height, width = images[0].shape[:2]
+        rows, columns = self._mosaic_grid(len(images))
+        mosaic = np.zeros((rows * height, columns * width, 3), dtype=np.uint8)
+
+        font_scale = max(0.5, height / 720)
+        thickness = max(1, round(font_scale * 2))
+        for i, (frame, image) in enumerate(zip(frames, images)):
+            if image.shape[:2] != (height, width):
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+            y, x = (i // columns) * height, (i % columns) * width
+            cell = mosaic[y:y + height, x:x + width]
+            cell[:] = image
+
+            label = f"{i + 1} | {frame.timestamp:.1f}s"
+            (text_width, text_height), baseline = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+            pad = thickness * 3
+            cv2.rectangle(cell, (0, 0), (text_width + 2 * pad, text_height + baseline + 2 * pad), (0, 0, 0), -1)
+            cv2.putText(cell, label, (pad, pad + text_height), cv2.FONT_HERSHEY_SIMPLEX, font_scale,
+                        (255, 255, 255), thickness, cv2.LINE_AA)
+
+        ok, jpeg = cv2.imencode('.jpg', mosaic, [int(cv2.IMWRITE_JPEG_QUALITY), self.MOSAIC_JPEG_QUALITY])
+        if not ok:
+            raise RuntimeError("Could not encode frame mosaic")
+        return jpeg.tobytes()
+
+    def analyze_group(self, frames: Sequence[Frame]) -> List[Dict[str, Any]]:
+        """Analyze consecutive frames with a single request, on a mosaic of them or,
+        in batch mode, on the frames sent as separate images.
+
+        The model is asked to describe each cell or image under a "Cell k:" or
+        "Image k:" heading and the response is split back into one analysis per
+        frame. Frames the response has no section for get the whole response.
+        Token usage is reported on the first frame's analysis only.
+        """
+        results = self._analyze_group(frames, self._format_previous_analyses())
+        self._remember(results)
+        return results
+
+    def _analyze_group(self, frames: Sequence[Frame], context: str,
+                       on_token: Optional[Callable[[Frame, str], None]] = None) -> List[Dict[str, Any]]:
+        """Analyze a group of frames given the formatted analyses of the frames before them.
+
+        Batch requests are not streamed.
+        """
         try:
-            response = self.client.generate(
-                prompt=prompt,
-                image_path=frame['path'],
-                model=self.model,
-                num_predict=300
+            method, kwargs, mode = self._group_request(frames, context, on_token)
+            response = getattr(self.client, method)(**kwargs)
+        except Exception as e:
+            return self._group_error(frames, e)
+        return self._group_results(frames, method, kwargs, mode, response)
+
+    def _group_request(self, frames: Sequence[Frame], context: str,
+                       on_token: Optional[Callable[[Frame, str], None]] = None
+                       ) -> Tuple[str, Dict[str, Any], Optional[str]]:
+        """The client method and keyword arguments of the request analyzing `frames`,
+        and the group mode: None for a single frame, 'mosaic' or 'batch'."""
+        if len(frames) == 1:
+            frame = frames[0]
+            prompt = self._frame_prompt(f"This is frame {frame.number} captured at {frame.timestamp:.2f} seconds.",
+                                        context)
+            return (*self._request(prompt, frame.data, 300, self._token_callback(frame, on_token),
+                                   image_path=frame.path), None)
+
+        if self.batch > 1:
+            images = "\n".join(
+                f"Image {i + 1}: frame {frame.number} captured at {frame.timestamp:.2f} seconds."
+                for i, frame in enumerate(frames)
+            )
+            prompt = self._frame_prompt(
+                f"These are {len(frames)} consecutive frames of the video, in order.\n"
+                f"{images}\n"
+                f"Describe each image separately, starting each description on a new line with \"Image <number>:\".",
+                context
             )
-            logger.debug(f"Successfully analyzed frame {frame['num']}")
-            
-            # Store the analysis for future frames
+            return "generate_batch", {
+                "prompt": prompt,
+                "images": [frame.data for frame in frames],
+                "model": self.model,
+                "num_predict": 300 * len(frames)
+            }, 'batch'
+
+        rows, columns = self._mosaic_grid(len(frames))
+        cells = "\n".join(
+            f"Cell {i + 1}: frame {frame.number} captured at {frame.timestamp:.2f} seconds."
+            for i, frame in enumerate(frames)
+        )
+        prompt = self._frame_prompt(
+            f"This image is a grid of {len(frames)} consecutive frames in {rows} rows and {columns} columns, "
+            f"numbered left to right and top to bottom, each labelled with its cell number and timestamp.\n"
+            f"{cells}\n"
+            f"Describe each cell separately, starting each description on a new line with \"Cell <number>:\".",
+            context
+        )
+        return (*self._request(prompt, self.build_mosaic(frames), 300 * len(frames),
+                               self._token_callback(frames[0], on_token)), 'mosaic')
+
+    def _group_error(self, frames: Sequence[Frame], error: Exception) -> List[Dict[str, Any]]:
+        """Analyses of frames whose request failed."""
+        if len(frames) == 1:
+            logger.error(f"Error analyzing frame {frames[0].number}: {error}")
+        else:
+            logger.error(f"Error analyzing frames {frames[0].number}-{frames[-1].number}: {error}")
+        return [
+            {"response": f"Error analyzing frame {frame.number}: {str(error)}", "frame": frame.to_dict()}
+            for frame in frames
+        ]
+
+    def _group_results(self, frames: Sequence[Frame], method: str, kwargs: Dict[str, Any], mode: Optional[str],
+                       response: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Split the response of a group request into one analysis per frame."""
+        if method == "chat":
+            self._chat_turn(kwargs["messages"][-1]["content"], response)
+
+        if mode is None:
+            frame = frames[0]
+            logger.debug(f"Successfully analyzed frame {frame.number}")
             analysis_result = {k: v for k, v in response.items() if k != "context"}
-            frame.pop('path') # we send frame dict as part of analysis - remove local server path
-            analysis_result['frame'] = frame
-            
-            self.previous_analyses.append(analysis_result)
-    
-            return analysis_result
-            
-        except Exception as e:
-            logger.error(f"Error analyzing frame {frame['num']}: {e}")
-            error_result = {"response": f"Error analyzing frame {frame['num']}: {str(e)}"}
-            self.previous_analyses.append(error_result)
-            return error_result
+            # we send frame metadata as part of analysis - without local server path and image bytes
+            analysis_result['frame'] = frame.to_dict()
+            return [analysis_result]
 
-    def reconstruct_video(self, frame_analyses: Dict[int,Dict[str, Any]], frames, 
-                         transcript: Optional[AudioTranscript] = None) -> Dict[str, Any]:
-        """Reconstruct video description from frame analyses and transcript."""
+        frame_range = f"{frames[0].number}-{frames[-1].number}"
+        logger.debug(f"Successfully analyzed frames {frame_range}")
+        label = 'Image' if mode == 'batch' else 'Cell'
+        text = response.get("response", "")
+        sections = split_sections(text, len(frames), label)
+        if None in sections:
+            logger.warning(f"Response for frames {frame_range} has no section for "
+                           f"{sections.count(None)} of {len(frames)} {label.lower()}s, using the whole response for them")
+
+        results = []
+        for i, (frame, section) in enumerate(zip(frames, sections)):
+            analysis_result = {k: v for k, v in response.items() if k not in ("context", "token_usage", "stream") or i == 0}
+            analysis_result['response'] = section if section is not None else text
+            analysis_result['frame'] = frame.to_dict()
+            analysis_result[mode] = {'index': i + 1, 'size': len(frames)}
+            results.append(analysis_result)
+
+        return results
+
+    def _groups(self, frames: Iterable[Frame]) -> Iterator[List[Frame]]:
+        """Group frames into lists of `group_size` consecutive frames, one per request."""
+        group: List[Frame] = []
+        for frame in frames:
+            group.append(frame)
+            if len(group) == self.group_size:
+                yield group
+                group = []
+        if group:
+            yield group
+
+    def _request(self, prompt: str, image_data: bytes, num_predict: int,
+                 on_token: Optional[Callable[[str], None]] = None, image_path: Optional[str] = None
+                 ) -> Tuple[str, Dict[str, Any]]:
+        """Client method and keyword arguments of a frame analysis request on one image,
+        the next message of the chat session with chat_session."""
+        if not self.chat_session:
+            return "generate", {
+                "prompt": prompt,
+                "image_path": image_path,
+                "image_data": image_data,
+                "model": self.model,
+                "num_predict": num_predict,
+                "stream": self.stream,
+                "on_token": on_token
+            }
+
+        messages = [{"role": "system", "content": self.frame_prompt_prefix()}, *self.chat_history,
+                    {"role": "user", "content": prompt, "images": [image_data if image_data is not None else image_path]}]
+        return "chat", {
+            "messages": messages,
+            "model": self.model,
+            "num_predict": num_predict,
+            "stream": self.stream,
+            "on_token": on_token
+        }
+
+    def _chat_turn(self, prompt: str, response: Dict[str, Any]):
+        """Add a frame's message and the reply to the chat session."""
+        # earlier images are not sent again, the replies describing them stand in for them
+        self.chat_history += [{"role": "user", "content": prompt},
+                              {"role": "assistant", "content": response.get("response", "")}]
+        if self.context_window and len(self.chat_history) > 2 * self.context_window:
+            # drop half a window of turns at once, every trim makes the server evaluate the conversation again
+            self.chat_history = self.chat_history[-2 * max(1, self.context_window // 2):]
+
+    def _token_callback(self, frame: Frame, on_token: Optional[Callable[[Frame, str], None]]
+                        ) -> Optional[Callable[[str], None]]:
+        """Client on_token callback passing streamed text on with the request's (first) frame."""
+        if not self.stream or on_token is None:
+            return None
+        return lambda text: on_token(frame, text)
+
+    def _analyze_timed(self, group: List[Frame], context: str,
+                       on_token: Optional[Callable[[Frame, str], None]] = None) -> List[Dict[str, Any]]:
+        """Analyze one request's worth of frames, giving each analysis its share of the request time."""
+        start_time = time.perf_counter()
+        analyses = self._analyze_group(group, context, on_token)
+        elapsed_time = time.perf_counter() - start_time
+        for analysis in analyses:
+            analysis['time'] = elapsed_time / len(group)
+        return analyses
+
+    def analyze_frames(self, frames: Iterable[Frame],
+                       on_complete: Optional[Callable[[Frame, Dict[str, Any]], None]] = None,
+                       on_token: Optional[Callable[[Frame, str], None]] = None
+                       ) -> Iterator[Tuple[Frame, Dict[str, Any]]]:
+        """Analyze frames, yielding (frame, analysis) in frame order.
+
+        With mosaic or batch > 1, groups of consecutive frames are analyzed with one
+        request each. Up to max_in_flight requests run concurrently; each request's
+        {PREVIOUS_FRAMES} context is the analyses of the earlier frames that had
+        completed in order when it was sent, so with one request in flight every
+        frame sees all frames before it.
+
+        on_complete is called for every analysis as soon as its request finishes,
+        which may be out of frame order.
+
+        With stream, on_token is called with each piece of a response as it arrives
+        and the frame it describes (the first frame of a mosaic), from the request's
+        thread, and analyses get the 'stream' metrics of their request: time to
+        first token and tokens per second.
+
+        With adaptive skipping, frames whose analysis would likely repeat the last
+        one are not analyzed, and are not yielded.
+
+        With prompt_cache, the client is told the frame prompt prefix first.
+        """
+        if self.prompt_cache:
+            self.client.cache_prompt_prefix(self.frame_prompt_prefix(), self.model)
+
+        if self.adaptive:
+            yield from self._analyze_adaptive(frames, on_complete, on_token)
+            return
+
+        if self.max_in_flight == 1:
+            for group in self._groups(frames):
+                analyses = self._analyze_timed(group, self._format_previous_analyses(), on_token)
+                self._remember(analyses)
+                for frame, analysis in zip(group, analyses):
+                    if on_complete:
+                        on_complete(frame, analysis)
+                    yield frame, analysis
+            return
+
+        groups = self._groups(frames)
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            pending = deque() # (group, future) in frame order
+            completed = set()
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < self.max_in_flight:
+                    group = next(groups, None)
+                    if group is None:
+                        exhausted = True
+                        break
+                    # context from the in-order completed prefix
+                    context = self._format_previous_analyses()
+                    pending.append((group, executor.submit(self._analyze_timed, group, context, on_token)))
+                if not pending:
+                    break
+
+                done, _ = wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                for group, future in pending:
+                    if future in done and future not in completed:
+                        completed.add(future)
+                        if on_complete:
+                            for frame, analysis in zip(group, future.result()):
+                                on_complete(frame, analysis)
+
+                while pending and pending[0][1] in completed:
+                    group, future = pending.popleft()
+                    completed.discard(future)
+                    analyses = future.result()
+                    self._remember(analyses)
+                    yield from zip(group, analyses)
+
+    def _analyze_adaptive(self, frames: Iterable[Frame],
+                          on_complete: Optional[Callable[[Frame, Dict[str, Any]], None]] = None,
+                          on_token: Optional[Callable[[Frame, str], None]] = None
+                          ) -> Iterator[Tuple[Frame, Dict[str, Any]]]:
+        """Analyze frames sequentially, widening the stride over them while analyses are redundant.
+
+        An analysis is redundant when its response is at least redundant_similarity
+        similar to the previous one and its frame's image hash is within
+        redundant_hash_distance bits of the previous analyzed frame's. Each redundant
+        analysis doubles the stride, up to max_stride, and any other one resets it to 1.
+        Skipped frames are still hashed, so a frame that looks different from the
+        last analyzed one ends the skip and is analyzed.
+        """
+        stride = 1
+        to_skip = 0
+        last_hash = last_response = None
+
+        for frame in frames:
+            frame_hash = image_hash(frame.data)
+            distance = bin(frame_hash ^ last_hash).count("1") if last_hash is not None else None
+            if to_skip and distance <= self.redundant_hash_distance:
+                to_skip -= 1
+                self.skipped_frames.append(frame.number)
+                logger.debug(f"Skipping frame {frame.number}, stride {stride}")
+                continue
+            if to_skip:
+                logger.debug(f"Frame {frame.number} changed ({distance} bits), ending the skip")
+
+            analysis = self._analyze_timed([frame], self._format_previous_analyses(), on_token)[0]
+            self._remember([analysis])
+
+            response = analysis.get('response', '')
+            similarity = (
+                difflib.SequenceMatcher(None, last_response.split(), response.split()).ratio()
+                if last_response is not None else 0.0
+            )
+            if (similarity >= self.redundant_similarity
+                    and distance is not None and distance <= self.redundant_hash_distance):
+                stride = min(stride * 2, self.max_stride)
+            else:
+                stride = 1
+            to_skip = stride - 1
+            analysis['adaptive'] = {'similarity': similarity, 'hash_distance': distance, 'stride': stride}
+            last_hash, last_response = frame_hash, response
+
+            if on_complete:
+                on_complete(frame, analysis)
+            yield frame, analysis
+
+    def _format_frame_notes(self, frame_analyses: Sequence[Dict[str, Any]], frames: Sequence[Frame], start: int = 0) -> str:
+        """Format frame analyses as {FRAME_NOTES}, numbering frames from `start`."""
         frame_notes = []
-        for i, (frame, analysis) in enumerate(zip(frames, frame_analyses)):
+        for i, (frame, analysis) in enumerate(zip(frames, frame_analyses), start=start):
             frame_note = (
-                f"Frame {i} ({frame['timestamp']:.2f}s):\n"
+                f"Frame {i} ({frame.timestamp:.2f}s):\n"
                 f"{analysis.get('response', 'No analysis available')}"
             )
             frame_notes.append(frame_note)
         
-        analysis_text = "\n\n".join(frame_notes)
+        return "\n\n".join(frame_notes)
+
+    def _reconstruction_prompt(self, frame_notes: str, first_frame_text: str, transcript_text: str, note: str = "") -> str:
+        """Fill the video reconstruction template, followed by an optional note on what the notes cover."""
+        # Replace tokens in the prompt template
+        prompt = self.video_prompt.replace("{prompt}", self._format_user_prompt())
+        prompt = prompt.replace("{FRAME_NOTES}", frame_notes)
+        prompt = prompt.replace("{FIRST_FRAME}", first_frame_text)
+        prompt = prompt.replace("{TRANSCRIPT}", transcript_text)
+        if note:
+            prompt = f"{prompt}\n{note}"
+        return prompt
+
+    def reconstruct_video(self, frame_analyses: List[Dict[str, Any]], frames: Sequence[Frame], 
+                         transcript: Optional[AudioTranscript] = None) -> Dict[str, Any]:
+        """Reconstruct video description from frame analyses and transcript."""
+        steps = self._reconstruction_steps(frame_analyses, frames, transcript)
+        with ThreadPoolExecutor(max_workers=self.reconstruction_workers) as executor:
+            try:
+                jobs = next(steps)
+                while True:
+                    jobs = steps.send(list(executor.map(lambda job: self._summarize_part(*job), jobs)))
+            except StopIteration as stop:
+                return stop.value
+
+    def _reconstruction_steps(self, frame_analyses: Sequence[Dict[str, Any]], frames: Sequence[Frame],
+                              transcript: Optional[AudioTranscript]
+                              ) -> Generator[List[Tuple[str, int, str]], List[Dict[str, Any]], Dict[str, Any]]:
+        """Reconstruction as rounds of independent requests.
+
+        Yields the (prompt, num_predict, description) of each round's requests, is sent
+        their responses in the same order, and returns the reconstruction.
+        """
+        if self.reconstruction == "hierarchical":
+            segments = self._segments(frame_analyses, frames)
+            if len(segments) > 1:
+                return (yield from self._hierarchical_steps(segments, frame_analyses, frames, transcript))
+
+        analysis_text = self._format_frame_notes(frame_analyses, frames)
         
         # Get first frame analysis
         first_frame_text = ""
@@ -107,20 +679,115 @@ class VideoAnalyzer:
         if transcript and transcript.text.strip():
             transcript_text = transcript.text
         
-        # Replace tokens in the prompt template
-        prompt = self.video_prompt.replace("{prompt}", self._format_user_prompt())
-        prompt = prompt.replace("{FRAME_NOTES}", analysis_text)
-        prompt = prompt.replace("{FIRST_FRAME}", first_frame_text)
-        prompt = prompt.replace("{TRANSCRIPT}", transcript_text)
-        
+        prompt = self._reconstruction_prompt(analysis_text, first_frame_text, transcript_text)
+        response, = yield [(prompt, 1000, "video")]
+        return response
+
+    def _segments(self, frame_analyses: Sequence[Dict[str, Any]], frames: Sequence[Frame]) -> List[Tuple[float, float, int, int]]:
+        """Split frames into consecutive time segments of segment_seconds.
+
+        Returns (start_time, end_time, first_frame, end_frame) per segment that has frames.
+        """
+        segments = []
+        count = min(len(frames), len(frame_analyses))
+        first = 0
+        for i in range(1, count + 1):
+            segment = int(frames[first].timestamp // self.segment_seconds)
+            if i == count or int(frames[i].timestamp // self.segment_seconds) != segment:
+                segments.append((segment * self.segment_seconds, (segment + 1) * self.segment_seconds, first, i))
+                first = i
+        return segments
+
+    @staticmethod
+    def _transcript_slice(transcript: Optional[AudioTranscript], start: float, end: float) -> str:
+        """Text of the transcript segments overlapping [start, end)."""
+        if not transcript or not transcript.segments:
+            return ""
+        return " ".join(
+            segment["text"].strip() for segment in transcript.segments
+            if segment["start"] < end and segment["end"] > start
+        )
+
+    def _summarize_part(self, prompt: str, num_predict: int, description: str) -> Dict[str, Any]:
+        """Run one request of reconstruction."""
         try:
-            response = self.client.generate(
-                prompt=prompt,
-                model=self.model,
-                num_predict=1000
-            )
-            logger.info("Successfully reconstructed video description")
-            return {k: v for k, v in response.items() if k != "context"}
+            response = self.client.generate(prompt=prompt, model=self.model, num_predict=num_predict)
         except Exception as e:
-            logger.error(f"Error reconstructing video: {e}")
-            return {"response": f"Error reconstructing video: {str(e)}"}
+            return self._part_error(description, e)
+        return self._part_result(description, response)
+
+    @staticmethod
+    def _part_result(description: str, response: Dict[str, Any]) -> Dict[str, Any]:
+        logger.debug(f"Successfully reconstructed {description}")
+        return {k: v for k, v in response.items() if k != "context"}
+
+    @staticmethod
+    def _part_error(description: str, error: Exception) -> Dict[str, Any]:
+        logger.error(f"Error reconstructing {description}: {error}")
+        return {"response": f"Error reconstructing {description}: {str(error)}"}
+
+    def _hierarchical_steps(self, segments: List[Tuple[float, float, int, int]],
+                            frame_analyses: Sequence[Dict[str, Any]], frames: Sequence[Frame],
+                            transcript: Optional[AudioTranscript]
+                            ) -> Generator[List[Tuple[str, int, str]], List[Dict[str, Any]], Dict[str, Any]]:
+        """Map-reduce reconstruction: describe each time segment from its frame notes and
+        transcript slice in one round, then combine the segment descriptions, REDUCE_FANOUT
+        at a time, one round per level, until one description is left.
+
+        The result is the final description with the token usage of all requests summed
+        and the per-segment descriptions under 'segments'.
+        """
+        first_frame_text = frame_analyses[0].get('response', '') if frame_analyses else ""
+        responses = []
+
+        # map : one description per time segment
+        jobs = []
+        for k, (start, end, first, last) in enumerate(segments):
+            prompt = self._reconstruction_prompt(
+                self._format_frame_notes(frame_analyses[first:last], [frames[i] for i in range(first, last)], start=first),
+                frame_analyses[first].get('response', ''),
+                self._transcript_slice(transcript, start, end),
+                f"These notes only cover part {k + 1} of {len(segments)} of the video, "
+                f"from {start:.0f} to {end:.0f} seconds. Describe only this part."
+            )
+            jobs.append((prompt, 500, f"segment {start:.0f}-{end:.0f}s"))
+        parts = yield jobs
+        responses.extend(parts)
+        spans = [(start, end) for start, end, _, _ in segments]
+        segment_results = [
+            {"start": start, "end": end, **part} for (start, end), part in zip(spans, parts)
+        ]
+
+        # reduce : combine consecutive descriptions until one is left
+        while True:
+            groups = [range(i, min(i + self.REDUCE_FANOUT, len(parts))) for i in range(0, len(parts), self.REDUCE_FANOUT)]
+            jobs = []
+            for group in groups:
+                notes = "\n\n".join(
+                    f"Part {i + 1} ({spans[i][0]:.0f}s - {spans[i][1]:.0f}s):\n{parts[i].get('response', '')}"
+                    for i in group
+                )
+                final = len(groups) == 1
+                note = ("The notes above are descriptions of consecutive parts of the video rather than "
+                        "single frames, and already include what was said in each part. Combine them into one description"
+                        + (" of the whole video." if final else f" of {spans[group[0]][0]:.0f}s - {spans[group[-1]][1]:.0f}s."))
+                prompt = self._reconstruction_prompt(notes, first_frame_text, "", note)
+                jobs.append((prompt, 1000 if final else 500,
+                             "video" if final else f"parts {group[0] + 1}-{group[-1] + 1}"))
+            parts = yield jobs
+            responses.extend(parts)
+            spans = [(spans[group[0]][0], spans[group[-1]][1]) for group in groups]
+            if len(parts) == 1:
+                break
+
+        result = dict(parts[0])
+        usages = [response['token_usage'] for response in responses if 'token_usage' in response]
+        if usages:
+            result['token_usage'] = {
+                key: sum(usage.get(key, 0) for usage in usages)
+                for key in ('prompt_tokens', 'cached_prompt_tokens', 'uncached_prompt_tokens',
+                            'completion_tokens', 'total_tokens', 'cost')
+            }
+        result['segments'] = segment_results
+        logger.info(f"Successfully reconstructed video description from {len(segments)} segments")
+        return result
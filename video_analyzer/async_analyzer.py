@@ -0,0 +1,162 @@
+from typing import List, Dict, Any, Optional, Iterable, AsyncIterator, Tuple, Callable
+from collections import deque
+import asyncio
+import logging
+import time
+
+from .analyzer import VideoAnalyzer
+from .audio_processor import AudioTranscript
+from .frame import Frame
+
+logger = logging.getLogger(__name__)
+
+class AsyncVideoAnalyzer(VideoAnalyzer):
+    """VideoAnalyzer whose requests are coroutines on the running event loop.
+
+    Requests go through the clients' agenerate, agenerate_batch and achat. One
+    analyzer handles one video; several videos are analyzed at once by awaiting
+    their analyzers together, e.g. with asyncio.gather, and passing them the same
+    `semaphore` bounds the requests in flight across all of them. max_in_flight
+    still bounds each video's own frame requests and decides how fresh their
+    {PREVIOUS_FRAMES} context is, as in analyze_frames.
+
+    Adaptive skipping is not supported.
+    """
+    def __init__(self, *args, semaphore: Optional[asyncio.Semaphore] = None, **kwargs):
+        """Take the arguments of VideoAnalyzer, and optionally a semaphore every request
+        is made under."""
+        super().__init__(*args, **kwargs)
+        if self.adaptive:
+            raise ValueError("adaptive skipping is not supported by AsyncVideoAnalyzer")
+        self.semaphore = semaphore
+
+    async def _call(self, method: str, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """Await the coroutine variant of the client `method`, e.g. agenerate for generate."""
+        request = getattr(self.client, f"a{method}")
+        if self.semaphore is None:
+            return await request(**kwargs)
+        async with self.semaphore:
+            return await request(**kwargs)
+
+    async def _analyze_group_async(self, frames: List[Frame], context: str,
+                                   on_token: Optional[Callable[[Frame, str], None]] = None) -> List[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        try:
+            # mosaics are drawn off the event loop
+            method, kwargs, mode = await loop.run_in_executor(None, self._group_request, frames, context, on_token)
+            response = await self._call(method, kwargs)
+        except Exception as e:
+            return self._group_error(frames, e)
+        return self._group_results(frames, method, kwargs, mode, response)
+
+    async def _analyze_timed_async(self, group: List[Frame], context: str,
+                                   on_complete: Optional[Callable[[Frame, Dict[str, Any]], None]] = None,
+                                   on_token: Optional[Callable[[Frame, str], None]] = None) -> List[Dict[str, Any]]:
+        start_time = time.perf_counter()
+        analyses = await self._analyze_group_async(group, context, on_token)
+        elapsed_time = time.perf_counter() - start_time
+        for frame, analysis in zip(group, analyses):
+            analysis['time'] = elapsed_time / len(group)
+            if on_complete:
+                on_complete(frame, analysis)
+        return analyses
+
+    async def aanalyze_frames(self, frames: Iterable[Frame],
+                              on_complete: Optional[Callable[[Frame, Dict[str, Any]], None]] = None,
+                              on_token: Optional[Callable[[Frame, str], None]] = None
+                              ) -> AsyncIterator[Tuple[Frame, Dict[str, Any]]]:
+        """analyze_frames as an asynchronous iterator, with the same ordering and context.
+
+        Frames are taken from `frames` in the default executor, so an iterator that
+        blocks on extraction, e.g. VideoProcessor.iter_keyframes, does not hold up the
+        event loop. on_complete and on_token are called from the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self.prompt_cache:
+            await loop.run_in_executor(None, self.client.cache_prompt_prefix, self.frame_prompt_prefix(), self.model)
+
+        groups = self._groups(frames)
+        pending = deque() # (group, task) in frame order
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.max_in_flight:
+                    group = await loop.run_in_executor(None, next, groups, None)
+                    if group is None:
+                        exhausted = True
+                        break
+                    # context from the in-order completed prefix
+                    context = self._format_previous_analyses()
+                    pending.append((group, asyncio.ensure_future(
+                        self._analyze_timed_async(group, context, on_complete, on_token))))
+                if not pending:
+                    break
+
+                # later groups call on_complete as they finish, results are taken in order
+                await asyncio.wait([pending[0][1]])
+
+                while pending and pending[0][1].done():
+                    group, task = pending.popleft()
+                    analyses = task.result()
+                    await self._remember_async(analyses)
+                    for frame, analysis in zip(group, analyses):
+                        yield frame, analysis
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def _remember_async(self, analyses: List[Dict[str, Any]]):
+        self.previous_analyses.extend(analyses)
+        count = self._summary_due()
+        if count is None:
+            return
+        try:
+            response = await self._call("generate", {
+                "prompt": self._summary_prompt(count),
+                "model": self.model,
+                "num_predict": self.SUMMARY_WORDS * 2
+            })
+        except Exception as e:
+            # keep the analyses verbatim and try again with the next ones
+            logger.error(f"Error summarizing frames {self.summarized_count}-{count - 1}: {e}")
+            return
+        self._apply_summary(count, response)
+
+    async def areconstruct_video(self, frame_analyses: List[Dict[str, Any]], frames: List[Frame],
+                                 transcript: Optional[AudioTranscript] = None) -> Dict[str, Any]:
+        """reconstruct_video with up to reconstruction_workers requests of a round in flight."""
+        workers = asyncio.Semaphore(self.reconstruction_workers)
+
+        async def summarize_part(prompt: str, num_predict: int, description: str) -> Dict[str, Any]:
+            async with workers:
+                try:
+                    response = await self._call("generate", {
+                        "prompt": prompt,
+                        "model": self.model,
+                        "num_predict": num_predict
+                    })
+                except Exception as e:
+                    return self._part_error(description, e)
+            return self._part_result(description, response)
+
+        steps = self._reconstruction_steps(frame_analyses, frames, transcript)
+        try:
+            jobs = next(steps)
+            while True:
+                jobs = steps.send(list(await asyncio.gather(*(summarize_part(*job) for job in jobs))))
+        except StopIteration as stop:
+            return stop.value
+
+    async def aanalyze_video(self, frames: Iterable[Frame], transcript: Optional[AudioTranscript] = None,
+                             on_complete: Optional[Callable[[Frame, Dict[str, Any]], None]] = None,
+                             on_token: Optional[Callable[[Frame, str], None]] = None
+                             ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """Analyze the frames, then reconstruct the video from them.
+
+        Returns the frame analyses in frame order and the video description.
+        """
+        analyzed_frames, frame_analyses = [], []
+        async for frame, analysis in self.aanalyze_frames(frames, on_complete, on_token):
+            analyzed_frames.append(frame)
+            frame_analyses.append(analysis)
+        return frame_analyses, await self.areconstruct_video(frame_analyses, analyzed_frames, transcript)
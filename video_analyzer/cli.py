@@ -6,7 +6,9 @@ import logging
 from pprint import pformat
 import shutil
 import sys
+import threading
 import time
+from collections.abc import Sized
 from typing import Optional
 import torch
 import torch.backends.mps
@@ -16,14 +18,18 @@ import pstats
 import io
 
 from .config import Config, get_client, get_config
-from .frame import VideoProcessor
+from .frame import VideoProcessor, FrameScorer
+from .frame_cache import FrameCache
 from .prompt import PromptLoader
 from .analyzer import VideoAnalyzer
+from .planner import RunPlanner, sample_frames, video_duration
 from .audio_processor import AudioProcessor, AudioTranscript
 from .clients.ollama import OllamaClient
 from .clients.generic_openai_api import GenericOpenAIAPIClient
 from .clients.google_api import GoogleAPIClient
 from .clients.mistral_api import MistralAPIClient
+from .clients.cached_client import CachedClient
+from .clients.transport import Transport
 
 # Initialize logger at module level
 logger = logging.getLogger(__name__)
@@ -75,6 +81,79 @@ def create_client(client_type, client_config):
     else:
         raise ValueError(f"Unknown client type: {client_type}")
 
+def get_response_cache(config: Config, client):
+    """Wrap the client in an LLM response cache if response_cache.path is configured."""
+    cache_path = config.get("response_cache", {}).get("path")
+    if not cache_path:
+        return client
+    return CachedClient(
+        client,
+        Path(cache_path),
+        max_size_mb=config.get("response_cache", {}).get("max_mb", 256),
+        max_age_days=config.get("response_cache", {}).get("max_age_days", 30)
+    )
+
+def create_analyzer(config: Config, client, model: str, prompt_loader: PromptLoader) -> VideoAnalyzer:
+    """Create the VideoAnalyzer with the analysis settings."""
+    analysis = config.get("analysis", {})
+    reconstruction = analysis.get("reconstruction", {})
+    adaptive = analysis.get("adaptive", {})
+    return VideoAnalyzer(
+        client,
+        model,
+        prompt_loader,
+        config.get("prompt", ""),
+        mosaic=analysis.get("mosaic", 1),
+        batch=analysis.get("batch", 1),
+        max_in_flight=analysis.get("max_in_flight", 1),
+        context_window=analysis.get("context_window", 0),
+        summary_interval=analysis.get("summary_interval", 0),
+        context_tokens=analysis.get("context_tokens", 0),
+        reconstruction=reconstruction.get("mode", "single"),
+        segment_seconds=reconstruction.get("segment_seconds", 300),
+        reconstruction_workers=reconstruction.get("max_workers", 4),
+        adaptive=adaptive.get("enabled", False),
+        redundant_similarity=adaptive.get("similarity", 0.8),
+        redundant_hash_distance=adaptive.get("hash_distance", 6),
+        max_stride=adaptive.get("max_stride", 8),
+        stream=analysis.get("stream", False),
+        prompt_cache=analysis.get("prompt_cache", False),
+        chat_session=analysis.get("chat_session", False)
+    )
+
+def plan_frames(config: Config, client, model: str, analyzer: VideoAnalyzer, video_path: Path,
+                frames, budget: Optional[float] = None):
+    """Project the tokens, cost and wall time of analyzing `frames`, first sampling them
+    down to fit `budget` dollars if given. Returns (plan, frames)."""
+    planner = RunPlanner(
+        client,
+        model,
+        analyzer,
+        request_latency=config.get("planner", {}).get("request_latency", 2.0),
+        tokens_per_second=config.get("planner", {}).get("tokens_per_second", 50.0),
+        transcript=config.get("audio", {}).get("whisper_model", "medium") != "none"
+    )
+    duration = video_duration(video_path, config.get("duration"))
+    frames = list(frames) # planning needs every frame, streamed ones included
+
+    if budget is not None:
+        max_frames = planner.fit_budget(frames, duration, budget)
+        if max_frames == 0:
+            cost = planner.estimate(frames[:1], duration).cost
+            raise ValueError(f"Budget ${budget} does not cover analyzing a single frame (${cost:.4f})")
+        if max_frames < len(frames):
+            logger.warning(f"Reducing frames from {len(frames)} to {max_frames} to fit the ${budget} budget")
+            frames = sample_frames(frames, max_frames)
+
+    return planner.estimate(frames, duration), frames
+
+def get_frame_cache(config: Config) -> Optional[FrameCache]:
+    """Create the keyframe extraction cache if frames.cache_dir is configured."""
+    cache_dir = config.get("frames", {}).get("cache_dir")
+    if not cache_dir:
+        return None
+    return FrameCache(Path(cache_dir), config.get("frames", {}).get("cache_max_mb", 1024))
+
 def main():
     parser = argparse.ArgumentParser(description="Analyze video using Vision models")
     parser.add_argument("video_path", type=str, help="Path to the video file")
@@ -97,6 +176,10 @@ def main():
                         help="Question to ask about the video")
     parser.add_argument("--language", type=str, default=None)
     parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--plan", action="store_true",
+                        help="Select frames and print the projected tokens, cost and time of analyzing them, without analyzing")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="Analyze fewer frames, sampled evenly, if the projected cost exceeds this many dollars")
     args = parser.parse_args()
 
     # Set up logging with specified level
@@ -124,17 +207,20 @@ def main():
 
     output_dir_str = config.get("output_dir")
     output_dir = Path(output_dir_str)
+    output_frames_dir = output_dir
 
     client_type, client_config = get_client_config(config)
-    client = create_client(client_type, client_config)
+    client = get_response_cache(config, create_client(client_type, client_config))
     
     model = client_config['model']
    
     prompt_loader = PromptLoader(config.get("prompt_dir"), config.get("prompts", []))
+    analyzer = create_analyzer(config, client, model, prompt_loader)
     
     try:
         transcript = None
         frames = []
+        analyzed_frames = []
         frame_analyses = []
         video_description = None
         total_video_time = time.perf_counter()
@@ -148,7 +234,9 @@ def main():
             audio_path = None
             whisper_model = config.get("audio", {}).get("whisper_model", "medium")
             
-            if whisper_model == 'none':
+            if args.plan:
+                logger.info("Planning run, no audio processing...")
+            elif whisper_model == 'none':
                 logger.info("No audio processing...")
             else:
                 logger.info(f"Initializing audio processing with whisper model {whisper_model}")
@@ -172,27 +260,56 @@ def main():
             
             logger.info(f"Extracting frames from video using model {model}...")
 
-            output_frames_dir = output_dir
             processor = VideoProcessor(
                 video_path, 
                 output_frames_dir, 
-                model
+                model,
+                seek_interval=config.get("frames", {}).get("seek_interval", VideoProcessor.SEEK_INTERVAL),
+                threshold=config.get("frames", {}).get("analysis_threshold", VideoProcessor.FRAME_DIFFERENCE_THRESHOLD),
+                score_size=config.get("frames", {}).get("score_size", FrameScorer.SCORE_SIZE),
+                workers=config.get("frames", {}).get("workers", 1),
+                decoder=config.get("frames", {}).get("decoder", "opencv"),
+                mode=config.get("frames", {}).get("mode", "sampled"),
+                scorer=config.get("frames", {}).get("scorer", "diff"),
+                persist=bool(config.get("keep_frames")),
+                cache=get_frame_cache(config)
             )
             
-            frames = processor.extract_keyframes(
-                frames_per_minute=config.get("frames", {}).get("per_minute", 60),
-                duration=config.get("duration"),
-                max_frames=args.max_frames
-            )
+            if config.get("frames", {}).get("stream", False):
+                # Frames are extracted in the background and analyzed as they become final
+                frames = processor.iter_keyframes(
+                    frames_per_minute=config.get("frames", {}).get("per_minute", 60),
+                    duration=config.get("duration"),
+                    max_frames=args.max_frames,
+                    window=config.get("frames", {}).get("stream_window", VideoProcessor.STREAM_WINDOW)
+                )
+            else:
+                frames = processor.extract_keyframes(
+                    frames_per_minute=config.get("frames", {}).get("per_minute", 60),
+                    duration=config.get("duration"),
+                    max_frames=args.max_frames
+                )
+
+            if args.plan or args.budget is not None:
+                plan, frames = plan_frames(config, client, model, analyzer, video_path, frames, args.budget)
+                if args.plan:
+                    output_dir.mkdir(parents=True, exist_ok=True)
+                    with open(output_dir / "plan.json", "w") as f:
+                        json.dump(plan.to_dict(), f, indent=2)
+                    print(f"Run plan for {video_path} with {model}:\n{plan.format()}")
+                    return
+                logger.info(f"Run plan:\n{plan.format()}")
             
         # Stage 2: Frame Analysis
         if args.start_stage <= 2:
             logger.info("Analyzing frames...")
-            analyzer = VideoAnalyzer(client, model, prompt_loader, config.get("prompt", ""))
+            # frames kept in memory (no --keep-frames) leave the output directory uncreated
+            output_dir.mkdir(parents=True, exist_ok=True)
             frame_analyses = []
             token_usage = {
                 'total_tokens'      : 0,
                 'prompt_tokens'     : 0,
+                'cached_prompt_tokens' : 0,
                 'completion_tokens' : 0,
                 'total_cost'        : 0,
                 'model_cost'        : False
@@ -200,37 +317,62 @@ def main():
 
             total_frame_time = 0
 
-            for frame in frames:
+            # streamed text not ending in a newline yet, per frame
+            partial_lines = {}
+            partial_lock = threading.Lock()
 
-                start_time = time.perf_counter()
-                analysis = analyzer.analyze_frame(frame)
-                end_time = time.perf_counter()
-                elapsed_time = end_time - start_time
-                analysis['time']  = elapsed_time
-                total_frame_time += elapsed_time
-                
-                frame_analyses.append(analysis)
+            def log_tokens(frame, text):
+                # log streamed responses line by line as they arrive, requests may run concurrently
+                with partial_lock:
+                    *lines, partial_lines[frame.number] = (partial_lines.get(frame.number, "") + text).split("\n")
+                for line in lines:
+                    if line.strip():
+                        logger.info(f"frame {frame.number} >> {line}")
 
-                output_frame_path = output_frames_dir / frame['name']
-                output_frame_json = output_frame_path.with_suffix(".json")
-                
+            def write_frame_json(frame, analysis):
+                # called as soon as each frame is analyzed, possibly out of order
+                with partial_lock:
+                    line = partial_lines.pop(frame.number, "")
+                if line.strip():
+                    logger.info(f"frame {frame.number} >> {line}")
+                output_frame_json = (output_frames_dir / frame.name).with_suffix(".json")
                 with open(output_frame_json, "w") as f:
                     json.dump(analysis, f, indent=2)
+                logging.info(f'frame json >> {output_frame_json}')
 
+            for frame, analysis in analyzer.analyze_frames(frames, on_complete=write_frame_json, on_token=log_tokens):
+                analyzed_frames.append(frame)
+                total_frame_time += analysis['time']
                 
-                logging.info(f'frame json >> {output_frame_json}')
-               
-                if 'token_usage' in analysis:
-                    token_usage['total_tokens'     ] += analysis['token_usage']['total_tokens']
-                    token_usage['prompt_tokens'    ] += analysis['token_usage']['prompt_tokens']
-                    token_usage['completion_tokens'] += analysis['token_usage']['completion_tokens']
-                    token_usage['total_cost'       ] += analysis['token_usage']['cost'  ]
+                frame_analyses.append(analysis)
+
+            # running summary requests of the previous frames context count as frame analysis
+            for response in frame_analyses + analyzer.context_summaries:
+                if 'token_usage' in response:
+                    token_usage['total_tokens'     ] += response['token_usage']['total_tokens']
+                    token_usage['prompt_tokens'    ] += response['token_usage']['prompt_tokens']
+                    token_usage['cached_prompt_tokens'] += response['token_usage'].get('cached_prompt_tokens', 0)
+                    token_usage['completion_tokens'] += response['token_usage']['completion_tokens']
+                    token_usage['total_cost'       ] += response['token_usage']['cost'  ]
+
+            streamed = [a['stream'] for a in frame_analyses if a.get('stream', {}).get('ttft') is not None]
+            if streamed:
+                rates = [s['tokens_per_second'] for s in streamed if s['tokens_per_second']]
+                logger.info(f"Streamed {len(streamed)} requests, mean time to first token "
+                            f"{sum(s['ttft'] for s in streamed) / len(streamed):.2f}s"
+                            + (f", {sum(rates) / len(rates):.1f} tokens/s" if rates else ""))
+
+            if not isinstance(frames, Sized):
+                # streamed frames were consumed by the analysis, the processor kept every one
+                frames = processor.frames
+            if analyzer.skipped_frames:
+                logger.info(f"Adaptive skipping left out {len(analyzer.skipped_frames)} redundant frames")
 
         # Stage 3: Video Reconstruction
         if args.start_stage <= 3:
             logger.info("Reconstructing video description...")
             video_description = analyzer.reconstruct_video(
-                frame_analyses, frames, transcript
+                frame_analyses, analyzed_frames, transcript
             )
         
         output_dir.mkdir(parents=True, exist_ok=True)
@@ -248,6 +390,8 @@ def main():
                 "duration_processed": config.get("duration"),
                 "frames_extracted": len(frames),
                 "frames_processed": min(len(frames), args.max_frames),
+                "frames_analyzed": len(analyzed_frames),
+                "frames_skipped": len(analyzer.skipped_frames),
                 "start_stage": args.start_stage,
                 "audio_language": transcript.language if transcript else None,
                 "transcription_successful": transcript is not None
@@ -276,6 +420,13 @@ def main():
         if video_description:
             video_desc = video_description.get("response", "No description generated")
             logger.info(f"Video Description: {video_desc}")
+
+        if isinstance(client, CachedClient):
+            logger.info(f"Response cache : {client.stats()}")
+
+        for endpoint, stats in Transport.all_stats().items():
+            logger.info(f"HTTP {endpoint} : {stats['requests']} requests, {stats['bytes_sent'] / 1e6:.2f}MB sent, "
+                        f"{stats['bytes_received'] / 1e6:.2f}MB received")
         
         if not config.get("keep_frames"):
             cleanup_files(output_dir)
@@ -0,0 +1,285 @@
+from pathlib import Path
+from typing import Optional, Dict, Any, Tuple, Sequence, Callable, Awaitable
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from .llm_client import LLMClient, ImageSource, TokenCallback
+
+logger = logging.getLogger(__name__)
+
+class CachedClient(LLMClient):
+    """Content-addressed cache of LLM responses wrapping another client.
+
+    Responses are keyed on the wrapped client type and endpoint, the model,
+    temperature, num_predict, the image policy and hashes of the prompt and image
+    bytes, and stored
+    in a SQLite database. Entries older than max_age_days are dropped and the
+    least recently used ones are evicted once the stored responses grow past
+    max_size_mb. Failed requests are not cached.
+
+    Cache hits are returned without 'token_usage', as no tokens were spent on them,
+    nor 'stream' metrics, and with 'cached' set.
+    """
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS responses ("
+        " key TEXT PRIMARY KEY,"
+        " response TEXT NOT NULL,"
+        " size INTEGER NOT NULL,"
+        " created REAL NOT NULL,"
+        " accessed REAL NOT NULL)"
+    )
+
+    def __init__(self, client: LLMClient, path: Path, max_size_mb: float = 256, max_age_days: float = 30):
+        self.client = client
+        self.path = Path(path).expanduser()
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 3600 if max_age_days else None
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # requests may come from several analysis threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(self.SCHEMA)
+        self._evict()
+
+    def __getattr__(self, name: str):
+        # client specific attributes, e.g. base_url, come from the wrapped client
+        if name == "client":
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+    def image_policy(self, model: Optional[str] = None) -> Dict[str, Any]:
+        return self.client.image_policy(model)
+
+    def prepare_image(self, image_path: Optional[str] = None, image_data: Optional[bytes] = None,
+                      model: Optional[str] = None) -> Tuple[str, str]:
+        return self.client.prepare_image(image_path, image_data, model)
+
+    def scaled_size(self, width: int, height: int, model: Optional[str] = None) -> Tuple[int, int]:
+        return self.client.scaled_size(width, height, model)
+
+    def estimate_image_tokens(self, width: int, height: int, model: Optional[str] = None) -> int:
+        return self.client.estimate_image_tokens(width, height, model)
+
+    def supports_batch(self) -> bool:
+        return self.client.supports_batch()
+
+    def pricing(self, model: Optional[str] = None) -> Optional[Dict[str, float]]:
+        return self.client.pricing(model)
+
+    def supports_chat(self) -> bool:
+        return self.client.supports_chat()
+
+    def cache_prompt_prefix(self, prefix: str, model: Optional[str] = None) -> bool:
+        return self.client.cache_prompt_prefix(prefix, model)
+
+    def key(self, prompt: str, images: Sequence[ImageSource], model: str, temperature: float, num_predict: int) -> str:
+        """Return the cache key of a request on `prompt` and `images`."""
+        image_hashes = []
+        for image in images:
+            if not isinstance(image, bytes):
+                with open(image, "rb") as image_file:
+                    image = image_file.read()
+            image_hashes.append(hashlib.sha256(image).hexdigest())
+        payload = json.dumps({
+            "client": type(self.client).__name__,
+            "endpoint": getattr(self.client, "base_url", None),
+            "model": model,
+            "temperature": temperature,
+            "num_predict": num_predict,
+            "image_policy": self.client.image_policy(model) if images else None,
+            "prompt": hashlib.sha256(prompt.encode()).hexdigest(),
+            "images": image_hashes,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _load(self, key: str) -> Optional[Dict[Any, Any]]:
+        with self._lock, self._db:
+            row = self._db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.max_age and row[1] < time.time() - self.max_age:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def _store(self, key: str, response: Dict[Any, Any]):
+        try:
+            value = json.dumps(response)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Not caching response that is not JSON serializable: {e}")
+            return
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now)
+            )
+        self._evict()
+
+    def _evict(self):
+        """Drop expired entries, then least recently used ones until the cache fits in max_size."""
+        with self._lock, self._db:
+            if self.max_age:
+                self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            total_size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total_size <= self.max_size:
+                return
+            evicted = []
+            for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                if total_size <= self.max_size:
+                    break
+                evicted.append((key,))
+                total_size -= size
+            self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+            logger.debug(f"Evicted {len(evicted)} cached responses")
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit and miss counts of this run and the current size of the cache."""
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "entries": entries,
+            "size_mb": size / (1024 * 1024),
+        }
+
+    def generate(self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        stream: bool = False,
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        images = [image_data if image_data is not None else image_path] if image_path or image_data is not None else []
+        return self._cached(
+            self.key(prompt, images, model, temperature, num_predict),
+            lambda: self.client.generate(prompt, image_path, stream, model, temperature, num_predict, image_data,
+                                         on_token),
+            on_token if stream else None
+        )
+
+    async def agenerate(self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        stream: bool = False,
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        images = [image_data if image_data is not None else image_path] if image_path or image_data is not None else []
+        return await self._acached(
+            self.key(prompt, images, model, temperature, num_predict),
+            lambda: self.client.agenerate(prompt, image_path, stream, model, temperature, num_predict, image_data,
+                                          on_token),
+            on_token if stream else None
+        )
+
+    def generate_batch(self,
+        prompt: str,
+        images: Sequence[ImageSource],
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256) -> Dict[Any, Any]:
+        return self._cached(
+            self.key(prompt, images, model, temperature, num_predict),
+            lambda: self.client.generate_batch(prompt, images, model, temperature, num_predict)
+        )
+
+    async def agenerate_batch(self,
+        prompt: str,
+        images: Sequence[ImageSource],
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256) -> Dict[Any, Any]:
+        return await self._acached(
+            self.key(prompt, images, model, temperature, num_predict),
+            lambda: self.client.agenerate_batch(prompt, images, model, temperature, num_predict)
+        )
+
+    def chat(self,
+        messages: Sequence[Dict[str, Any]],
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        stream: bool = False,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        return self._cached(
+            self._chat_key(messages, model, temperature, num_predict),
+            lambda: self.client.chat(messages, model, temperature, num_predict, stream, on_token),
+            on_token if stream else None
+        )
+
+    async def achat(self,
+        messages: Sequence[Dict[str, Any]],
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        stream: bool = False,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        return await self._acached(
+            self._chat_key(messages, model, temperature, num_predict),
+            lambda: self.client.achat(messages, model, temperature, num_predict, stream, on_token),
+            on_token if stream else None
+        )
+
+    def _chat_key(self, messages: Sequence[Dict[str, Any]], model: str, temperature: float, num_predict: int) -> str:
+        # the conversation text is the prompt, its images in order are the images
+        conversation = json.dumps([[m["role"], m["content"], len(m.get("images", []))] for m in messages])
+        images = [image for m in messages for image in m.get("images", [])]
+        return self.key(conversation, images, model, temperature, num_predict)
+
+    def _cached(self, key: str, request: Callable[[], Dict[Any, Any]],
+                on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        """Return the cached response for `key`, or make the request and cache its response.
+
+        A cached response to a streaming request is passed to on_token in one piece.
+        """
+        response = self._hit(key, on_token)
+        if response is not None:
+            return response
+        response = request()
+        self._store(key, response)
+        return response
+
+    async def _acached(self, key: str, request: Callable[[], Awaitable[Dict[Any, Any]]],
+                       on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        """_cached with a coroutine making the request."""
+        response = self._hit(key, on_token)
+        if response is not None:
+            return response
+        response = await request()
+        self._store(key, response)
+        return response
+
+    def _hit(self, key: str, on_token: Optional[TokenCallback] = None) -> Optional[Dict[Any, Any]]:
+        """The cached response for `key`, counting the hit or miss."""
+        response = self._load(key)
+        if response is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        logger.debug(f"Response cache hit : {key}")
+        response.pop("token_usage", None)
+        response.pop("stream", None)
+        response["cached"] = True
+        if on_token:
+            on_token(response["response"])
+        return response
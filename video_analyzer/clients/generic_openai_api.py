@@ -1,9 +1,13 @@
 import requests
+import asyncio
 import json
 import time
 import re
-from typing import Optional, Dict, Any, Tuple
-from .llm_client import LLMClient, TOKEN_PRICING
+import math
+from typing import Optional, Dict, Any, Tuple, Sequence
+from .llm_client import (LLMClient, TOKEN_PRICING, ImageSource, TokenCallback, StreamTimer, iter_sse, aiter_sse,
+                         token_usage)
+from .transport import Transport, AsyncTransport, TransportResponse
 import logging
 from pprint import pformat
 
@@ -15,13 +19,29 @@ RATE_LIMIT_WAIT_TIME = 25  # seconds
 DEFAULT_WAIT_TIME = 25  # seconds
 
 class GenericOpenAIAPIClient(LLMClient):
+    # OpenAI fits high detail images in 2048x2048 and then scales the short edge to 768
+    IMAGE_POLICY = {"max_edge": 2048, "short_edge": 768}
+
     def __init__(self, config, max_retries: int = DEFAULT_MAX_RETRIES):
         self.api_key = config['api_key']
+        self.image_config = config.get('image') or {}
         api_url = config['api_url']
         self.base_url = api_url.rstrip('/')  # Remove trailing slash if present
         self.generate_url = f"{self.base_url}/chat/completions"
         self.max_retries = max_retries
         self.usage = {}
+        self.transport = Transport.for_url(self.base_url, config.get('http'))
+        self.async_transport = AsyncTransport.for_url(self.base_url, config.get('http'))
+
+    def estimate_image_tokens(self, width: int, height: int, model: Optional[str] = None) -> int:
+        """85 tokens at low detail, otherwise 85 plus 170 per 512px tile of the image
+        fitted in 2048x2048 with its short edge scaled to 768."""
+        if self.image_policy(model)["detail"] == "low":
+            return 85
+        width, height = self.scaled_size(width, height, model)
+        scale = min(1.0, 2048 / max(width, height), 768 / min(width, height))
+        tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+        return 85 + 170 * tiles
 
     def generate(self,
         prompt: str,
@@ -29,19 +49,59 @@ class GenericOpenAIAPIClient(LLMClient):
         stream: bool = False,
         model: str = "gpt-4o",
         temperature: float = 0.2,
-        num_predict: int = 256) -> Dict[Any, Any]:
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
         """Generate response from OpenAI-compatible API."""
+        images = [image_data if image_data is not None else image_path] if image_path or image_data is not None else []
+        return self._generate(prompt, images, stream, model, temperature, num_predict, on_token)
 
+    async def agenerate(self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        stream: bool = False,
+        model: str = "gpt-4o",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        """Generate response from OpenAI-compatible API on the running event loop."""
+        images = [image_data if image_data is not None else image_path] if image_path or image_data is not None else []
+        return await self._agenerate(prompt, images, stream, model, temperature, num_predict, on_token)
+
+    def generate_batch(self,
+        prompt: str,
+        images: Sequence[ImageSource],
+        model: str = "gpt-4o",
+        temperature: float = 0.2,
+        num_predict: int = 256) -> Dict[Any, Any]:
+        """Generate response from OpenAI-compatible API about several images in one message."""
+        return self._generate(prompt, images, False, model, temperature, num_predict)
+
+    async def agenerate_batch(self,
+        prompt: str,
+        images: Sequence[ImageSource],
+        model: str = "gpt-4o",
+        temperature: float = 0.2,
+        num_predict: int = 256) -> Dict[Any, Any]:
+        """generate_batch on the running event loop."""
+        return await self._agenerate(prompt, images, False, model, temperature, num_predict)
+
+    def _request(self, prompt: str, images: Sequence[ImageSource], stream: bool, model: str,
+                 temperature: float, num_predict: int) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """Data and headers of a chat completion request."""
         # Prepare request content
-        if image_path:
-            base64_image = self.encode_image(image_path)
-            content = [
-                {"type": "text", "text": prompt},
-                {
+        if images:
+            detail = self.image_policy(model)["detail"]
+            content = [{"type": "text", "text": prompt}]
+            for base64_image, mime_type in self.prepare_images(images, model):
+                image_url = {"url": f"data:{mime_type};base64,{base64_image}"}
+                if detail:
+                    image_url["detail"] = detail
+                content.append({
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}
-                }
-            ]
+                    "image_url": image_url
+                })
         else:
             content = prompt
 
@@ -53,6 +113,9 @@ class GenericOpenAIAPIClient(LLMClient):
             "temperature": temperature,
             "max_tokens": num_predict
         }
+        if stream:
+            # the last event before [DONE] then carries the token usage
+            data["stream_options"] = {"include_usage": True}
 
         # Prepare headers
         headers = {
@@ -61,106 +124,149 @@ class GenericOpenAIAPIClient(LLMClient):
             "X-Title": "Video Analyzer",
             "Content-Type": "application/json"
         }
+        return data, headers
+
+    def _generate(self, prompt: str, images: Sequence[ImageSource], stream: bool, model: str,
+                  temperature: float, num_predict: int, on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        data, headers = self._request(prompt, images, stream, model, temperature, num_predict)
 
         # Try request with retries
         for attempt in range(self.max_retries):
             try:
-                response = requests.post(self.generate_url, headers=headers, json=data)
+                timer = StreamTimer(on_token)
+                response = self.transport.post(self.generate_url, data, headers=headers, stream=stream)
                 response.raise_for_status()
-                
-                # Parse successful response
-                try:
-                    json_response = response.json()
-                    if 'error' in json_response:
-                        raise Exception(f"API error: {json_response['error']}")
-                    
-                    if stream:
-                        return self._handle_streaming_response(response)
-                    
-                    if 'choices' not in json_response or not json_response['choices']:
-                        raise Exception("No choices in response")
-                        
-                    message = json_response['choices'][0].get('message', {})
-                    if not message or 'content' not in message:
-                        raise Exception("No content in response message")
-                    
-                    logger.info(f'>> {message}')
-
-                    # Extract token usage information
-                    usage = json_response.get('usage', {})
-                    prompt_tokens = usage.get('prompt_tokens', 0)
-                    completion_tokens = usage.get('completion_tokens', 0)
-                    total_tokens = usage.get('total_tokens', 0)
-
-                    # Calculate cost
-                    model_pricing = TOKEN_PRICING.get(model, {"prompt": 0.0, "completion": 0.0})
-
-                    cost = ((prompt_tokens * model_pricing["prompt"]) + (completion_tokens * model_pricing["completion"])) / 1000
-
-                    logger.info(f"Token Usage - Prompt: {prompt_tokens}, Completion: {completion_tokens}, Total: {total_tokens}")
-                    logger.info(f"Estimated Cost: ${cost:.6f}")
-
-                    return {
-                        "response": message['content'],
-                        "token_usage": {
-                            "prompt_tokens": prompt_tokens,
-                            "completion_tokens": completion_tokens,
-                            "total_tokens": total_tokens,
-                            "model_pricing": model_pricing,
-                            "cost": cost
-                        }
-                    }
-                    
-                except json.JSONDecodeError:
-                    raise Exception(f"Invalid JSON response: {response.text}")
+
+                if stream:
+                    return self._handle_streaming_response(response, model, timer)
+                return self._handle_response(response, model)
             
             except requests.exceptions.HTTPError as e:
-                try:
-                    json_data = json.loads(response.text)
-                    err_msg = f'HTTPError {response.status_code} : {pformat(json_data,indent=4)}'
-                except json.JSONDecodeError: # Fallback if the response isn't valid JSON
-                    err_msg = f'HTTPError {response.status_code} : {response.text}'
-                    
-                logger.error(err_msg)
-
-                if 'Retry-After' in e.response.headers and attempt < self.max_retries:
-
-                    try:
-                        wait_time = int(e.response.headers['Retry-After'])
-                        logger.info(f"Using Retry-After header value: {wait_time} seconds")
-                    except (ValueError, TypeError):
-                        wait_time = RATE_LIMIT_WAIT_TIME
-                        logger.warning("Invalid Retry-After header value, using default wait time")
-
-                    logger.warning(f"Request failed (attempt {attempt + 1}/{self.max_retries}): {str(e)}")
-                    logger.warning(f"Waiting {wait_time} seconds before retry")
-                    time.sleep(wait_time)
-                else:
-                    raise Exception(err_msg)
+                time.sleep(self._retry_wait(e, attempt))
+
+            except Exception as e:
+                raise Exception(f"An error occurred: {str(e)}")
+
+    async def _agenerate(self, prompt: str, images: Sequence[ImageSource], stream: bool, model: str,
+                         temperature: float, num_predict: int, on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        # images are resized off the event loop
+        data, headers = await self._in_executor(self._request, prompt, images, stream, model, temperature, num_predict)
+
+        # Try request with retries
+        for attempt in range(self.max_retries):
+            try:
+                timer = StreamTimer(on_token)
+                response = await self.async_transport.apost(self.generate_url, data, headers=headers, stream=stream)
+                response.raise_for_status()
+
+                if stream:
+                    usage = None
+                    async for event in aiter_sse(response):
+                        usage = self._stream_event(event, timer) or usage
+                    return self._stream_result(timer, usage, model)
+                return self._handle_response(response, model)
+
+            except requests.exceptions.HTTPError as e:
+                await asyncio.sleep(self._retry_wait(e, attempt))
 
             except Exception as e:
                 raise Exception(f"An error occurred: {str(e)}")
+
+    def _handle_response(self, response: TransportResponse, model: str) -> Dict[Any, Any]:
+        """Parse a successful, non streamed, response."""
+        try:
+            json_response = response.json()
+            if 'error' in json_response:
+                raise Exception(f"API error: {json_response['error']}")
+            
+            if 'choices' not in json_response or not json_response['choices']:
+                raise Exception("No choices in response")
                 
+            message = json_response['choices'][0].get('message', {})
+            if not message or 'content' not in message:
+                raise Exception("No content in response message")
+            
+            logger.info(f'>> {message}')
+
+            # Extract token usage information
+            usage = self._token_usage(json_response.get('usage', {}), model)
 
-    def _handle_streaming_response(self, response: requests.Response) -> Dict[Any, Any]:
+            logger.info(f"Token Usage - Prompt: {usage['prompt_tokens']} ({usage['cached_prompt_tokens']} cached), "
+                        f"Completion: {usage['completion_tokens']}, Total: {usage['total_tokens']}")
+            logger.info(f"Estimated Cost: ${usage['cost']:.6f}")
+
+            return {
+                "response": message['content'],
+                "token_usage": usage
+            }
+            
+        except json.JSONDecodeError:
+            raise Exception(f"Invalid JSON response: {response.text}")
+
+    def _retry_wait(self, e: requests.exceptions.HTTPError, attempt: int) -> float:
+        """Seconds to wait before retrying a request that failed with `e`, raises when it
+        is not retried."""
+        response = e.response
+        try:
+            json_data = json.loads(response.text)
+            err_msg = f'HTTPError {response.status_code} : {pformat(json_data,indent=4)}'
+        except json.JSONDecodeError: # Fallback if the response isn't valid JSON
+            err_msg = f'HTTPError {response.status_code} : {response.text}'
+            
+        logger.error(err_msg)
+
+        if 'Retry-After' in response.headers and attempt < self.max_retries:
+
+            try:
+                wait_time = int(response.headers['Retry-After'])
+                logger.info(f"Using Retry-After header value: {wait_time} seconds")
+            except (ValueError, TypeError):
+                wait_time = RATE_LIMIT_WAIT_TIME
+                logger.warning("Invalid Retry-After header value, using default wait time")
+
+            logger.warning(f"Request failed (attempt {attempt + 1}/{self.max_retries}): {str(e)}")
+            logger.warning(f"Waiting {wait_time} seconds before retry")
+            return wait_time
+        raise Exception(err_msg)
+
+    def _handle_streaming_response(self, response: TransportResponse, model: str, timer: StreamTimer) -> Dict[Any, Any]:
         """Handle streaming response from API.
         
         Args:
-            response: Streaming response from API
+            response: Server-sent events response from API
+            model: Model the usage is priced for
+            timer: Timer started when the request was sent
             
         Returns:
-            Dict containing accumulated response
+            Dict containing accumulated response, token usage and stream metrics
         """
-        accumulated_response = ""
-        for line in response.iter_lines():
-            if line:
-                try:
-                    json_response = json.loads(line.decode('utf-8'))
-                    if 'choices' in json_response and len(json_response['choices']) > 0:
-                        delta = json_response['choices'][0].get('delta', {})
-                        if 'content' in delta:
-                            accumulated_response += delta['content']
-                except json.JSONDecodeError:
-                    continue
-
-        return {"response": accumulated_response}
+        usage = None
+        for event in iter_sse(response):
+            usage = self._stream_event(event, timer) or usage
+        return self._stream_result(timer, usage, model)
+
+    @staticmethod
+    def _stream_event(event: Dict[str, Any], timer: StreamTimer) -> Optional[Dict[str, Any]]:
+        """Add the content delta of a chat completion event to `timer`, returns its usage if any."""
+        if 'error' in event:
+            raise Exception(f"API error: {event['error']}")
+        if event.get('choices'):
+            timer.add(event['choices'][0].get('delta', {}).get('content'))
+        return event.get('usage') or None
+
+    def _stream_result(self, timer: StreamTimer, usage: Optional[Dict[str, Any]], model: str) -> Dict[Any, Any]:
+        result = {"response": timer.text}
+        if usage:
+            result["token_usage"] = self._token_usage(usage, model)
+        result["stream"] = timer.metrics(usage.get('completion_tokens') if usage else None)
+        logger.info(f"Streamed {result['stream']['completion_tokens']} tokens, "
+                    f"time to first token {result['stream']['ttft']}s")
+        return result
+
+    @staticmethod
+    def _token_usage(usage: Dict[str, Any], model: str) -> Dict[str, Any]:
+        """token_usage of an API usage object. Prompts of 1024 tokens or more are
+        prefix cached automatically, the cached part is in prompt_tokens_details."""
+        details = usage.get('prompt_tokens_details') or {}
+        return token_usage(model, usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0),
+                           usage.get('total_tokens'), details.get('cached_tokens') or 0)
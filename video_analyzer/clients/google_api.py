@@ -1,10 +1,15 @@
 import requests
 from requests.exceptions import RequestException
+import asyncio
 import json
+import threading
 import time
 import re
-from typing import Optional, Dict, Any, Tuple
-from .llm_client import LLMClient, TOKEN_PRICING
+import math
+from typing import Optional, Dict, Any, Tuple, Sequence
+from .llm_client import (LLMClient, TOKEN_PRICING, ImageSource, TokenCallback, StreamTimer, iter_sse, aiter_sse,
+                         token_usage)
+from .transport import Transport, AsyncTransport, TransportResponse
 import logging
 from pprint import pformat
 
@@ -26,13 +31,85 @@ curl "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:g
    }'
 '''
 class GoogleAPIClient(LLMClient):
+    # Gemini bills 258 tokens per 768x768 tile, set "max_edge"/"tile" to 768 to cap it
+    IMAGE_POLICY = {}
+
     def __init__(self, config, max_retries: int = DEFAULT_MAX_RETRIES):
         self.api_key = config['api_key']
+        self.image_config = config.get('image') or {}
         api_url = config['api_url']
         self.base_url = api_url.rstrip('/')  # Remove trailing slash if present
         self.generate_url = f"{self.base_url}/models/%model%/:generateContent"
+        self.stream_url = f"{self.base_url}/models/%model%/:streamGenerateContent"
+        self.cached_contents_url = f"{self.base_url}/cachedContents"
         self.max_retries = max_retries
         self.usage = {}
+        self.transport = Transport.for_url(self.base_url, config.get('http'))
+        self.async_transport = AsyncTransport.for_url(self.base_url, config.get('http'))
+        # explicit context caching of prompt prefixes, billed for storage per hour of ttl
+        context_cache = config.get('context_cache') or {}
+        self.context_cache = context_cache.get('enabled', False)
+        self.context_cache_ttl = context_cache.get('ttl', 3600)
+        self._cached_contents: Dict[Tuple[str, str], Optional[Tuple[str, float]]] = {} # (model, prefix) -> (name, expiry)
+        self._cached_contents_lock = threading.Lock()
+
+    def estimate_image_tokens(self, width: int, height: int, model: Optional[str] = None) -> int:
+        """258 tokens for images up to 384x384, otherwise 258 per 768x768 tile."""
+        width, height = self.scaled_size(width, height, model)
+        if width <= 384 and height <= 384:
+            return 258
+        return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+
+    def cache_prompt_prefix(self, prefix: str, model: Optional[str] = None) -> bool:
+        """Store `prefix` as a Gemini cachedContents entry, which prompts for `model`
+        starting with it then refer to instead of resending it.
+
+        Needs context_cache enabled in the client config. Gemini only caches contents
+        of a minimum size (some thousand tokens depending on the model); when the
+        entry can not be created, prompts are sent whole.
+        """
+        if not self.context_cache:
+            return False
+        with self._cached_contents_lock:
+            key = (model, prefix)
+            if key in self._cached_contents:
+                entry = self._cached_contents[key]
+                # refresh a minute before the entry expires
+                if entry is None or entry[1] > time.time() + 60:
+                    return entry is not None
+
+            data = {
+                "model": f"models/{model}",
+                "contents": [{"role": "user", "parts": [{"text": prefix}]}],
+                "ttl": f"{self.context_cache_ttl}s"
+            }
+            try:
+                response = self.transport.post(self.cached_contents_url, data, params={"key": self.api_key})
+                response.raise_for_status()
+                name = response.json()["name"]
+            except (RequestException, KeyError, ValueError) as e:
+                details = e.response.text if getattr(e, "response", None) is not None else str(e)
+                logger.warning(f"Could not cache the prompt prefix, sending whole prompts: {details}")
+                self._cached_contents[key] = None
+                return False
+
+            logger.info(f"Cached {len(prefix)} characters of prompt prefix as {name}")
+            self._cached_contents[key] = (name, time.time() + self.context_cache_ttl)
+            return True
+
+    def _cached_prefix(self, prompt: str, model: str) -> Optional[Tuple[str, str]]:
+        """(cachedContents name, prefix) of the cached prefix `prompt` starts with, if any."""
+        with self._cached_contents_lock:
+            matches = [(m, prefix) for (m, prefix), entry in self._cached_contents.items()
+                       if entry is not None and m == model and prompt.startswith(prefix)]
+        if not matches:
+            return None
+        _, prefix = max(matches, key=lambda match: len(match[1]))
+        if not self.cache_prompt_prefix(prefix, model): # refreshes an expiring entry
+            return None
+        with self._cached_contents_lock:
+            entry = self._cached_contents.get((model, prefix))
+        return (entry[0], prefix) if entry else None
 
     def generate(self,
         prompt: str,
@@ -40,44 +117,85 @@ class GoogleAPIClient(LLMClient):
         stream: bool = False,
         model: str = "gemini-2.0-flash",
         temperature: float = 0.2,
-        num_predict: int = 256) -> Dict[Any, Any]:
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
         """Generate response from OpenAI-compatible API."""
+        images = [image_data if image_data is not None else image_path] if image_path or image_data is not None else []
+        return self._generate(prompt, images, stream, model, temperature, num_predict, on_token)
+
+    async def agenerate(self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        stream: bool = False,
+        model: str = "gemini-2.0-flash",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        """Generate response from Gemini API on the running event loop."""
+        images = [image_data if image_data is not None else image_path] if image_path or image_data is not None else []
+        return await self._agenerate(prompt, images, stream, model, temperature, num_predict, on_token)
+
+    def generate_batch(self,
+        prompt: str,
+        images: Sequence[ImageSource],
+        model: str = "gemini-2.0-flash",
+        temperature: float = 0.2,
+        num_predict: int = 256) -> Dict[Any, Any]:
+        """Generate response from Gemini API about several images in one request."""
+        return self._generate(prompt, images, False, model, temperature, num_predict)
+
+    async def agenerate_batch(self,
+        prompt: str,
+        images: Sequence[ImageSource],
+        model: str = "gemini-2.0-flash",
+        temperature: float = 0.2,
+        num_predict: int = 256) -> Dict[Any, Any]:
+        """generate_batch on the running event loop."""
+        return await self._agenerate(prompt, images, False, model, temperature, num_predict)
 
-        generate_url = self.generate_url.replace('%model%', model)
+    def _request(self, prompt: str, images: Sequence[ImageSource], stream: bool,
+                 model: str) -> Tuple[str, Dict[str, Any], Dict[str, str]]:
+        """URL, data and query parameters of a generateContent request."""
+        generate_url = (self.stream_url if stream else self.generate_url).replace('%model%', model)
  
+        cached_prefix = self._cached_prefix(prompt, model) if self.context_cache else None
+        if cached_prefix:
+            # the cached content holds the start of the prompt
+            prompt = prompt[len(cached_prefix[1]):]
+
         # Prepare the request data
-        if image_path:
-            base64_image = self.encode_image(image_path)
-            data = {
-                "contents": [
-                    {
-                        "parts": [
-                            {"text": prompt},
-                            {
-                                "inline_data": {
-                                    "mime_type": "image/jpeg",
-                                    "data": base64_image
-                                }
-                            }
-                        ]
-                    }
-                ]
-            }
-        else:
-            data = {
-                "contents": [
-                    {
-                        "parts": [
-                            {"text": prompt}
-                        ]
-                    }
-                ]
-            }
+        parts = [{"text": prompt}]
+        for base64_image, mime_type in self.prepare_images(images, model):
+            parts.append({
+                "inline_data": {
+                    "mime_type": mime_type,
+                    "data": base64_image
+                }
+            })
+        data = {
+            "contents": [
+                {
+                    "role": "user",
+                    "parts": parts
+                }
+            ]
+        }
+        if cached_prefix:
+            data["cachedContent"] = cached_prefix[0]
 
         # Add any additional parameters
         params = {
             "key": self.api_key
         }
+        if stream:
+            params["alt"] = "sse"
+        return generate_url, data, params
+
+    def _generate(self, prompt: str, images: Sequence[ImageSource], stream: bool, model: str,
+                  temperature: float, num_predict: int, on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        generate_url, data, params = self._request(prompt, images, stream, model)
     
         # Initialize retry parameters
         retries = 0
@@ -86,108 +204,20 @@ class GoogleAPIClient(LLMClient):
         while retries <= self.max_retries:
             try:
                 # Make the API request
-                response = requests.post(generate_url, params=params, json=data)
+                timer = StreamTimer(on_token)
+                response = self.transport.post(generate_url, data, params=params, stream=stream)
     
                 # Check if successful
+                if response.status_code == 200 and stream:
+                    return self._handle_streaming_response(response, model, timer)
+
                 if response.status_code == 200:
-                    json_response = response.json()
-                    try:
-                        '''
-                        "candidates": [
-                            {
-                            "content": {
-                                "parts": [
-                                {
-                                    "text": "```\nFrame 24\nAction/Movement: ... Observe the construction site\n```"
-                                }
-                                ],
-                                "role": "model"
-                            },
-                            "finishReason": "STOP",
-                            "avgLogprobs": -0.6573867797851562
-                            }
-                        ],
-                        '''
-                        message = json_response["candidates"][0]["content"]["parts"][0]["text"]
-
-                    except Exception as e:
-                        logger.error(f'json_response parse Error : {str(e)}')
-
-                    if not message :
-                        raise Exception(f"No content in response message {json_response}")
-                        
-                    logger.info(f'>> {message}')
-
-                    # Extract token usage information
-                    '''
-                    "usageMetadata": {
-                        "promptTokenCount": 2153,
-                        "candidatesTokenCount": 143,
-                        "totalTokenCount": 2296,
-                        "promptTokensDetails": [
-                            {
-                                "modality": "TEXT",
-                                "tokenCount": 347
-                            },
-                            {
-                                "modality": "IMAGE",
-                                "tokenCount": 1806
-                            }
-                        ],
-                        "candidatesTokensDetails": [
-                            {
-                                "modality": "TEXT",
-                                "tokenCount": 143
-                            }
-                        ]
-                    }
-                    '''
-                    # Calculate tokens
-                    prompt_tokens     = json_response["usageMetadata"]["promptTokenCount"    ] 
-                    completion_tokens = json_response["usageMetadata"]["candidatesTokenCount"] 
-                    total_tokens      = json_response["usageMetadata"]["totalTokenCount"     ] 
-
-                    # Calculate cost
-                    model_pricing = TOKEN_PRICING.get(model, {"prompt": 0.0, "completion": 0.0})
-
-                    cost = ((prompt_tokens * model_pricing["prompt"]) + (completion_tokens * model_pricing["completion"])) / 1000
-
-                    logger.info(f"Token Usage - Prompt: {prompt_tokens}, Completion: {completion_tokens}, Total: {total_tokens}")
-                    logger.info(f"Estimated Cost: ${cost:.6f}")
-
-                    return {
-                        "response": message,
-                        "token_usage": {
-                            "prompt_tokens": prompt_tokens,
-                            "completion_tokens": completion_tokens,
-                            "total_tokens": total_tokens,
-                            "model_pricing": model_pricing,
-                            "cost": cost
-                        }
-                    }
-  
-                # Handle rate limiting
-                if response.status_code == 429 or response.status_code == 503:
-                    # Get retry-after header if available
-                    retry_after = None
-                    if 'retry-after' in response.headers:
-                        retry_after = int(response.headers['retry-after'])
-                        logger.info(f"Using Retry-After header value: {retry_after} seconds")
-
-                    # Use retry-after value or exponential backoff
-                    wait_time = retry_after if retry_after else backoff_time
-                    
-                    if retries < self.max_retries:
-                        logger.info(f"Rate limit hit. Retrying in {wait_time} seconds. (Attempt {retries+1}/{self.max_retries})")
-                        time.sleep(wait_time)
-                        retries += 1
-                        backoff_time *= 2  # Exponential backoff
-                    else:
-                        logger.error(f"Max retries ({self.max_retries}) exceeded")
-                        raise Exception(f"Max retries exceeded. Last status: {response.status_code}")
-                else:
-                    # If it's another error, raise immediately
-                    raise Exception(f"API request failed with status code {response.status_code}: {response.text}")
+                    return self._handle_response(response, model)
+
+                wait_time = self._rate_limit_wait(response, retries, backoff_time)
+                time.sleep(wait_time)
+                retries += 1
+                backoff_time *= 2  # Exponential backoff
                 
             except RequestException as e:
                 # Handle network errors
@@ -199,3 +229,163 @@ class GoogleAPIClient(LLMClient):
                 else:
                     logger.error(f"Max retries ({self.max_retries}) exceeded")
                     raise
+
+    async def _agenerate(self, prompt: str, images: Sequence[ImageSource], stream: bool, model: str,
+                         temperature: float, num_predict: int, on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        # images are resized, and the prompt prefix cache looked up, off the event loop
+        generate_url, data, params = await self._in_executor(self._request, prompt, images, stream, model)
+
+        retries = 0
+        backoff_time = 2
+
+        while retries <= self.max_retries:
+            try:
+                timer = StreamTimer(on_token)
+                response = await self.async_transport.apost(generate_url, data, params=params, stream=stream)
+
+                if response.status_code == 200 and stream:
+                    usage = None
+                    async for event in aiter_sse(response):
+                        usage = self._stream_event(event, timer) or usage
+                    return self._stream_result(timer, usage, model)
+
+                if response.status_code == 200:
+                    return self._handle_response(response, model)
+
+                wait_time = self._rate_limit_wait(response, retries, backoff_time)
+                await asyncio.sleep(wait_time)
+                retries += 1
+                backoff_time *= 2
+
+            except RequestException as e:
+                if retries < self.max_retries:
+                    logger.info(f"Network error: {str(e)}. Retrying in {backoff_time} seconds.")
+                    await asyncio.sleep(backoff_time)
+                    retries += 1
+                    backoff_time *= 2
+                else:
+                    logger.error(f"Max retries ({self.max_retries}) exceeded")
+                    raise
+
+    def _handle_response(self, response: TransportResponse, model: str) -> Dict[Any, Any]:
+        """Parse a successful, non streamed, response."""
+        json_response = response.json()
+        message = None
+        try:
+            '''
+            "candidates": [
+                {
+                "content": {
+                    "parts": [
+                    {
+                        "text": "```\nFrame 24\nAction/Movement: ... Observe the construction site\n```"
+                    }
+                    ],
+                    "role": "model"
+                },
+                "finishReason": "STOP",
+                "avgLogprobs": -0.6573867797851562
+                }
+            ],
+            '''
+            message = json_response["candidates"][0]["content"]["parts"][0]["text"]
+
+        except Exception as e:
+            logger.error(f'json_response parse Error : {str(e)}')
+
+        if not message :
+            raise Exception(f"No content in response message {json_response}")
+            
+        logger.info(f'>> {message}')
+
+        # Extract token usage information
+        '''
+        "usageMetadata": {
+            "promptTokenCount": 2153,
+            "candidatesTokenCount": 143,
+            "totalTokenCount": 2296,
+            "promptTokensDetails": [
+                {
+                    "modality": "TEXT",
+                    "tokenCount": 347
+                },
+                {
+                    "modality": "IMAGE",
+                    "tokenCount": 1806
+                }
+            ],
+            "candidatesTokensDetails": [
+                {
+                    "modality": "TEXT",
+                    "tokenCount": 143
+                }
+            ]
+        }
+        '''
+        # Calculate tokens, promptTokenCount includes cachedContentTokenCount
+        usage = self._token_usage(json_response["usageMetadata"], model)
+
+        logger.info(f"Token Usage - Prompt: {usage['prompt_tokens']} ({usage['cached_prompt_tokens']} cached), "
+                    f"Completion: {usage['completion_tokens']}, Total: {usage['total_tokens']}")
+        logger.info(f"Estimated Cost: ${usage['cost']:.6f}")
+
+        return {
+            "response": message,
+            "token_usage": usage
+        }
+
+    def _rate_limit_wait(self, response: TransportResponse, retries: int, backoff_time: float) -> float:
+        """Seconds to wait before retrying a failed request, raises when it is not retried."""
+        # Handle rate limiting
+        if response.status_code == 429 or response.status_code == 503:
+            # Get retry-after header if available
+            retry_after = None
+            if 'retry-after' in response.headers:
+                retry_after = int(response.headers['retry-after'])
+                logger.info(f"Using Retry-After header value: {retry_after} seconds")
+
+            # Use retry-after value or exponential backoff
+            wait_time = retry_after if retry_after else backoff_time
+            
+            if retries < self.max_retries:
+                logger.info(f"Rate limit hit. Retrying in {wait_time} seconds. (Attempt {retries+1}/{self.max_retries})")
+                return wait_time
+            logger.error(f"Max retries ({self.max_retries}) exceeded")
+            raise Exception(f"Max retries exceeded. Last status: {response.status_code}")
+        # If it's another error, raise immediately
+        raise Exception(f"API request failed with status code {response.status_code}: {response.text}")
+
+    def _handle_streaming_response(self, response: TransportResponse, model: str, timer: StreamTimer) -> Dict[Any, Any]:
+        """Accumulate the candidate text of streamGenerateContent events, each event
+        carries the usage metadata so far."""
+        usage = None
+        for event in iter_sse(response):
+            usage = self._stream_event(event, timer) or usage
+        return self._stream_result(timer, usage, model)
+
+    @staticmethod
+    def _stream_event(event: Dict[str, Any], timer: StreamTimer) -> Optional[Dict[str, Any]]:
+        if 'error' in event:
+            raise Exception(f"API error: {event['error']}")
+        for candidate in event.get('candidates', [])[:1]:
+            for part in candidate.get('content', {}).get('parts', []):
+                timer.add(part.get('text'))
+        return event.get('usageMetadata')
+
+    def _stream_result(self, timer: StreamTimer, usage: Optional[Dict[str, Any]], model: str) -> Dict[Any, Any]:
+        if not timer.text:
+            raise Exception("No content in streamed response")
+
+        result = {"response": timer.text}
+        if usage:
+            result["token_usage"] = self._token_usage(usage, model)
+        result["stream"] = timer.metrics(usage.get('candidatesTokenCount') if usage else None)
+        logger.info(f"Streamed {result['stream']['completion_tokens']} tokens, "
+                    f"time to first token {result['stream']['ttft']}s")
+        return result
+
+    @staticmethod
+    def _token_usage(usage: Dict[str, Any], model: str) -> Dict[str, Any]:
+        """token_usage of a usageMetadata object."""
+        return token_usage(model, usage.get('promptTokenCount', 0), usage.get('candidatesTokenCount', 0),
+                           usage.get('totalTokenCount'), usage.get('cachedContentTokenCount', 0))
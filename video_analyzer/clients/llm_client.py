@@ -1,14 +1,23 @@
 from abc import ABC, abstractmethod
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple, List, Sequence, Union, Callable, Iterator, AsyncIterator
+from pathlib import Path
+import asyncio
 import base64
+import functools
+import json
+import logging
+import math
+import time
+import cv2
+import numpy as np
 
-TOKEN_PRICING = {  # (per 1K tokens)
+TOKEN_PRICING = {  # (per 1K tokens), "cached_prompt" for prompt tokens read from the provider's prefix cache
     "llama3.2-vision"       : {"prompt": 0.005      , "completion": 0.015  },  
     # OpenAI
     "gpt-4-turbo"           : {"prompt": 0.010      , "completion": 0.03   },
-    "gpt-4o"                : {"prompt": 0.0025     , "completion": 0.01   }, 
+    "gpt-4o"                : {"prompt": 0.0025     , "completion": 0.01   , "cached_prompt": 0.00125  }, 
     # Google 
-    "gemini-2.0-flash"      : {"prompt": 0.0001     , "completion": 0.0004 },  
+    "gemini-2.0-flash"      : {"prompt": 0.0001     , "completion": 0.0004 , "cached_prompt": 0.000025 },  
     "gemini-2.0-flash-lite" : {"prompt": 0.000075   , "completion": 0.03   },  
     "gemini-1.5-flash"      : {"prompt": 0.000075   , "completion": 0.03   }, 
     "gemini-1.5-flash-8b"   : {"prompt": 0.0000375  , "completion": 0.015  }, 
@@ -17,12 +26,230 @@ TOKEN_PRICING = {  # (per 1K tokens)
     "pixtral-12b-2409"      : {"prompt": 0.00015    , "completion": 0.00015},
 }
 
+IMAGE_MIME_TYPES = {
+    "jpeg" : "image/jpeg",
+    "webp" : "image/webp",
+    "png"  : "image/png",
+}
+
+# an image given as encoded bytes or as the path of an image file
+ImageSource = Union[bytes, str, Path]
+
+# called with each piece of text of a streamed response as it arrives
+TokenCallback = Callable[[str], None]
+
+logger = logging.getLogger(__name__)
+
+class StreamTimer:
+    """Collect the text of a streamed response and time it.
+
+    Created just before the request is sent; add() is called with each piece of
+    text as it arrives and passes it on to on_token.
+    """
+    def __init__(self, on_token: Optional[TokenCallback] = None):
+        self.on_token = on_token
+        self.start = time.perf_counter()
+        self.first_token = None
+        self.chunks: List[str] = []
+
+    def add(self, text: Optional[str]):
+        if not text:
+            return
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+        self.chunks.append(text)
+        if self.on_token:
+            self.on_token(text)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.chunks)
+
+    def metrics(self, completion_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """Time to first token and output tokens per second after it, in seconds.
+
+        Without a completion token count from the provider, streamed chunks are
+        counted as tokens.
+        """
+        elapsed = time.perf_counter() - self.start
+        ttft = self.first_token - self.start if self.first_token is not None else None
+        tokens = completion_tokens or len(self.chunks)
+        generation_time = elapsed - ttft if ttft is not None else 0.0
+        return {
+            "ttft": ttft,
+            "elapsed": elapsed,
+            "completion_tokens": tokens,
+            "tokens_per_second": tokens / generation_time if generation_time > 0 else None,
+        }
+
+# the end of a server-sent events stream
+SSE_DONE = object()
+
+def _sse_event(line: Union[bytes, str]) -> Optional[Any]:
+    """JSON payload of a `data:` line, SSE_DONE at `[DONE]`, None for any other line."""
+    if not line:
+        return None
+    line = line.decode('utf-8') if isinstance(line, bytes) else line
+    if not line.startswith('data:'):
+        return None
+    payload = line[len('data:'):].strip()
+    if payload == '[DONE]':
+        return SSE_DONE
+    try:
+        return json.loads(payload)
+    except json.JSONDecodeError:
+        logger.warning(f"Skipping malformed stream event: {payload[:200]}")
+        return None
+
+def iter_sse(response) -> Iterator[Dict[str, Any]]:
+    """JSON payloads of the `data:` lines of a server-sent events response, up to `[DONE]`."""
+    for line in response.iter_lines():
+        event = _sse_event(line)
+        if event is SSE_DONE:
+            break
+        if event is not None:
+            yield event
+
+async def aiter_sse(response) -> AsyncIterator[Dict[str, Any]]:
+    """iter_sse of an asynchronous response."""
+    async for line in response.aiter_lines():
+        event = _sse_event(line)
+        if event is SSE_DONE:
+            break
+        if event is not None:
+            yield event
+
+def token_usage(model: str, prompt_tokens: int, completion_tokens: int, total_tokens: Optional[int] = None,
+                cached_prompt_tokens: int = 0) -> Dict[str, Any]:
+    """token_usage entry of a response, priced with TOKEN_PRICING.
+
+    cached_prompt_tokens are the part of prompt_tokens the provider read from its
+    prefix cache, priced at "cached_prompt" when the model has one.
+    """
+    model_pricing = TOKEN_PRICING.get(model, {"prompt": 0.0, "completion": 0.0})
+    uncached_prompt_tokens = prompt_tokens - cached_prompt_tokens
+    cost = ((uncached_prompt_tokens * model_pricing["prompt"])
+            + (cached_prompt_tokens * model_pricing.get("cached_prompt", model_pricing["prompt"]))
+            + (completion_tokens * model_pricing["completion"])) / 1000
+    return {
+        "prompt_tokens": prompt_tokens,
+        "cached_prompt_tokens": cached_prompt_tokens,
+        "uncached_prompt_tokens": uncached_prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": total_tokens if total_tokens is not None else prompt_tokens + completion_tokens,
+        "model_pricing": model_pricing,
+        "cost": cost
+    }
+
 class LLMClient(ABC):
+    # How frames are resized and encoded before upload, clients override the defaults
+    # with their provider's limits and the "image" client config overrides both:
+    #   max_edge   : longest edge in pixels (0 keeps the size)
+    #   short_edge : shortest edge in pixels (0 keeps the size)
+    #   tile       : shrink edges spilling less than half a tile into one more tile
+    #   format     : jpeg, webp or png
+    #   quality    : encoder quality 1-100, None re-encodes only when resizing
+    #   detail     : OpenAI image detail (low, high or auto), None omits it
+    # A "models" dict in the config holds further overrides per model name.
+    IMAGE_POLICY = {
+        "max_edge"   : 0,
+        "short_edge" : 0,
+        "tile"       : 0,
+        "format"     : "jpeg",
+        "quality"    : None,
+        "detail"     : None,
+    }
 
+    image_config: Dict[str, Any] = {}
 
-    def encode_image(self, image_path: str) -> str:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+    def image_policy(self, model: Optional[str] = None) -> Dict[str, Any]:
+        """Return the image policy for `model`."""
+        policy = {**LLMClient.IMAGE_POLICY, **self.IMAGE_POLICY}
+        policy.update({k: v for k, v in self.image_config.items() if k != "models"})
+        policy.update(self.image_config.get("models", {}).get(model, {}))
+        return policy
+
+    def scaled_size(self, width: int, height: int, model: Optional[str] = None) -> Tuple[int, int]:
+        """Size a width x height image is uploaded at under the model's image policy."""
+        policy = self.image_policy(model)
+        scale = 1.0
+        if policy["max_edge"]:
+            scale = min(scale, policy["max_edge"] / max(width, height))
+        if policy["short_edge"]:
+            scale = min(scale, policy["short_edge"] / min(width, height))
+        if policy["tile"]:
+            tile = policy["tile"]
+            tiles_w = max(1, round(width * scale / tile))
+            tiles_h = max(1, round(height * scale / tile))
+            scale = min(scale, tiles_w * tile / width, tiles_h * tile / height)
+
+        if scale >= 1.0:
+            return width, height
+        return max(1, round(width * scale)), max(1, round(height * scale))
+
+    def estimate_image_tokens(self, width: int, height: int, model: Optional[str] = None) -> int:
+        """Estimate the prompt tokens a width x height image costs, after the image policy.
+
+        Clients override this with their provider's accounting, the default is
+        roughly one token per 750 pixels.
+        """
+        width, height = self.scaled_size(width, height, model)
+        return math.ceil(width * height / 750)
+
+    def prepare_image(self, image_path: Optional[str] = None, image_data: Optional[bytes] = None,
+                      model: Optional[str] = None) -> Tuple[str, str]:
+        """Apply the model's image policy and return the image as (base64 data, mime type).
+
+        Images that need neither resizing nor a different format or quality are
+        uploaded as they are.
+        """
+        if image_data is None:
+            with open(image_path, "rb") as image_file:
+                image_data = image_file.read()
+
+        policy = self.image_policy(model)
+        image_format = policy["format"]
+        if image_format not in IMAGE_MIME_TYPES:
+            raise ValueError(f"Unsupported image format: {image_format}, expected one of {list(IMAGE_MIME_TYPES)}")
+
+        image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Could not decode image")
+
+        height, width = image.shape[:2]
+        size = self.scaled_size(width, height, model)
+
+        if size == (width, height) and image_format == "jpeg" and policy["quality"] is None:
+            return base64.b64encode(image_data).decode('utf-8'), IMAGE_MIME_TYPES["jpeg"]
+
+        if size != (width, height):
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+        params = []
+        if policy["quality"] is not None:
+            quality_flag = {"jpeg": cv2.IMWRITE_JPEG_QUALITY, "webp": cv2.IMWRITE_WEBP_QUALITY}.get(image_format)
+            if quality_flag is not None:
+                params = [quality_flag, int(policy["quality"])]
+
+        ok, encoded = cv2.imencode(f".{image_format}", image, params)
+        if not ok:
+            raise ValueError(f"Could not encode image as {image_format}")
+        return base64.b64encode(encoded.tobytes()).decode('utf-8'), IMAGE_MIME_TYPES[image_format]
+
+    def prepare_images(self, images: Sequence[ImageSource], model: Optional[str] = None) -> List[Tuple[str, str]]:
+        """Apply prepare_image to each of `images`."""
+        return [
+            self.prepare_image(image_data=image, model=model) if isinstance(image, bytes)
+            else self.prepare_image(image_path=image, model=model)
+            for image in images
+        ]
+
+    def encode_image(self, image_path: Optional[str] = None, image_data: Optional[bytes] = None) -> str:
+        """Base64 encode an image given in memory as `image_data`, or read from `image_path`."""
+        if image_data is None:
+            with open(image_path, "rb") as image_file:
+                image_data = image_file.read()
+        return base64.b64encode(image_data).decode('utf-8')
 
     @abstractmethod
     def generate(self,
@@ -31,5 +258,108 @@ class LLMClient(ABC):
         stream: bool = False,
         model: str = "llama3.2-vision",
         temperature: float = 0.2,
-        num_predict: int = 256) -> Dict[Any, Any]:
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        """Generate a response for `prompt`, optionally about an image.
+
+        The image is given either as encoded bytes in `image_data` or as a file
+        at `image_path`, `image_data` takes precedence.
+
+        With `stream`, on_token is called with each piece of the response as it
+        arrives, and the response has a 'stream' entry with StreamTimer.metrics.
+        """
         pass
+
+    async def agenerate(self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        stream: bool = False,
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        """generate as a coroutine.
+
+        Clients override it with requests made on the event loop, the default runs
+        generate in the loop's default executor. on_token is called from the event
+        loop in overrides, from the executor's thread otherwise.
+        """
+        return await self._in_executor(self.generate, prompt, image_path, stream, model, temperature, num_predict,
+                                       image_data, on_token)
+
+    @staticmethod
+    async def _in_executor(function: Callable[..., Any], *args) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(function, *args))
+
+    def generate_batch(self,
+        prompt: str,
+        images: Sequence[ImageSource],
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256) -> Dict[Any, Any]:
+        """Generate a response for `prompt` about several images sent in one request.
+
+        Images are given as encoded bytes or file paths and sent in order after the
+        prompt. Clients whose API takes a single image per request do not support it.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support several images per request")
+
+    async def agenerate_batch(self,
+        prompt: str,
+        images: Sequence[ImageSource],
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256) -> Dict[Any, Any]:
+        """generate_batch as a coroutine, see agenerate."""
+        return await self._in_executor(self.generate_batch, prompt, images, model, temperature, num_predict)
+
+    def chat(self,
+        messages: Sequence[Dict[str, Any]],
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        stream: bool = False,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        """Generate the next reply of a conversation.
+
+        Messages are dicts with a "role" (system, user or assistant), the "content"
+        text and optionally "images", a list of ImageSource. Clients whose server
+        keeps the evaluated conversation between calls implement it, so a follow up
+        message only needs its own new tokens evaluated.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support chat sessions")
+
+    async def achat(self,
+        messages: Sequence[Dict[str, Any]],
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        stream: bool = False,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        """chat as a coroutine, see agenerate."""
+        return await self._in_executor(self.chat, messages, model, temperature, num_predict, stream, on_token)
+
+    def supports_chat(self) -> bool:
+        """Whether chat is implemented."""
+        return type(self).chat is not LLMClient.chat
+
+    def cache_prompt_prefix(self, prefix: str, model: Optional[str] = None) -> bool:
+        """Announce that prompts for `model` will start with `prefix`, so the client may
+        cache it on the provider's side.
+
+        Returns whether the client cached it. Providers that cache prompt prefixes
+        automatically, or not at all, need nothing, which is the default.
+        """
+        return False
+
+    def pricing(self, model: Optional[str] = None) -> Optional[Dict[str, float]]:
+        """TOKEN_PRICING entry the client's responses are priced with, None when requests
+        to `model` on this endpoint are not priced."""
+        return TOKEN_PRICING.get(model)
+
+    def supports_batch(self) -> bool:
+        """Whether generate_batch is implemented."""
+        return type(self).generate_batch is not LLMClient.generate_batch
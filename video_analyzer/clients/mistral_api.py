@@ -1,10 +1,14 @@
 import requests
 from requests.exceptions import RequestException
+import asyncio
 import json
 import time
 import re
-from typing import Optional, Dict, Any, Tuple
-from .llm_client import LLMClient, TOKEN_PRICING
+import math
+from typing import Optional, Dict, Any, Tuple, Sequence
+from .llm_client import (LLMClient, TOKEN_PRICING, ImageSource, TokenCallback, StreamTimer, iter_sse, aiter_sse,
+                         token_usage)
+from .transport import Transport, AsyncTransport, TransportResponse
 import logging
 from pprint import pformat
 
@@ -41,13 +45,25 @@ curl https://api.mistral.ai/v1/chat/completions \
 
 '''
 class MistralAPIClient(LLMClient):
+    # Pixtral downscales images larger than 1024x1024
+    IMAGE_POLICY = {"max_edge": 1024}
+
     def __init__(self, config, max_retries: int = DEFAULT_MAX_RETRIES):
         self.api_key = config['api_key']
+        self.image_config = config.get('image') or {}
         api_url = config['api_url']
         self.base_url = api_url.rstrip('/')  # Remove trailing slash if present
         self.generate_url = f"{self.base_url}/chat/completions"
         self.max_retries = max_retries
         self.usage = {}
+        self.transport = Transport.for_url(self.base_url, config.get('http'))
+        self.async_transport = AsyncTransport.for_url(self.base_url, config.get('http'))
+
+    def estimate_image_tokens(self, width: int, height: int, model: Optional[str] = None) -> int:
+        """One token per 16x16 patch plus a break token per row of patches."""
+        width, height = self.scaled_size(width, height, model)
+        rows = math.ceil(height / 16)
+        return math.ceil(width / 16) * rows + rows
 
     def generate(self,
         prompt: str,
@@ -55,55 +71,82 @@ class MistralAPIClient(LLMClient):
         stream: bool = False,
         model: str = None,
         temperature: float = 0.2,
-        num_predict: int = 256) -> Dict[Any, Any]:
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
         """Generate response from OpenAI-compatible API."""
+        images = [image_data if image_data is not None else image_path] if image_path or image_data is not None else []
+        return self._generate(prompt, images, stream, model, temperature, num_predict, on_token)
 
-        generate_url = self.generate_url
- 
+    async def agenerate(self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        stream: bool = False,
+        model: str = None,
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        """Generate response from Mistral API on the running event loop."""
+        images = [image_data if image_data is not None else image_path] if image_path or image_data is not None else []
+        return await self._agenerate(prompt, images, stream, model, temperature, num_predict, on_token)
+
+    def generate_batch(self,
+        prompt: str,
+        images: Sequence[ImageSource],
+        model: str = None,
+        temperature: float = 0.2,
+        num_predict: int = 256) -> Dict[Any, Any]:
+        """Generate response from Mistral API about several images in one message."""
+        return self._generate(prompt, images, False, model, temperature, num_predict)
+
+    async def agenerate_batch(self,
+        prompt: str,
+        images: Sequence[ImageSource],
+        model: str = None,
+        temperature: float = 0.2,
+        num_predict: int = 256) -> Dict[Any, Any]:
+        """generate_batch on the running event loop."""
+        return await self._agenerate(prompt, images, False, model, temperature, num_predict)
+
+    def _request(self, prompt: str, images: Sequence[ImageSource], stream: bool, model: str,
+                 num_predict: int) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """Data and headers of a chat completion request."""
         # Prepare the request data
-        if image_path:
-            base64_image = self.encode_image(image_path)
-            data = {
-                "model": model,
-                "messages": [
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {
-                                            "type": "text",
-                                            "text": prompt
-                                        },
-                                        {
-                                            "type": "image_url",
-                                            "image_url": f"data:image/jpeg;base64,{base64_image}"
-                                        }
-                                    ]
-                                }
-                ],
-                "max_tokens": 300
-            }
-        else:
-            data = {
-                "model": model,
-                "messages": [
-                                {
-                                    "role": "user",
-                                    "content": [
-                                        {
-                                            "type": "text",
-                                            "text": prompt
-                                        }
-                                    ]
-                                }
-                ],
-                "max_tokens": 300
+        content = [
+            {
+                "type": "text",
+                "text": prompt
             }
+        ]
+        for base64_image, mime_type in self.prepare_images(images, model):
+            content.append({
+                "type": "image_url",
+                "image_url": f"data:{mime_type};base64,{base64_image}"
+            })
+        data = {
+            "model": model,
+            "messages": [
+                            {
+                                "role": "user",
+                                "content": content
+                            }
+            ],
+            "max_tokens": num_predict,
+            "stream": stream
+        }
 
                 # Prepare headers
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
+        return data, headers
+
+    def _generate(self, prompt: str, images: Sequence[ImageSource], stream: bool, model: str,
+                  temperature: float, num_predict: int, on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        generate_url = self.generate_url
+        data, headers = self._request(prompt, images, stream, model, num_predict)
 
         # Initialize retry parameters
         retries = 0
@@ -112,99 +155,20 @@ class MistralAPIClient(LLMClient):
         while retries <= self.max_retries:
             try:
                 # Make the API request
-                response = requests.post(generate_url, headers=headers, json=data)
+                timer = StreamTimer(on_token)
+                response = self.transport.post(generate_url, data, headers=headers, stream=stream)
     
                 # Check if successful
+                if response.status_code == 200 and stream:
+                    return self._handle_streaming_response(response, model, timer)
+
                 if response.status_code == 200:
-                    json_response = response.json()
-                    logger.info(f'json_response : {json_response}')
-                    try:
-                        '''
-                            {
-                                'id': '1922d1034f7e4cb19728ca2555b084f8', 
-                                'object': 'chat.completion', 
-                                'created': 1742059898, 
-                                'model': 'pixtral-12b-2409', 
-                                'choices': [
-                                    {'index': 0, 
-                                    'message': 
-                                        { 'role': 'assistant', 
-                                        'tool_calls': None, 
-                                        'content': '```\nFrame 24\n\...```'},
-                                        'finish_reason': 'stop'
-                                    }
-                                ], 
-                                'usage': {
-                                    'prompt_tokens': 2942, 
-                                    'total_tokens': 3162, 
-                                    'completion_tokens': 220
-                                }
-                            }
-                        '''
-                        message = json_response["choices"][0]["message"]["content"]
-
-                    except Exception as e:
-                        logger.error(f'json_response parse Error : {str(e)}')
-
-                    if not message :
-                        raise Exception(f"No content in response message {json_response}")
-                        
-                    logger.info(f'>> {message}')
-
-                    # Extract token usage information
-                    '''
-                        'usage': {
-                            'prompt_tokens': 2942, 
-                            'total_tokens': 3162, 
-                            'completion_tokens': 220
-                        }
-                    '''
-                    # Calculate tokens
-                    prompt_tokens     = json_response["usage"]["prompt_tokens"    ] 
-                    completion_tokens = json_response["usage"]["completion_tokens"] 
-                    total_tokens      = json_response["usage"]["total_tokens"     ] 
-
-                    # Calculate cost
-                    model_pricing = TOKEN_PRICING.get(model, {"prompt": 0.0, "completion": 0.0})
-
-                    cost = ((prompt_tokens * model_pricing["prompt"]) + (completion_tokens * model_pricing["completion"])) / 1000
-
-                    logger.info(f"Token Usage - Prompt: {prompt_tokens}, Completion: {completion_tokens}, Total: {total_tokens}")
-                    logger.info(f"Estimated Cost: ${cost:.6f}")
-
-                    return {
-                        "response": message,
-                        "token_usage": {
-                            "prompt_tokens": prompt_tokens,
-                            "completion_tokens": completion_tokens,
-                            "total_tokens": total_tokens,
-                            "model_pricing": model_pricing,
-                            "cost": cost
-                        }
-                    }
-  
-                # Handle rate limiting
-                if response.status_code == 429 or response.status_code == 503:
-                    # Get retry-after header if available
-                    retry_after = None
-                    if 'retry-after' in response.headers:
-                        retry_after = int(response.headers['retry-after'])
-                        logger.info(f"Using Retry-After header value: {retry_after} seconds")
-
-                    # Use retry-after value or exponential backoff
-                    wait_time = retry_after if retry_after else backoff_time
-                    
-                    if retries < self.max_retries:
-                        logger.info(f"Rate limit hit. Retrying in {wait_time} seconds. (Attempt {retries+1}/{self.max_retries})")
-                        time.sleep(wait_time)
-                        retries += 1
-                        backoff_time *= 2  # Exponential backoff
-                    else:
-                        logger.error(f"Max retries ({self.max_retries}) exceeded")
-                        raise Exception(f"Max retries exceeded. Last status: {response.status_code}")
-                else:
-                    # If it's another error, raise immediately
-                    raise Exception(f"API request failed with status code {response.status_code}: {response.text}")
+                    return self._handle_response(response, model)
+
+                wait_time = self._rate_limit_wait(response, retries, backoff_time)
+                time.sleep(wait_time)
+                retries += 1
+                backoff_time *= 2  # Exponential backoff
                 
             except RequestException as e:
                 # Handle network errors
@@ -216,3 +180,145 @@ class MistralAPIClient(LLMClient):
                 else:
                     logger.error(f"Max retries ({self.max_retries}) exceeded")
                     raise
+
+    async def _agenerate(self, prompt: str, images: Sequence[ImageSource], stream: bool, model: str,
+                         temperature: float, num_predict: int, on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        # images are resized off the event loop
+        data, headers = await self._in_executor(self._request, prompt, images, stream, model, num_predict)
+
+        retries = 0
+        backoff_time = 2
+
+        while retries <= self.max_retries:
+            try:
+                timer = StreamTimer(on_token)
+                response = await self.async_transport.apost(self.generate_url, data, headers=headers, stream=stream)
+
+                if response.status_code == 200 and stream:
+                    usage = None
+                    async for event in aiter_sse(response):
+                        usage = self._stream_event(event, timer) or usage
+                    return self._stream_result(timer, usage, model)
+
+                if response.status_code == 200:
+                    return self._handle_response(response, model)
+
+                wait_time = self._rate_limit_wait(response, retries, backoff_time)
+                await asyncio.sleep(wait_time)
+                retries += 1
+                backoff_time *= 2
+
+            except RequestException as e:
+                if retries < self.max_retries:
+                    logger.info(f"Network error: {str(e)}. Retrying in {backoff_time} seconds.")
+                    await asyncio.sleep(backoff_time)
+                    retries += 1
+                    backoff_time *= 2
+                else:
+                    logger.error(f"Max retries ({self.max_retries}) exceeded")
+                    raise
+
+    def _handle_response(self, response: TransportResponse, model: str) -> Dict[Any, Any]:
+        """Parse a successful, non streamed, response."""
+        json_response = response.json()
+        logger.info(f'json_response : {json_response}')
+        message = None
+        try:
+            '''
+                {
+                    'id': '1922d1034f7e4cb19728ca2555b084f8', 
+                    'object': 'chat.completion', 
+                    'created': 1742059898, 
+                    'model': 'pixtral-12b-2409', 
+                    'choices': [
+                        {'index': 0, 
+                        'message': 
+                            { 'role': 'assistant', 
+                            'tool_calls': None, 
+                            'content': '```\nFrame 24\n\...```'},
+                            'finish_reason': 'stop'
+                        }
+                    ], 
+                    'usage': {
+                        'prompt_tokens': 2942, 
+                        'total_tokens': 3162, 
+                        'completion_tokens': 220
+                    }
+                }
+            '''
+            message = json_response["choices"][0]["message"]["content"]
+
+        except Exception as e:
+            logger.error(f'json_response parse Error : {str(e)}')
+
+        if not message :
+            raise Exception(f"No content in response message {json_response}")
+            
+        logger.info(f'>> {message}')
+
+        # Extract token usage information
+        '''
+            'usage': {
+                'prompt_tokens': 2942, 
+                'total_tokens': 3162, 
+                'completion_tokens': 220
+            }
+        '''
+        # Calculate tokens
+        usage = token_usage(model, json_response["usage"]["prompt_tokens"],
+                            json_response["usage"]["completion_tokens"], json_response["usage"]["total_tokens"])
+
+        logger.info(f"Token Usage - Prompt: {usage['prompt_tokens']}, Completion: {usage['completion_tokens']}, Total: {usage['total_tokens']}")
+        logger.info(f"Estimated Cost: ${usage['cost']:.6f}")
+
+        return {
+            "response": message,
+            "token_usage": usage
+        }
+
+    def _rate_limit_wait(self, response: TransportResponse, retries: int, backoff_time: float) -> float:
+        """Seconds to wait before retrying a failed request, raises when it is not retried."""
+        # Handle rate limiting
+        if response.status_code == 429 or response.status_code == 503:
+            # Get retry-after header if available
+            retry_after = None
+            if 'retry-after' in response.headers:
+                retry_after = int(response.headers['retry-after'])
+                logger.info(f"Using Retry-After header value: {retry_after} seconds")
+
+            # Use retry-after value or exponential backoff
+            wait_time = retry_after if retry_after else backoff_time
+            
+            if retries < self.max_retries:
+                logger.info(f"Rate limit hit. Retrying in {wait_time} seconds. (Attempt {retries+1}/{self.max_retries})")
+                return wait_time
+            logger.error(f"Max retries ({self.max_retries}) exceeded")
+            raise Exception(f"Max retries exceeded. Last status: {response.status_code}")
+        # If it's another error, raise immediately
+        raise Exception(f"API request failed with status code {response.status_code}: {response.text}")
+
+    def _handle_streaming_response(self, response: TransportResponse, model: str, timer: StreamTimer) -> Dict[Any, Any]:
+        """Accumulate the content deltas of chat completion events, the last one carries the usage."""
+        usage = None
+        for event in iter_sse(response):
+            usage = self._stream_event(event, timer) or usage
+        return self._stream_result(timer, usage, model)
+
+    @staticmethod
+    def _stream_event(event: Dict[str, Any], timer: StreamTimer) -> Optional[Dict[str, Any]]:
+        if event.get('choices'):
+            timer.add(event['choices'][0].get('delta', {}).get('content'))
+        return event.get('usage') or None
+
+    def _stream_result(self, timer: StreamTimer, usage: Optional[Dict[str, Any]], model: str) -> Dict[Any, Any]:
+        if not timer.text:
+            raise Exception("No content in streamed response")
+
+        result = {"response": timer.text}
+        if usage:
+            result["token_usage"] = token_usage(model, usage.get('prompt_tokens', 0),
+                                                usage.get('completion_tokens', 0), usage.get('total_tokens'))
+        result["stream"] = timer.metrics(usage.get('completion_tokens') if usage else None)
+        logger.info(f"Streamed {result['stream']['completion_tokens']} tokens, "
+                    f"time to first token {result['stream']['ttft']}s")
+        return result
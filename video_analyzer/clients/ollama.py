@@ -1,13 +1,23 @@
 import requests
 import json
-from typing import Optional, Dict, Any
-from .llm_client import LLMClient, TOKEN_PRICING
+from typing import Optional, Dict, Any, Sequence
+from .llm_client import LLMClient, TOKEN_PRICING, TokenCallback, StreamTimer
+from .transport import Transport, AsyncTransport
 
 class OllamaClient(LLMClient):
+    # llama3.2-vision tiles images into at most 1120x1120
+    IMAGE_POLICY = {"max_edge": 1120}
+
     def __init__(self, config):
         base_url = config['api_url']
+        self.image_config = config.get('image') or {}
         self.base_url = base_url.rstrip('/')
         self.generate_url = f"{self.base_url}/api/generate"
+        self.chat_url = f"{self.base_url}/api/chat"
+        # how long the server keeps the model, and the evaluated prompt, loaded after a request
+        self.keep_alive = config.get('keep_alive')
+        self.transport = Transport.for_url(self.base_url, config.get('http'))
+        self.async_transport = AsyncTransport.for_url(self.base_url, config.get('http'))
 
     def generate(self,
         prompt: str,
@@ -15,63 +25,193 @@ class OllamaClient(LLMClient):
         stream: bool = False,
         model: str = "llama3.2-vision",
         temperature: float = 0.2,
-        num_predict: int = 256) -> Dict[Any, Any]:
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
         try:
-            # Build the request data
-            data = {
-                "model": model,
-                "prompt": prompt,
-                "stream": stream,
-                "options": {
-                    "temperature": temperature,
-                    "num_predict": num_predict
-                }
+            data = self._generate_data(prompt, image_path, stream, model, temperature, num_predict, image_data)
+            return self._post(self.generate_url, data, stream, on_token)
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"API request failed: {str(e)}")
+        except Exception as e:
+            raise Exception(f"An error occurred: {str(e)}")
+
+    async def agenerate(self,
+        prompt: str,
+        image_path: Optional[str] = None,
+        stream: bool = False,
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        image_data: Optional[bytes] = None,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        try:
+            # images are resized off the event loop
+            data = await self._in_executor(self._generate_data, prompt, image_path, stream, model, temperature,
+                                           num_predict, image_data)
+            return await self._apost(self.generate_url, data, stream, on_token)
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"API request failed: {str(e)}")
+        except Exception as e:
+            raise Exception(f"An error occurred: {str(e)}")
+
+    def _generate_data(self, prompt: str, image_path: Optional[str], stream: bool, model: str, temperature: float,
+                       num_predict: int, image_data: Optional[bytes]) -> Dict[str, Any]:
+        # Build the request data
+        data = {
+            "model": model,
+            "prompt": prompt,
+            "stream": stream,
+            "options": {
+                "temperature": temperature,
+                "num_predict": num_predict
             }
-            
-            if image_path:
-                # Use encode_image from parent LLMClient class
-                data["images"] = [self.encode_image(image_path)]
-                    
-            response = requests.post(self.generate_url, json=data)
-            response.raise_for_status()
-            
-            if stream:
-                return self._handle_streaming_response(response)
-            else:
-                return {
-                        "response": response.json(),
-                        "token_usage": {
-                            "prompt_tokens": 0,
-                            "completion_tokens": 0,
-                            "total_tokens": 0,
-                            "model_pricing": false,
-                            "cost": 0
-                        }
-                    }
-                
+        }
+        if self.keep_alive is not None:
+            data["keep_alive"] = self.keep_alive
+        
+        if image_path or image_data is not None:
+            # Use prepare_image from parent LLMClient class, ollama takes raw base64 images
+            base64_image, _ = self.prepare_image(image_path, image_data, model)
+            data["images"] = [base64_image]
+        return data
+
+    def chat(self,
+        messages: Sequence[Dict[str, Any]],
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        stream: bool = False,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        """Generate the next reply with /api/chat.
+
+        The Ollama runner keeps the KV cache of the last conversation it evaluated,
+        so when `messages` extends the previous call's messages and reply, only the
+        new messages are prefilled.
+        """
+        try:
+            data = self._chat_data(messages, model, temperature, num_predict, stream)
+            return self._post(self.chat_url, data, stream, on_token)
         except requests.exceptions.RequestException as e:
             raise Exception(f"API request failed: {str(e)}")
         except Exception as e:
             raise Exception(f"An error occurred: {str(e)}")
-            
-    def _handle_streaming_response(self, response: requests.Response) -> Dict[Any, Any]:
-        accumulated_response = ""
-        for line in response.iter_lines():
-            if line:
-                try:
-                    json_response = json.loads(line.decode('utf-8'))
-                    if 'response' in json_response:
-                        accumulated_response += json_response['response']
-                except json.JSONDecodeError:
-                    continue
-                    
+
+    async def achat(self,
+        messages: Sequence[Dict[str, Any]],
+        model: str = "llama3.2-vision",
+        temperature: float = 0.2,
+        num_predict: int = 256,
+        stream: bool = False,
+        on_token: Optional[TokenCallback] = None) -> Dict[Any, Any]:
+        try:
+            data = await self._in_executor(self._chat_data, messages, model, temperature, num_predict, stream)
+            return await self._apost(self.chat_url, data, stream, on_token)
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"API request failed: {str(e)}")
+        except Exception as e:
+            raise Exception(f"An error occurred: {str(e)}")
+
+    def _chat_data(self, messages: Sequence[Dict[str, Any]], model: str, temperature: float, num_predict: int,
+                   stream: bool) -> Dict[str, Any]:
+        chat_messages = []
+        for message in messages:
+            chat_message = {"role": message["role"], "content": message["content"]}
+            if message.get("images"):
+                chat_message["images"] = [base64_image for base64_image, _ in self.prepare_images(message["images"], model)]
+            chat_messages.append(chat_message)
+
+        data = {
+            "model": model,
+            "messages": chat_messages,
+            "stream": stream,
+            "options": {
+                "temperature": temperature,
+                "num_predict": num_predict
+            }
+        }
+        if self.keep_alive is not None:
+            data["keep_alive"] = self.keep_alive
+        return data
+
+    def _post(self, url: str, data: Dict[str, Any], stream: bool, on_token: Optional[TokenCallback]) -> Dict[Any, Any]:
+        timer = StreamTimer(on_token)
+        response = self.transport.post(url, data, stream=stream)
+        response.raise_for_status()
+
+        if stream:
+            final = {}
+            for line in response.iter_lines():
+                final = self._stream_chunk(line, timer) or final
+            return self._stream_result(final, timer)
+        return self._result(response.json())
+
+    async def _apost(self, url: str, data: Dict[str, Any], stream: bool,
+                     on_token: Optional[TokenCallback]) -> Dict[Any, Any]:
+        timer = StreamTimer(on_token)
+        response = await self.async_transport.apost(url, data, stream=stream)
+        response.raise_for_status()
+
+        if stream:
+            final = {}
+            async for line in response.aiter_lines():
+                final = self._stream_chunk(line, timer) or final
+            return self._stream_result(final, timer)
+        return self._result(response.json())
+
+    def _result(self, json_response: Dict[str, Any]) -> Dict[Any, Any]:
+        # /api/generate responses have "response", /api/chat responses a "message"
+        if "message" in json_response:
+            text = json_response["message"].get("content", "")
+        else:
+            text = json_response.get("response", "")
+        return {
+                "response": text,
+                "token_usage": self._token_usage(json_response)
+            }
+
+    def pricing(self, model: Optional[str] = None) -> Optional[Dict[str, float]]:
+        """Local models cost nothing, whatever TOKEN_PRICING lists for their name."""
+        return None
+
+    @staticmethod
+    def _token_usage(json_response: Dict[str, Any]) -> Dict[str, Any]:
+        """Token counts of the final response, local models cost nothing.
+
+        When a chat reuses the previous conversation, Ollama may only count the newly
+        evaluated prompt tokens in prompt_eval_count.
+        """
+        prompt_tokens = json_response.get("prompt_eval_count", 0)
+        completion_tokens = json_response.get("eval_count", 0)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "cached_prompt_tokens": 0,
+            "uncached_prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "model_pricing": False,
+            "cost": 0
+        }
+
+    @staticmethod
+    def _stream_chunk(line: bytes, timer: StreamTimer) -> Optional[Dict[str, Any]]:
+        """Add the text of one newline delimited JSON chunk to `timer`, returns the last
+        chunk, the one with "done" and the token counts."""
+        if not line:
+            return None
+        try:
+            json_response = json.loads(line.decode('utf-8'))
+        except json.JSONDecodeError:
+            return None
+        if 'error' in json_response:
+            raise Exception(f"API error: {json_response['error']}")
+        # /api/generate chunks have "response", /api/chat chunks a "message"
+        timer.add(json_response.get('response') or json_response.get('message', {}).get('content'))
+        return json_response if json_response.get('done') else None
+
+    def _stream_result(self, final: Dict[str, Any], timer: StreamTimer) -> Dict[Any, Any]:
         return {
-                "response": accumulated_response,
-                "token_usage": {
-                    "prompt_tokens": 0,
-                    "completion_tokens": 0,
-                    "total_tokens": 0,
-                    "model_pricing": false,
-                    "cost": 0
-                }
+                "response": timer.text,
+                "token_usage": self._token_usage(final),
+                "stream": timer.metrics(final.get("eval_count"))
             }
@@ -0,0 +1,321 @@
+from typing import Optional, Dict, Any, Iterator, AsyncIterator, Tuple
+from urllib.parse import urlsplit
+import asyncio
+import json
+import logging
+import threading
+import weakref
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import h2 # noqa: F401, httpx needs it for HTTP/2
+    HTTP2_AVAILABLE = httpx is not None
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_TIMEOUT = 10  # seconds
+DEFAULT_READ_TIMEOUT = 300  # seconds between bytes, long generations send nothing until done
+DEFAULT_POOL_SIZE = 16  # connections kept alive per endpoint
+
+class TransportResponse:
+    """The parts of a response the clients use, the same for both HTTP libraries.
+
+    Bytes received are counted as the body is read.
+    """
+    def __init__(self, response, transport: "Transport", stream: bool):
+        self._response = response
+        self._transport = transport
+        self._content: Optional[bytes] = None
+        if not stream:
+            self._read()
+
+    @property
+    def status_code(self) -> int:
+        return self._response.status_code
+
+    @property
+    def headers(self):
+        return self._response.headers
+
+    @property
+    def content(self) -> bytes:
+        return self._read()
+
+    def _read(self) -> bytes:
+        if self._content is None:
+            if httpx is not None and isinstance(self._response, httpx.Response):
+                self._content = self._response.read()
+                self._response.close()
+            else:
+                self._content = self._response.content
+            self._transport._count(received=len(self._content))
+        return self._content
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self._response.encoding or "utf-8", errors="replace")
+
+    def json(self) -> Any:
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f"{self.status_code} Error for url: {self._response.url}",
+                                                response=self)
+
+    def iter_lines(self) -> Iterator[bytes]:
+        """Lines of a streamed body as bytes, as requests gives them."""
+        if self._content is not None:
+            yield from self._content.splitlines()
+            return
+        if httpx is not None and isinstance(self._response, httpx.Response):
+            try:
+                for line in self._response.iter_lines():
+                    self._transport._count(received=len(line) + 1)
+                    yield line.encode("utf-8")
+            except httpx.HTTPError as e:
+                raise _request_exception(e) from e
+            finally:
+                self._response.close()
+            return
+        try:
+            for line in self._response.iter_lines():
+                self._transport._count(received=len(line) + 1)
+                yield line
+        finally:
+            self._response.close()
+
+def _request_exception(error: Exception) -> requests.exceptions.RequestException:
+    """httpx errors as the requests exceptions the clients retry on."""
+    if isinstance(error, httpx.TimeoutException):
+        return requests.exceptions.Timeout(str(error))
+    return requests.exceptions.ConnectionError(str(error))
+
+class Transport:
+    """Keep-alive connection pool to one endpoint (scheme, host and port), shared by
+    every client talking to it.
+
+    Requests have connect and read timeouts, and the bytes sent and received are
+    counted. With http2 and httpx (with h2) installed requests go over HTTP/2,
+    otherwise over a pooled requests.Session.
+    """
+    # transports of every class, keyed by (class name, endpoint, config)
+    _transports: Dict[Tuple[str, str, str], "Transport"] = {}
+    _transports_lock = threading.Lock()
+
+    def __init__(self, endpoint: str, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT, pool_size: int = DEFAULT_POOL_SIZE, http2: bool = False):
+        self.endpoint = endpoint
+        self.timeout = (connect_timeout, read_timeout)
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("HTTP/2 needs httpx with h2 installed (pip install 'httpx[http2]'), using HTTP/1.1")
+        self.http2 = http2 and HTTP2_AVAILABLE
+        if self.http2:
+            self._client = httpx.Client(
+                http2=True,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            )
+        else:
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            self._session.mount(endpoint, adapter)
+
+    @classmethod
+    def for_url(cls, url: str, config: Optional[Dict[str, Any]] = None) -> "Transport":
+        """The shared transport to the endpoint of `url`, created with the "http" config
+        settings on first use."""
+        config = config or {}
+        parts = urlsplit(url)
+        endpoint = f"{parts.scheme}://{parts.netloc}"
+        key = (cls.__name__, endpoint, json.dumps(config, sort_keys=True))
+        with cls._transports_lock:
+            if key not in cls._transports:
+                cls._transports[key] = cls(
+                    endpoint,
+                    connect_timeout=config.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+                    read_timeout=config.get("read_timeout", DEFAULT_READ_TIMEOUT),
+                    pool_size=config.get("pool_size", DEFAULT_POOL_SIZE),
+                    http2=config.get("http2", False)
+                )
+            return cls._transports[key]
+
+    @classmethod
+    def all_stats(cls) -> Dict[str, Dict[str, Any]]:
+        """stats() of every transport, synchronous and asynchronous, by endpoint."""
+        with cls._transports_lock:
+            transports = list(cls._transports.values())
+        stats: Dict[str, Dict[str, Any]] = {}
+        for transport in transports:
+            total = stats.setdefault(transport.endpoint, {"requests": 0, "bytes_sent": 0, "bytes_received": 0})
+            for name, value in transport.stats().items():
+                if name in total:
+                    total[name] += value
+        return stats
+
+    def _count(self, sent: int = 0, received: int = 0):
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "bytes_sent": self.bytes_sent,
+                "bytes_received": self.bytes_received,
+                "http2": self.http2,
+            }
+
+    def post(self, url: str, json_data: Any = None, params: Optional[Dict[str, Any]] = None,
+             headers: Optional[Dict[str, str]] = None, stream: bool = False) -> TransportResponse:
+        """POST `json_data` as a JSON body. With stream, the body is read as it is iterated."""
+        body = json.dumps(json_data).encode("utf-8")
+        headers = {"Content-Type": "application/json", **(headers or {})}
+        with self._lock:
+            self.requests += 1
+        self._count(sent=len(body))
+
+        if self.http2:
+            try:
+                request = self._client.build_request("POST", url, content=body, params=params, headers=headers)
+                response = self._client.send(request, stream=True)
+                return TransportResponse(response, self, stream)
+            except httpx.HTTPError as e:
+                raise _request_exception(e) from e
+
+        response = self._session.post(url, data=body, params=params, headers=headers, stream=stream,
+                                      timeout=self.timeout)
+        return TransportResponse(response, self, stream)
+
+class AsyncTransportResponse(TransportResponse):
+    """TransportResponse of an AsyncTransport request.
+
+    The body of a non streamed response, or of an error response, is read before
+    it is returned, so content, text, json() and raise_for_status() work as for
+    TransportResponse; a streamed body is read with aiter_lines.
+    """
+    def __init__(self, response, transport: "AsyncTransport"):
+        super().__init__(response, transport, stream=True)
+
+    def _read(self) -> bytes:
+        if self._content is None:
+            raise RuntimeError("The streamed body of an asynchronous response is read with aiter_lines")
+        return self._content
+
+    async def aread(self) -> bytes:
+        if self._content is None:
+            try:
+                self._content = await self._response.aread()
+            except httpx.HTTPError as e:
+                raise _request_exception(e) from e
+            finally:
+                await self._response.aclose()
+            self._transport._count(received=len(self._content))
+        return self._content
+
+    def iter_lines(self) -> Iterator[bytes]:
+        raise RuntimeError("The body of an asynchronous response is read with aiter_lines")
+
+    async def aiter_lines(self) -> AsyncIterator[bytes]:
+        """Lines of a streamed body as bytes, as iter_lines gives them."""
+        if self._content is not None:
+            for line in self._content.splitlines():
+                yield line
+            return
+        try:
+            async for line in self._response.aiter_lines():
+                self._transport._count(received=len(line) + 1)
+                yield line.encode("utf-8")
+        except httpx.HTTPError as e:
+            raise _request_exception(e) from e
+        finally:
+            await self._response.aclose()
+
+class AsyncTransport(Transport):
+    """Transport for asyncio clients, on httpx.AsyncClient.
+
+    A pool of connections belongs to the event loop that opened it, so each
+    running loop gets its own httpx.AsyncClient; requests and bytes are counted
+    across all of them.
+    """
+    def __init__(self, endpoint: str, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT, pool_size: int = DEFAULT_POOL_SIZE, http2: bool = False):
+        self.endpoint = endpoint
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.requests = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("HTTP/2 needs httpx with h2 installed (pip install 'httpx[http2]'), using HTTP/1.1")
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._clients = weakref.WeakKeyDictionary() # event loop -> httpx.AsyncClient
+
+    def _client(self):
+        if httpx is None:
+            raise ImportError("Asynchronous requests need httpx installed (pip install httpx)")
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._clients:
+                connect_timeout, read_timeout = self.timeout
+                self._clients[loop] = httpx.AsyncClient(
+                    http2=self.http2,
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                    limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+                )
+            return self._clients[loop]
+
+    async def aclose(self):
+        """Close the connections of the running event loop."""
+        with self._lock:
+            client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    @classmethod
+    async def aclose_all(cls):
+        """aclose() every asynchronous transport, before the running event loop ends."""
+        with cls._transports_lock:
+            transports = [transport for transport in cls._transports.values() if isinstance(transport, AsyncTransport)]
+        for transport in transports:
+            await transport.aclose()
+
+    def post(self, url: str, json_data: Any = None, params: Optional[Dict[str, Any]] = None,
+             headers: Optional[Dict[str, str]] = None, stream: bool = False) -> TransportResponse:
+        raise RuntimeError("AsyncTransport requests are sent with apost")
+
+    async def apost(self, url: str, json_data: Any = None, params: Optional[Dict[str, Any]] = None,
+                    headers: Optional[Dict[str, str]] = None, stream: bool = False) -> AsyncTransportResponse:
+        """POST `json_data` as a JSON body. With stream, the body is read as it is iterated."""
+        client = self._client()
+        body = json.dumps(json_data).encode("utf-8")
+        headers = {"Content-Type": "application/json", **(headers or {})}
+        with self._lock:
+            self.requests += 1
+        self._count(sent=len(body))
+
+        try:
+            request = client.build_request("POST", url, content=body, params=params, headers=headers)
+            response = AsyncTransportResponse(await client.send(request, stream=True), self)
+        except httpx.HTTPError as e:
+            raise _request_exception(e) from e
+        if not stream or response.status_code >= 400:
+            await response.aread()
+        return response
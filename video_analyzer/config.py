@@ -84,7 +84,7 @@ class Config:
                         self.config["audio"]["language"] = value
                 elif key == "device":
                     self.config["audio"]["device"] = value
-                elif key not in ["start_stage", "max_frames"]:  # Ignore these as they're command-line only
+                elif key not in ["start_stage", "max_frames", "plan", "budget"]:  # Ignore these as they're command-line only
                     self.config[key] = value
 
     def save_user_config(self):
@@ -139,5 +139,9 @@ def get_client(config: Config, client_type: str) -> dict:
     return {
         "api_key": api_key,
         "api_url": api_url,
-        "model"  : model
+        "model"  : model,
+        "image"  : client_config.get("image", {}),
+        "context_cache": client_config.get("context_cache", {}),
+        "keep_alive": client_config.get("keep_alive"),
+        "http": config.get("http", {})
     }
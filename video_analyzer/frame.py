@@ -1,58 +1,610 @@
-from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import bisect
+import functools
+import heapq
+import os
+import queue
+import re
+import subprocess
+import threading
 import cv2
 import numpy as np
 import logging
+from .frame_cache import FrameCache
 
 logger = logging.getLogger(__name__)
 
-@dataclass
 class Frame:
-    ix: int
-    number: int
-    path: Path
-    name: str
-    timestamp: float
-    score: float
+    """Typed view of one row of a FrameTable."""
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table: 'FrameTable', row: int):
+        self._table = table
+        self._row = row
+
+    @property
+    def ix(self) -> int:
+        return int(self._table.ix[self._row])
+
+    @property
+    def number(self) -> int:
+        return int(self._table.number[self._row])
+
+    @property
+    def timestamp(self) -> float:
+        return float(self._table.timestamp[self._row])
+
+    @property
+    def score(self) -> float:
+        return float(self._table.score[self._row])
+
+    @property
+    def name(self) -> str:
+        return f"frame_{self.ix}.jpg"
+
+    @property
+    def path(self) -> Optional[Path]:
+        """Where the frame was written, None for frames only kept in memory."""
+        return self._table.paths[self._row]
+
+    @property
+    def data(self) -> bytes:
+        """The frame JPEG encoded."""
+        return self._table.data[self._row]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON serializable frame metadata, without local paths or image bytes."""
+        return {
+            'idx'  : self.ix,
+            'num'  : self.number,
+            'name' : self.name,
+            'timestamp' : self.timestamp,
+            'score' : self.score
+        }
+
+    def __repr__(self) -> str:
+        return f"Frame(ix={self.ix}, number={self.number}, timestamp={self.timestamp:.2f}, score={self.score:.2f})"
+
+class FrameTable:
+    """Column store of extracted frames.
+
+    Frame index, frame number, timestamp and score are kept in numpy columns
+    rather than one object per frame; iterating or indexing the table returns
+    Frame views onto its rows.
+    """
+
+    def __init__(self):
+        self.ix = np.empty(0, dtype=np.int32)
+        self.number = np.empty(0, dtype=np.int64)
+        self.timestamp = np.empty(0, dtype=np.float64)
+        self.score = np.empty(0, dtype=np.float64)
+        self.paths: List[Optional[Path]] = []
+        self.data: List[bytes] = []
+
+    def append(self, ix: List[int], number: List[int], timestamp: List[float], score: List[float],
+               paths: List[Optional[Path]], data: List[bytes]) -> List[Frame]:
+        """Append rows given column-wise and return views of them."""
+        first_row = len(self)
+        self.ix = np.concatenate((self.ix, np.asarray(ix, dtype=np.int32)))
+        self.number = np.concatenate((self.number, np.asarray(number, dtype=np.int64)))
+        self.timestamp = np.concatenate((self.timestamp, np.asarray(timestamp, dtype=np.float64)))
+        self.score = np.concatenate((self.score, np.asarray(score, dtype=np.float64)))
+        self.paths.extend(paths)
+        self.data.extend(data)
+        return [Frame(self, row) for row in range(first_row, len(self))]
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        return [frame.to_dict() for frame in self]
+
+    def __len__(self) -> int:
+        return len(self.ix)
+
+    def __getitem__(self, row: int) -> Frame:
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(f"Frame row {row} out of range")
+        return Frame(self, row)
+
+    def __iter__(self) -> Iterator[Frame]:
+        return (Frame(self, row) for row in range(len(self)))
+
+def image_hash(data: bytes, hash_size: int = 8) -> int:
+    """Difference hash of a JPEG: one bit per horizontally adjacent pixel pair of a
+    (hash_size + 1) x hash_size grayscale thumbnail, set where brightness increases."""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError("Could not decode image")
+    thumbnail = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_passthrough_option() -> str:
+    """Return the ffmpeg option keeping every frame's timestamp, -fps_mode needs ffmpeg 5.1."""
+    try:
+        version = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout
+    except FileNotFoundError:
+        return "-fps_mode" # reported when the frames are read
+    # development builds (N-...) are newer than any release without -fps_mode
+    match = re.match(r"ffmpeg version n?(\d+)\.(\d+)", version)
+    if match and (int(match.group(1)), int(match.group(2))) < (5, 1):
+        return "-vsync"
+    return "-fps_mode"
+
+class FrameScorer:
+    """Score sampled frames by their mean absolute difference from the previous sample.
+
+    Scoring runs on a small grayscale thumbnail and only the previous sample's
+    thumbnail is cached, so each frame is converted once and no per-frame
+    buffers are allocated after the first call.
+    """
+    # longest thumbnail edge in pixels, 0 scores at full resolution
+    SCORE_SIZE = 256
+
+    def __init__(self, score_size: int = SCORE_SIZE):
+        self.score_size = score_size
+        self.reset()
+
+    def reset(self):
+        """Forget the previous sample, the next frame scores 0."""
+        self._size = None
+        self._small = None
+        self._gray = None
+        self._prev = None
+        self._diff = None
+
+    def thumbnail_size(self, width: int, height: int) -> Tuple[int, int]:
+        """Return the (width, height) frames of the given size are scored at."""
+        scale = min(1.0, self.score_size / max(height, width)) if self.score_size else 1.0
+        return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+    def _allocate(self, frame: np.ndarray):
+        height, width = frame.shape[:2]
+        self._size = self.thumbnail_size(width, height)
+        thumb_w, thumb_h = self._size
+        resize = self._size != (width, height)
+        self._small = np.empty((thumb_h, thumb_w, 3), np.uint8) if resize and frame.ndim == 3 else None
+        self._gray = np.empty((thumb_h, thumb_w), np.uint8)
+        self._prev = np.empty_like(self._gray)
+        self._diff = np.empty_like(self._gray)
+
+    def score(self, frame: np.ndarray) -> float:
+        """Return the difference between `frame` and the previously scored frame.
+
+        `frame` is either a BGR frame or an already grayscale (2-D) frame, e.g. a
+        thumbnail scaled by the decoder.
+        """
+        has_prev = self._size is not None
+        if not has_prev:
+            self._allocate(frame)
+
+        if frame.ndim == 2:
+            if frame.shape == self._gray.shape:
+                np.copyto(self._gray, frame)
+            else:
+                cv2.resize(frame, self._size, dst=self._gray, interpolation=cv2.INTER_AREA)
+        elif self._small is not None:
+            cv2.resize(frame, self._size, dst=self._small, interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        else:
+            cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self._gray)
+
+        score = 0.0
+        if has_prev:
+            cv2.absdiff(self._gray, self._prev, dst=self._diff)
+            score = cv2.mean(self._diff)[0]
+
+        # current thumbnail becomes the previous one, reuse the old buffer next time
+        self._gray, self._prev = self._prev, self._gray
+        return float(score)
 
 class VideoProcessor:
     # Class constants
     FRAME_DIFFERENCE_THRESHOLD = 10.0
+    SEEK_INTERVAL = 300 # sampled frames further apart than this are reached by seeking
+    MIN_SEGMENT_SAMPLES = 50 # don't split the scan into segments smaller than this
+    DECODERS = ('opencv', 'ffmpeg')
+    MODES = ('sampled', 'iframes')
+    SCORERS = ('diff', 'scene')
+    STREAM_WINDOW = 60.0 # seconds of video per selection window when streaming keyframes
     
-    def __init__(self, video_path: Path, output_dir: Path, model: str):
+    def __init__(self, video_path: Path, output_dir: Path, model: str,
+                 seek_interval: int = SEEK_INTERVAL,
+                 threshold: float = FRAME_DIFFERENCE_THRESHOLD,
+                 score_size: int = FrameScorer.SCORE_SIZE,
+                 workers: int = 1,
+                 decoder: str = 'opencv',
+                 mode: str = 'sampled',
+                 scorer: str = 'diff',
+                 persist: bool = True,
+                 cache: Optional[FrameCache] = None):
+        """
+        Args:
+            workers: Number of processes scanning the video in parallel time
+                     segments, 0 uses every available core
+            decoder: 'opencv' decodes sampled frames with cv2.VideoCapture, 'ffmpeg'
+                     lets ffmpeg sample and downscale frames and pipes the scoring
+                     thumbnails back, selected frames are decoded again at full size
+            mode: 'sampled' scores frames at an adaptive sampling interval, 'iframes'
+                  scores only the keyframes listed in the container index
+            scorer: 'diff' scores frames by their mean absolute difference from the
+                    previous sample, 'scene' by ffmpeg's scene change score, which
+                    discounts steady motion (ffmpeg decoder, sampled mode only)
+            persist: Write selected frames to output_dir, otherwise frames are only
+                     handed over in memory as JPEG bytes
+            cache: Extraction cache, repeated extractions of the same video with the
+                   same parameters skip decoding entirely
+        """
+        if decoder not in self.DECODERS:
+            raise ValueError(f"Unknown frame decoder: {decoder}, expected one of {self.DECODERS}")
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown frame mode: {mode}, expected one of {self.MODES}")
+        if scorer not in self.SCORERS:
+            raise ValueError(f"Unknown frame scorer: {scorer}, expected one of {self.SCORERS}")
+        if scorer == 'scene' and (decoder != 'ffmpeg' or mode != 'sampled'):
+            raise ValueError("The scene frame scorer requires the ffmpeg decoder and the sampled mode")
+
         self.video_path = video_path
         self.output_dir = output_dir
         self.model = model
-        self.frames = []
+        self.seek_interval = seek_interval
+        self.threshold = threshold
+        self.score_size = score_size
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.decoder = decoder
+        self.mode = mode
+        self.scorer = scorer
+        self.persist = persist
+        self.cache = cache
+        self.fps = None
+        self.frame_size = None
+        self.frames = FrameTable()
         
-    def _calculate_frame_difference(self, frame1: np.ndarray, frame2: np.ndarray) -> float:
-        """Calculate the difference between two frames using absolute difference."""
-        if frame1 is None or frame2 is None:
-            return 0.0
-        
-        # Convert to grayscale for simpler comparison
-        gray1 = cv2.cvtColor(frame1, cv2.COLOR_BGR2GRAY)
-        gray2 = cv2.cvtColor(frame2, cv2.COLOR_BGR2GRAY)
-        
-        # Calculate absolute difference and mean
-        diff = cv2.absdiff(gray1, gray2)
-        score = np.mean(diff)
+    def _read_frame_at(self, cap: cv2.VideoCapture, position: int, frame_num: int,
+                       image: Optional[np.ndarray] = None) -> Optional[np.ndarray]:
+        """Decode frame `frame_num` given the capture currently points at `position`.
+
+        Frames in between are skipped with grab(), which demuxes and decodes but
+        never converts to BGR; when the gap exceeds seek_interval we seek instead.
+        If `image` is given the frame is retrieved into it instead of a new array.
+        """
+        gap = frame_num - position
+        if self.seek_interval and gap > self.seek_interval:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+        else:
+            for _ in range(gap):
+                if not cap.grab():
+                    return None
+
+        if not cap.grab():
+            return None
+        ret, frame = cap.retrieve(image=image)
+        return frame if ret else None
+
+    def _push_candidate(self, candidates: List[Tuple[float, int, Optional[bytes]]], limit: int,
+                        frame_num: int, frame: Optional[np.ndarray], score: float):
+        """Keep the `limit` best scoring frames in a min-heap of JPEG encoded candidates.
+
+        Frames are only encoded when they make it into the heap, so peak memory is
+        bounded by the number of target frames rather than the video length.
+        Ties on score keep the earlier frame, matching a stable sort by score.
+        Without a decoded `frame` the candidate is stored without its JPEG and is
+        decoded again by frame number once selected.
+        """
+        entry_key = (score, -frame_num)
+        if len(candidates) >= limit and entry_key <= candidates[0][:2]:
+            return
+
+        jpeg = None
+        if frame is not None:
+            ok, encoded = cv2.imencode('.jpg', frame)
+            if not ok:
+                logger.warning(f'Could not encode frame {frame_num}')
+                return
+            jpeg = encoded.tobytes()
+
+        entry = (score, -frame_num, jpeg)
+        if len(candidates) < limit:
+            heapq.heappush(candidates, entry)
+        else:
+            heapq.heapreplace(candidates, entry)
+
+    def _scan_range(self, start: int, end: int, sample_interval: int, limit: int) -> List[Tuple[float, int, bytes]]:
+        """Score sampled frames in [start, end) and return the `limit` best candidates.
+
+        `start` must be a multiple of `sample_interval`. A range not starting at the
+        beginning of the video first decodes the preceding sample, so its first frame
+        is scored against the same previous frame as in a sequential scan.
+        """
+        cap = cv2.VideoCapture(str(self.video_path))
+        if not cap.isOpened():
+            raise ValueError(f"Could not open video file: {self.video_path}")
+
+        frame_candidates = [] # min-heap : (score, -frame_num, jpeg bytes)
+        scorer = FrameScorer(self.score_size)
+        frame = None
+        position = 0
+
+        if start > 0:
+            position = start - sample_interval
+            cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+            frame = self._read_frame_at(cap, position, position)
+            if frame is not None:
+                scorer.score(frame)
+            position += 1
         
-        return float(score)
+        # Only sampled frames are retrieved (color converted), the rest are skipped.
+        # The decoded frame buffer is reused, candidates are encoded before the next read
+        for frame_count in range(start, end, sample_interval):
+            frame = self._read_frame_at(cap, position, frame_count, image=frame)
+            if frame is None:
+                break
+            position = frame_count + 1
 
-    def _is_keyframe(self, current_frame: np.ndarray, prev_frame: np.ndarray, threshold: float = FRAME_DIFFERENCE_THRESHOLD) -> bool:
-        """Determine if frame is significantly different from previous frame."""
-        if prev_frame is None:
-            return True
+            score = scorer.score(frame)
+            if score > self.threshold:
+                logger.info(f'key_frame : {frame_count}')
+                self._push_candidate(frame_candidates, limit, frame_count, frame, score)
             
-        score = self._calculate_frame_difference(current_frame, prev_frame)
-        return score > threshold
+        cap.release()
+        return frame_candidates
 
-    def extract_keyframes(self, frames_per_minute: int = 10, duration: Optional[float] = None, max_frames: Optional[int] = None) -> List[Frame]:
-        """Extract keyframes from video targeting a specific number of frames per minute."""
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-        
+    def _run_ffmpeg(self, count: int, start: int, filters: List[str], output: List[str],
+                    keyframes_only: bool = False) -> subprocess.Popen:
+        """Start ffmpeg on `count` frames from frame `start` through `filters`, writing `output`."""
+        cmd = ["ffmpeg", "-v", "error", "-nostdin"]
+        if start > 0:
+            # half a frame early, so rounding never drops frame `start` itself
+            cmd += ["-ss", f"{(start - 0.5) / self.fps:.6f}"]
+        if keyframes_only:
+            cmd += ["-skip_frame", "nokey"]
+        cmd += [
+            "-i", str(self.video_path),
+            "-vf", ",".join(filters),
+            ffmpeg_passthrough_option(), "passthrough",
+            "-frames:v", str(count),
+        ] + output
+
+        try:
+            return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except FileNotFoundError:
+            raise RuntimeError(
+                "The ffmpeg frame decoder requires ffmpeg. Please install ffmpeg using:\n"
+                "Ubuntu/Debian: sudo apt-get update && sudo apt-get install -y ffmpeg\n"
+                "MacOS: brew install ffmpeg\n"
+                "Windows: choco install ffmpeg"
+            )
+
+    @staticmethod
+    def _finish_ffmpeg(process: subprocess.Popen, stopped_early: bool):
+        """Wait for ffmpeg, killing it when the reader stopped early, and raise its errors."""
+        if process.poll() is None and stopped_early:
+            process.kill()
+        process.stdout.close()
+        error_output = process.stderr.read().decode(errors='replace')
+        process.stderr.close()
+        if process.wait() > 0:
+            raise RuntimeError(f"FFmpeg error: {error_output}")
+
+    def _ffmpeg_thumbnails(self, count: int, start: int = 0, sample_interval: int = 1,
+                           keyframes_only: bool = False, full_size: bool = False) -> Iterator[np.ndarray]:
+        """Yield grayscale scoring thumbnails of `count` samples starting at frame `start`.
+
+        ffmpeg samples and downscales in its threaded filters and writes raw frames
+        to a pipe, which are read into one buffer wrapped by np.frombuffer. The
+        yielded array is overwritten by the next frame. With `keyframes_only` the
+        decoder skips every frame that is not a keyframe. With `full_size` BGR
+        frames at the video's size are yielded instead of thumbnails.
+        """
+        if full_size:
+            width, height = self.frame_size
+            pix_fmt, shape = "bgr24", (height, width, 3)
+        else:
+            width, height = FrameScorer(self.score_size).thumbnail_size(*self.frame_size)
+            pix_fmt, shape = "gray", (height, width)
+        filters = [f"scale={width}:{height}:flags=area", f"format={pix_fmt}"]
+        if sample_interval > 1:
+            filters.insert(0, f"select=not(mod(n\\,{sample_interval}))")
+
+        process = self._run_ffmpeg(count, start, filters, ["-f", "rawvideo", "-pix_fmt", pix_fmt, "pipe:1"],
+                                   keyframes_only)
+        buffer = bytearray(int(np.prod(shape)))
+        view = memoryview(buffer)
+        thumbnail = np.frombuffer(buffer, dtype=np.uint8).reshape(shape)
+        read = 0
+        try:
+            while True:
+                read = 0
+                while read < len(buffer):
+                    n = process.stdout.readinto(view[read:])
+                    if not n:
+                        break
+                    read += n
+                if read < len(buffer):
+                    break
+                yield thumbnail
+        finally:
+            self._finish_ffmpeg(process, stopped_early=read == len(buffer))
+
+    def _ffmpeg_scene_scores(self, count: int, start: int = 0, sample_interval: int = 1) -> Iterator[float]:
+        """Yield ffmpeg's scene change score of `count` samples starting at frame `start`.
+
+        The scene select runs after the sampling select, so each sample is compared
+        with the previous sample. Scores are scaled from 0-1 to the 0-255 range of
+        FrameScorer, so the same threshold applies.
+        """
+        width, height = FrameScorer(self.score_size).thumbnail_size(*self.frame_size)
+        filters = [
+            f"scale={width}:{height}:flags=area", "format=gray",
+            "select=gte(scene\\,0)",
+            "metadata=print:key=lavfi.scene_score:file=pipe\\\\:1"
+        ]
+        if sample_interval > 1:
+            filters.insert(0, f"select=not(mod(n\\,{sample_interval}))")
+
+        process = self._run_ffmpeg(count, start, filters, ["-f", "null", "-"])
+        finished = False
+        try:
+            for line in process.stdout:
+                key, _, value = line.decode().strip().partition("=")
+                if key == "lavfi.scene_score":
+                    yield float(value) * 255
+            finished = True
+        finally:
+            self._finish_ffmpeg(process, stopped_early=not finished)
+
+    def _scan_range_ffmpeg(self, start: int, end: int, sample_interval: int, limit: int) -> List[Tuple[float, int, Optional[bytes]]]:
+        """ffmpeg variant of _scan_range, candidates are stored without their JPEG."""
+        frame_candidates = [] # min-heap : (score, -frame_num, None)
+
+        # start from the preceding sample so the first score matches a sequential scan,
+        # a scene score also depends on the difference of the sample before that
+        primed = 2 if self.scorer == 'scene' else 1
+        first = max(0, start - primed * sample_interval)
+        count = len(range(first, end, sample_interval))
+
+        if self.scorer == 'scene':
+            scores = self._ffmpeg_scene_scores(count, first, sample_interval)
+        else:
+            scorer = FrameScorer(self.score_size)
+            scores = (scorer.score(thumbnail) for thumbnail in self._ffmpeg_thumbnails(count, first, sample_interval))
+
+        for i, score in enumerate(scores):
+            frame_count = first + i * sample_interval
+            if frame_count < start:
+                continue
+
+            if score > self.threshold:
+                logger.info(f'key_frame : {frame_count}')
+                self._push_candidate(frame_candidates, limit, frame_count, None, score)
+
+        return frame_candidates
+
+    def _keyframe_numbers(self, total_frames: int) -> List[int]:
+        """List the frame numbers of the video's keyframes from the container index.
+
+        ffprobe only demuxes packets here, nothing is decoded.
+        """
+        cmd = [
+            "ffprobe", "-v", "error",
+            "-select_streams", "v:0",
+            "-show_entries", "packet=pts_time,flags",
+            "-of", "csv=p=0",
+            str(self.video_path)
+        ]
+        try:
+            result = subprocess.run(cmd, check=True, capture_output=True, text=True)
+        except FileNotFoundError:
+            raise RuntimeError(
+                "The iframes frame mode requires ffprobe, which is installed with ffmpeg:\n"
+                "Ubuntu/Debian: sudo apt-get update && sudo apt-get install -y ffmpeg\n"
+                "MacOS: brew install ffmpeg\n"
+                "Windows: choco install ffmpeg"
+            )
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(f"FFprobe error: {e.stderr}")
+
+        pts_times = []
+        keyframe_times = []
+        for line in result.stdout.splitlines():
+            pts_time, _, flags = line.partition(',')
+            try:
+                pts = float(pts_time)
+            except ValueError:
+                continue # packets without a timestamp
+            pts_times.append(pts)
+            if 'K' in flags:
+                keyframe_times.append(pts)
+
+        if not pts_times:
+            return []
+
+        # frame numbers count from the first presented frame, like CAP_PROP_POS_FRAMES
+        start_time = min(pts_times)
+        frame_nums = sorted({round((pts - start_time) * self.fps) for pts in keyframe_times})
+        return [frame_num for frame_num in frame_nums if frame_num < total_frames]
+
+    def _scan_keyframes(self, keyframes: List[int], limit: int,
+                        previous: Optional[int] = None) -> List[Tuple[float, int, Optional[bytes]]]:
+        """Score only the given keyframes, each against the previous keyframe.
+
+        Both decoders read the keyframes from ffmpeg, which skips decoding every
+        non-key frame; seeking with cv2.VideoCapture would still decode the frames
+        before each keyframe. The ffmpeg decoder scores downscaled thumbnails and
+        decodes the selected frames again, the opencv decoder reads full size frames
+        and keeps the candidates' JPEGs. The keyframe `previous` to the first one is
+        decoded first, so its score matches a scan of all keyframes.
+        """
+        frame_candidates = [] # min-heap : (score, -frame_num, jpeg bytes or None)
+        if not keyframes:
+            return frame_candidates
+
+        scorer = FrameScorer(self.score_size)
+        full_size = self.decoder != 'ffmpeg'
+        frame_nums = ([previous] if previous is not None else []) + keyframes
+        frames = self._ffmpeg_thumbnails(len(frame_nums), frame_nums[0], keyframes_only=True, full_size=full_size)
+        for frame_count, frame in zip(frame_nums, frames):
+            score = scorer.score(frame)
+            if frame_count == previous:
+                continue
+
+            if score > self.threshold:
+                logger.info(f'key_frame : {frame_count}')
+                self._push_candidate(frame_candidates, limit, frame_count, frame if full_size else None, score)
+
+        return frame_candidates
+
+    def _encode_frames(self, frame_nums: List[int]) -> Dict[int, bytes]:
+        """Decode the given frames at full resolution and return them JPEG encoded."""
+        cap = cv2.VideoCapture(str(self.video_path))
+        if not cap.isOpened():
+            raise ValueError(f"Could not open video file: {self.video_path}")
+
+        encoded = {}
+        position = 0
+        for frame_num in sorted(frame_nums):
+            frame = self._read_frame_at(cap, position, frame_num)
+            if frame is None:
+                break
+            position = frame_num + 1
+            ok, jpeg = cv2.imencode('.jpg', frame)
+            if ok:
+                encoded[frame_num] = jpeg.tobytes()
+
+        cap.release()
+        return encoded
+
+    def _scan(self, total_frames: int, sample_interval: int, limit: int) -> List[Tuple[float, int, bytes]]:
+        """Scan the whole video, splitting it into one time segment per worker process.
+
+        Every segment keeps its own `limit` best candidates, the global best `limit`
+        are always among them so merging the segment heaps is exact.
+        """
+        scan_range = self._scan_range_ffmpeg if self.decoder == 'ffmpeg' else self._scan_range
+
+        total_samples = -(-total_frames // sample_interval)
+        workers = max(1, min(self.workers, total_samples // self.MIN_SEGMENT_SAMPLES))
+        if workers == 1:
+            return scan_range(0, total_frames, sample_interval, limit)
+
+        # Segment boundaries fall on sampled frames so samples match a sequential scan
+        bounds = [total_samples * i // workers * sample_interval for i in range(workers)] + [total_frames]
+        logger.info(f'Scanning {total_frames} frames in {workers} parallel segments')
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(scan_range, start, end, sample_interval, limit)
+                for start, end in zip(bounds, bounds[1:])
+            ]
+            segment_candidates = [c for future in futures for c in future.result()]
+
+        return heapq.nlargest(limit, segment_candidates)
+
+    def _plan(self, frames_per_minute: int, duration: Optional[float], max_frames: Optional[int]) -> Tuple[int, int, int]:
+        """Read the video properties and return (total_frames, target_frames, sample_interval)."""
         cap = cv2.VideoCapture(str(self.video_path))
         if not cap.isOpened():
             raise ValueError(f"Could not open video file: {self.video_path}")
@@ -60,6 +612,9 @@ class VideoProcessor:
         fps = cap.get(cv2.CAP_PROP_FPS)
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         video_duration = total_frames / fps
+        self.fps = fps
+        self.frame_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        cap.release()
         
         if duration:
             video_duration = min(duration, video_duration)
@@ -74,29 +629,16 @@ class VideoProcessor:
         
         # Calculate adaptive sampling interval
         sample_interval = max(1, total_frames // (target_frames * 2))
-        
-        frame_candidates = []
-        prev_frame = None
-        frame_count = 0
-        
-        while frame_count < total_frames:
-            ret, frame = cap.read()
-            if not ret:
-                break
-                
-            if frame_count % sample_interval == 0:
-                score = self._calculate_frame_difference(frame, prev_frame)
-                if score > self.FRAME_DIFFERENCE_THRESHOLD:
-                    logger.info(f'key_frame : {frame_count}')
-                    frame_candidates.append((frame_count, frame, score))
-                prev_frame = frame.copy()
-                
-            frame_count += 1
-            
-        cap.release()
-        
-        # Select the most significant frames
-        selected_candidates = sorted(frame_candidates, key=lambda x: x[2], reverse=True)[:target_frames]
+        return total_frames, target_frames, sample_interval
+
+    def _select(self, frame_candidates: List[Tuple[float, int, Optional[bytes]]],
+                max_frames: Optional[int]) -> List[Tuple[int, bytes, float]]:
+        """Turn a candidate heap into (frame_num, jpeg, score) tuples in frame order."""
+        # Select the most significant frames, the heap already holds at most target_frames
+        selected_candidates = [
+            (-neg_frame_num, jpeg, score)
+            for score, neg_frame_num, jpeg in sorted(frame_candidates, reverse=True)
+        ]
         
         # If max_frames is specified, sample evenly across the candidates
         if max_frames is not None and max_frames < len(selected_candidates):
@@ -105,25 +647,199 @@ class VideoProcessor:
         else:
             selected_frames = selected_candidates
 
-        selected_frames.sort(key=lambda x: x[0]) # topple : (frame_num, frame, score)
+        selected_frames.sort(key=lambda x: x[0]) # topple : (frame_num, jpeg, score)
+
+        # Candidates scored on decoder thumbnails are decoded at full size only now
+        missing = [frame_num for frame_num, jpeg, _ in selected_frames if jpeg is None]
+        if missing:
+            encoded = self._encode_frames(missing)
+            selected_frames = [
+                (frame_num, jpeg if jpeg is not None else encoded[frame_num], score)
+                for frame_num, jpeg, score in selected_frames
+                if jpeg is not None or frame_num in encoded
+            ]
+        return selected_frames
+
+    def _write_frames(self, selected_frames: List[Tuple[int, bytes, float]]) -> List[Frame]:
+        """Append the selected frames to the frame table and return their views.
 
-        self.frames = []
-        for idx, (frame_num, frame, score) in enumerate(selected_frames):
+        Frames carry their JPEG bytes and are also written to the output
+        directory when persist is set.
+        """
+        first_idx = len(self.frames)
+        paths = []
+        for idx, (frame_num, jpeg, score) in enumerate(selected_frames, start=first_idx):
             
-            name = f"frame_{idx}.jpg"
-            frame_path = self.output_dir / name
-            logger.info(f'frame_path : {frame_path}')
-            cv2.imwrite(str(frame_path), frame)
-            timestamp = frame_num / fps
-
-            self.frames.append({
-                'idx'  : idx,
-                'num'  : frame_num,
-                'path' : str(frame_path),
-                'name' : name,
-                'timestamp' : timestamp,
-                'score' : score
-            })
+            frame_path = None
+            if self.persist:
+                frame_path = self.output_dir / f"frame_{idx}.jpg"
+                logger.info(f'frame_path : {frame_path}')
+                frame_path.write_bytes(jpeg)
+            paths.append(frame_path)
+
+        return self.frames.append(
+            ix=range(first_idx, first_idx + len(selected_frames)),
+            number=[frame_num for frame_num, _, _ in selected_frames],
+            timestamp=[frame_num / self.fps for frame_num, _, _ in selected_frames],
+            score=[score for _, _, score in selected_frames],
+            paths=paths,
+            data=[jpeg for _, jpeg, _ in selected_frames]
+        )
+
+    def _cache_key(self, **params) -> Optional[str]:
+        """Return the extraction cache key for this video and the given parameters."""
+        if self.cache is None:
+            return None
+
+        params.update(
+            threshold=self.threshold,
+            score_size=self.score_size,
+            decoder=self.decoder,
+            mode=self.mode,
+            scorer=self.scorer
+        )
+        return self.cache.key(self.video_path, params)
+
+    def _load_cached(self, cache_key: Optional[str]) -> Optional[List[Tuple[int, bytes, float]]]:
+        """Return the cached selected frames for `cache_key`, restoring the video fps."""
+        cached = self.cache.load(cache_key) if cache_key else None
+        if cached is None:
+            return None
+
+        self.fps, selected_frames = cached
+        return selected_frames
+
+    def extract_keyframes(self, frames_per_minute: int = 10, duration: Optional[float] = None, max_frames: Optional[int] = None) -> FrameTable:
+        """Extract keyframes from video targeting a specific number of frames per minute."""
+        self.frames = FrameTable()
+        if self.persist:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        cache_key = self._cache_key(frames_per_minute=frames_per_minute, duration=duration, max_frames=max_frames)
+        selected_frames = self._load_cached(cache_key)
+        if selected_frames is not None:
+            self._write_frames(selected_frames)
+            logger.info(f"Loaded {len(self.frames)} frames from the extraction cache")
+            return self.frames
+        
+        total_frames, target_frames, sample_interval = self._plan(frames_per_minute, duration, max_frames)
+        
+        if self.mode == 'iframes':
+            keyframes = self._keyframe_numbers(total_frames)
+            logger.info(f'Scanning {len(keyframes)} keyframes')
+            frame_candidates = self._scan_keyframes(keyframes, target_frames)
+        else:
+            # Scan sampled frames, in parallel time segments when workers are available
+            frame_candidates = self._scan(total_frames, sample_interval, target_frames)
+        
+        selected_frames = self._select(frame_candidates, max_frames)
+        if cache_key:
+            self.cache.store(cache_key, self.fps, selected_frames)
+
+        self._write_frames(selected_frames)
 
         logger.info(f"Extracted {len(self.frames)} frames from video (target was {target_frames})")
         return self.frames
+
+    def _extract_windows(self, frames_per_minute: int, duration: Optional[float],
+                         max_frames: Optional[int], window: float) -> Iterator[List[Frame]]:
+        """Extract keyframes one time window at a time, yielding each window's frames.
+
+        The target frame count is shared between windows in proportion to their
+        length, so a window's selection is final as soon as it has been scanned.
+        """
+        self.frames = FrameTable()
+        if self.persist:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+
+        cache_key = self._cache_key(frames_per_minute=frames_per_minute, duration=duration,
+                                    max_frames=max_frames, window=window)
+        selected_frames = self._load_cached(cache_key)
+        if selected_frames is not None:
+            frames = self._write_frames(selected_frames)
+            logger.info(f"Loaded {len(frames)} frames from the extraction cache")
+            if frames:
+                yield frames
+            return
+        
+        total_frames, target_frames, sample_interval = self._plan(frames_per_minute, duration, max_frames)
+
+        keyframes = None
+        if self.mode == 'iframes':
+            keyframes = self._keyframe_numbers(total_frames)
+
+        # Window boundaries fall on sampled frames so samples match a full scan
+        window_frames = max(sample_interval, int(window * self.fps) // sample_interval * sample_interval)
+        bounds = list(range(0, total_frames, window_frames)) + [total_frames]
+
+        all_selected = []
+        for start, end in zip(bounds, bounds[1:]):
+            # cumulative rounding keeps the quotas summing up to target_frames
+            quota = round(target_frames * end / total_frames) - round(target_frames * start / total_frames)
+            if quota <= 0:
+                continue
+
+            if keyframes is not None:
+                # the window's first keyframe is scored against the one before the window
+                first, last = bisect.bisect_left(keyframes, start), bisect.bisect_left(keyframes, end)
+                previous = keyframes[first - 1] if first > 0 else None
+                frame_candidates = self._scan_keyframes(keyframes[first:last], quota, previous)
+            elif self.decoder == 'ffmpeg':
+                frame_candidates = self._scan_range_ffmpeg(start, end, sample_interval, quota)
+            else:
+                frame_candidates = self._scan_range(start, end, sample_interval, quota)
+
+            selected_frames = self._select(frame_candidates, max_frames)
+            all_selected.extend(selected_frames)
+            frames = self._write_frames(selected_frames)
+            logger.info(f"Extracted {len(frames)} frames between {start / self.fps:.2f}s and {end / self.fps:.2f}s")
+            if frames:
+                yield frames
+
+        if cache_key:
+            self.cache.store(cache_key, self.fps, all_selected)
+
+    def iter_keyframes(self, frames_per_minute: int = 10, duration: Optional[float] = None,
+                       max_frames: Optional[int] = None, window: float = STREAM_WINDOW) -> Iterator[Frame]:
+        """Extract keyframes in a background thread and yield them as they become final.
+
+        Frames are selected per `window` seconds of video rather than across the whole
+        video, so the first frames are available after one window has been scanned and
+        consumers (e.g. frame analysis) overlap with decoding. At most a couple of
+        windows are extracted ahead of the consumer.
+        """
+        windows = queue.Queue(maxsize=2)
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            try:
+                for frames in self._extract_windows(frames_per_minute, duration, max_frames, window):
+                    windows.put(frames)
+                    if stop.is_set():
+                        return
+                windows.put(done)
+            except Exception as e:
+                windows.put(e)
+
+        producer = threading.Thread(target=produce, name='keyframe-extraction', daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                frames = windows.get()
+                if frames is done:
+                    break
+                if isinstance(frames, Exception):
+                    raise frames
+                yield from frames
+        finally:
+            # the consumer may stop early, unblock the producer so it can exit
+            stop.set()
+            while producer.is_alive():
+                try:
+                    windows.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+        logger.info(f"Extracted {len(self.frames)} frames from video")
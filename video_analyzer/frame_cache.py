@@ -0,0 +1,110 @@
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+class FrameCache:
+    """On-disk cache of keyframe extraction results.
+
+    Entries are keyed on a content fingerprint of the video and the extraction
+    parameters, and hold the selected frame numbers, scores and JPEG bytes.
+    Each entry is a directory with an index.json whose modification time marks
+    its last use; the least recently used entries are evicted once the cache
+    grows past max_size_mb.
+    """
+    FINGERPRINT_CHUNK = 1 << 20 # bytes read at the start, middle and end of the video
+    INDEX_FILE = "index.json"
+
+    def __init__(self, cache_dir: Path, max_size_mb: float = 1024):
+        self.cache_dir = Path(cache_dir).expanduser()
+        self.max_size = int(max_size_mb * 1024 * 1024)
+
+    def _fingerprint(self, video_path: Path) -> str:
+        """Hash the file size and three chunks of the video instead of the whole file."""
+        size = os.path.getsize(video_path)
+        digest = hashlib.sha256(str(size).encode())
+        with open(video_path, "rb") as f:
+            for offset in (0, size // 2, max(0, size - self.FINGERPRINT_CHUNK)):
+                f.seek(offset)
+                digest.update(f.read(self.FINGERPRINT_CHUNK))
+        return digest.hexdigest()
+
+    def key(self, video_path: Path, params: Dict[str, Any]) -> str:
+        """Return the cache key of extracting `video_path` with `params`."""
+        payload = json.dumps({"video": self._fingerprint(video_path), "params": params}, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def load(self, key: str) -> Optional[Tuple[float, List[Tuple[int, bytes, float]]]]:
+        """Return (fps, [(frame_num, jpeg, score), ...]) for `key`, or None on a miss."""
+        entry_dir = self.cache_dir / key
+        index_path = entry_dir / self.INDEX_FILE
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            selected_frames = [
+                (frame["num"], (entry_dir / frame["file"]).read_bytes(), frame["score"])
+                for frame in index["frames"]
+            ]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Discarding unreadable frame cache entry {key}: {e}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+
+        os.utime(index_path) # mark as recently used
+        logger.info(f"Frame cache hit : {key}")
+        return index["fps"], selected_frames
+
+    def store(self, key: str, fps: float, selected_frames: List[Tuple[int, bytes, float]]):
+        """Store the selected frames under `key` and evict old entries if needed."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # write into a temporary directory first so readers never see partial entries
+        tmp_dir = Path(tempfile.mkdtemp(dir=self.cache_dir, prefix=".tmp-"))
+        try:
+            frames = []
+            for i, (frame_num, jpeg, score) in enumerate(selected_frames):
+                file_name = f"frame_{i}.jpg"
+                (tmp_dir / file_name).write_bytes(jpeg)
+                frames.append({"num": frame_num, "score": score, "file": file_name})
+
+            with open(tmp_dir / self.INDEX_FILE, "w") as f:
+                json.dump({"fps": fps, "frames": frames, "created": time.time()}, f)
+
+            entry_dir = self.cache_dir / key
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        except Exception as e:
+            logger.warning(f"Could not store frame cache entry {key}: {e}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        logger.info(f"Frame cache stored : {key}")
+        self._evict()
+
+    def _evict(self):
+        """Remove least recently used entries until the cache fits in max_size."""
+        entries = []
+        total_size = 0
+        for entry_dir in self.cache_dir.iterdir():
+            index_path = entry_dir / self.INDEX_FILE
+            if entry_dir.name.startswith(".") or not index_path.exists():
+                continue
+            size = sum(f.stat().st_size for f in entry_dir.iterdir())
+            entries.append((index_path.stat().st_mtime, size, entry_dir))
+            total_size += size
+
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.debug(f"Evicting frame cache entry {entry_dir.name}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,243 @@
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+import logging
+import math
+
+import cv2
+import numpy as np
+
+from .analyzer import VideoAnalyzer
+from .clients.llm_client import LLMClient
+from .frame import Frame
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class Plan:
+    """Projected requests, tokens, cost and wall time of analyzing a set of frames."""
+    frames: int
+    requests: int = 0
+    image_tokens: int = 0
+    prompt_tokens: int = 0 # text only, images are counted in image_tokens
+    completion_tokens: int = 0
+    cost: float = 0.0
+    wall_time: float = 0.0
+    priced: bool = True # False when the client does not price the model, e.g. local Ollama models
+    stages: Dict[str, Dict[str, Any]] = field(default_factory=dict)
+
+    @property
+    def total_tokens(self) -> int:
+        return self.image_tokens + self.prompt_tokens + self.completion_tokens
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "frames": self.frames,
+            "requests": self.requests,
+            "image_tokens": self.image_tokens,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "cost": self.cost if self.priced else None,
+            "wall_time": self.wall_time,
+            "stages": self.stages,
+        }
+
+    def format(self) -> str:
+        lines = [f"{'stage':16s} {'requests':>8s} {'image tok':>10s} {'prompt tok':>11s} {'output tok':>11s} {'seconds':>8s}"]
+        for name, stage in self.stages.items():
+            lines.append(f"{name:16s} {stage['requests']:8d} {stage['image_tokens']:10d} {stage['prompt_tokens']:11d} "
+                         f"{stage['completion_tokens']:11d} {stage['wall_time']:8.1f}")
+        lines.append(f"{'total':16s} {self.requests:8d} {self.image_tokens:10d} {self.prompt_tokens:11d} "
+                     f"{self.completion_tokens:11d} {self.wall_time:8.1f}")
+        cost = f"${self.cost:.4f}" if self.priced else "none (the client does not price this model)"
+        lines.append(f"{self.frames} frames, {self.total_tokens} tokens, estimated cost {cost}")
+        return "\n".join(lines)
+
+class RunPlanner:
+    """Estimate the tokens, cost and wall time of stages 2 and 3 before running them.
+
+    Image tokens come from each client's estimate_image_tokens for the frames as
+    they would be uploaded (mosaics and batches included), text tokens from prompt
+    lengths at VideoAnalyzer.CHARS_PER_TOKEN, and {PREVIOUS_FRAMES} growth follows
+    the analyzer's context window, summary and token budget settings. Responses are
+    assumed to use their whole num_predict, so the projection is an upper bound.
+    Cost uses the client's pricing, runs it does not price are free. Wall time is
+    request_latency plus output tokens at tokens_per_second per request,
+    with concurrent requests overlapping.
+    """
+    FRAME_NUM_PREDICT = 300
+    SEGMENT_NUM_PREDICT = 500
+    RECONSTRUCTION_NUM_PREDICT = 1000
+    NOTE_TOKENS = 20 # per frame "This is frame N captured at T seconds." line or "Frame i (t):" header
+    SPEECH_TOKENS_PER_SECOND = 3.0 # transcript tokens of continuous speech
+
+    def __init__(self, client: LLMClient, model: str, analyzer: VideoAnalyzer,
+                 request_latency: float = 2.0, tokens_per_second: float = 50.0, transcript: bool = True):
+        self.client = client
+        self.model = model
+        self.analyzer = analyzer
+        self.request_latency = request_latency
+        self.tokens_per_second = tokens_per_second
+        self.transcript = transcript
+        self._sizes: Dict[int, Tuple[int, int]] = {}
+
+    def _tokens(self, text: str) -> int:
+        return math.ceil(len(text) / self.analyzer.CHARS_PER_TOKEN)
+
+    def _request_time(self, completion_tokens: int) -> float:
+        return self.request_latency + completion_tokens / self.tokens_per_second
+
+    def _frame_sizes(self, frames: Sequence[Frame]) -> List[Tuple[int, int]]:
+        # fit_budget estimates many subsets of the same frames, decode each one once
+        sizes = []
+        for frame in frames:
+            if frame.number not in self._sizes:
+                self._sizes[frame.number] = frame_size(frame)
+            sizes.append(self._sizes[frame.number])
+        return sizes
+
+    def _context_tokens(self, previous: int) -> int:
+        """Tokens of {PREVIOUS_FRAMES} after `previous` analyses."""
+        analyzer = self.analyzer
+        per_analysis = self.FRAME_NUM_PREDICT + self.NOTE_TOKENS
+        if analyzer.context_window and analyzer.summary_interval:
+            summarized = max(0, previous - analyzer.context_window) // analyzer.summary_interval * analyzer.summary_interval
+            tokens = (previous - summarized) * per_analysis
+            if summarized:
+                tokens += analyzer.SUMMARY_WORDS * 2
+        elif analyzer.context_window:
+            tokens = min(previous, analyzer.context_window) * per_analysis
+        else:
+            tokens = previous * per_analysis
+        if analyzer.context_tokens:
+            tokens = min(tokens, analyzer.context_tokens)
+        return tokens
+
+    def _group_image_tokens(self, frame_sizes: Sequence[Tuple[int, int]]) -> int:
+        """Image tokens of one request on frames of the given (width, height)."""
+        if self.analyzer.mosaic > 1 and len(frame_sizes) > 1:
+            # cells have the size of the first frame
+            rows, columns = self.analyzer._mosaic_grid(len(frame_sizes))
+            width, height = frame_sizes[0]
+            return self.client.estimate_image_tokens(columns * width, rows * height, self.model)
+        return sum(self.client.estimate_image_tokens(width, height, self.model) for width, height in frame_sizes)
+
+    def _add(self, plan: Plan, stage: str, requests: int, image_tokens: int, prompt_tokens: int,
+             completion_tokens: int, wall_time: float):
+        plan.stages[stage] = {
+            "requests": requests,
+            "image_tokens": image_tokens,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "wall_time": wall_time,
+        }
+        plan.requests += requests
+        plan.image_tokens += image_tokens
+        plan.prompt_tokens += prompt_tokens
+        plan.completion_tokens += completion_tokens
+        plan.wall_time += wall_time
+
+    def estimate(self, frames: Sequence[Frame], duration: float) -> Plan:
+        """Project stages 2 and 3 on `frames` of a video `duration` seconds long."""
+        analyzer = self.analyzer
+        plan = Plan(frames=len(frames))
+        if not frames:
+            return plan
+        sizes = self._frame_sizes(frames)
+
+        # Stage 2 : one request per group of frames
+        template_tokens = self._tokens(analyzer.frame_prompt.replace("{prompt}", analyzer._format_user_prompt()))
+        requests = image_tokens = prompt_tokens = completion_tokens = 0
+        request_times = []
+        for first in range(0, len(frames), analyzer.group_size):
+            group = sizes[first:first + analyzer.group_size]
+            requests += 1
+            image_tokens += self._group_image_tokens(group)
+            prompt_tokens += template_tokens + self.NOTE_TOKENS * (len(group) + 1) + self._context_tokens(first)
+            completion_tokens += self.FRAME_NUM_PREDICT * len(group)
+            request_times.append(self._request_time(self.FRAME_NUM_PREDICT * len(group)))
+        # requests in flight overlap
+        wall_time = sum(request_times) / analyzer.max_in_flight
+        self._add(plan, "frame analysis", requests, image_tokens, prompt_tokens, completion_tokens, wall_time)
+
+        if analyzer.context_window and analyzer.summary_interval:
+            summaries = max(0, len(frames) - analyzer.context_window) // analyzer.summary_interval
+            summary_tokens = analyzer.SUMMARY_WORDS * 2
+            self._add(plan, "context summary", summaries, 0,
+                      summaries * (self._tokens(analyzer.SUMMARY_PROMPT) + summary_tokens
+                                   + analyzer.summary_interval * (self.FRAME_NUM_PREDICT + self.NOTE_TOKENS)),
+                      summaries * summary_tokens, summaries * self._request_time(summary_tokens))
+
+        # Stage 3 : video reconstruction
+        template_tokens = self._tokens(analyzer.video_prompt.replace("{prompt}", analyzer._format_user_prompt()))
+        notes_tokens = len(frames) * (self.FRAME_NUM_PREDICT + self.NOTE_TOKENS)
+        transcript_tokens = math.ceil(duration * self.SPEECH_TOKENS_PER_SECOND) if self.transcript else 0
+        segments = min(len(frames), math.ceil(duration / analyzer.segment_seconds)) if duration else 1
+        if analyzer.reconstruction == "hierarchical" and segments > 1:
+            map_time = self._request_time(self.SEGMENT_NUM_PREDICT) * math.ceil(segments / analyzer.reconstruction_workers)
+            requests, prompt_tokens = segments, segments * template_tokens + notes_tokens + transcript_tokens
+            completion_tokens, wall_time = segments * self.SEGMENT_NUM_PREDICT, map_time
+            parts = segments
+            while parts > 1:
+                groups = math.ceil(parts / analyzer.REDUCE_FANOUT)
+                num_predict = self.RECONSTRUCTION_NUM_PREDICT if groups == 1 else self.SEGMENT_NUM_PREDICT
+                requests += groups
+                prompt_tokens += groups * template_tokens + parts * (self.SEGMENT_NUM_PREDICT + self.NOTE_TOKENS)
+                completion_tokens += groups * num_predict
+                wall_time += self._request_time(num_predict) * math.ceil(groups / analyzer.reconstruction_workers)
+                parts = groups
+            self._add(plan, "reconstruction", requests, 0, prompt_tokens, completion_tokens, wall_time)
+        else:
+            self._add(plan, "reconstruction", 1, 0, template_tokens + notes_tokens + transcript_tokens,
+                      self.RECONSTRUCTION_NUM_PREDICT, self._request_time(self.RECONSTRUCTION_NUM_PREDICT))
+
+        pricing = self.client.pricing(self.model)
+        plan.priced = pricing is not None
+        if pricing:
+            plan.cost = ((plan.image_tokens + plan.prompt_tokens) * pricing["prompt"]
+                         + plan.completion_tokens * pricing["completion"]) / 1000
+        return plan
+
+    def fit_budget(self, frames: Sequence[Frame], duration: float, budget: float) -> int:
+        """Largest number of frames, sampled evenly from `frames`, whose projected cost fits `budget`.
+
+        Returns 0 when not even one frame fits, and len(frames) when the client does not
+        price the model, as such runs cost nothing.
+        """
+        plan = self.estimate(frames, duration)
+        if not plan.priced or plan.cost <= budget:
+            return len(frames)
+        low, high = 0, len(frames) # cost(low) fits, cost(high) does not
+        while high - low > 1:
+            middle = (low + high) // 2
+            if self.estimate(sample_frames(frames, middle), duration).cost <= budget:
+                low = middle
+            else:
+                high = middle
+        return low
+
+def frame_size(frame: Frame) -> Tuple[int, int]:
+    """(width, height) of a frame's JPEG."""
+    image = cv2.imdecode(np.frombuffer(frame.data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError(f"Could not decode frame {frame.number}")
+    height, width = image.shape[:2]
+    return width, height
+
+def sample_frames(frames: Sequence[Frame], max_frames: int) -> List[Frame]:
+    """Sample `max_frames` evenly across `frames`, as frame extraction does for max_frames."""
+    if max_frames >= len(frames):
+        return list(frames)
+    step = len(frames) / max_frames
+    return [frames[int(i * step)] for i in range(max_frames)]
+
+def video_duration(video_path: Path, duration: Optional[float] = None) -> float:
+    """Length in seconds of the video, or of its first `duration` seconds."""
+    cap = cv2.VideoCapture(str(video_path))
+    if not cap.isOpened():
+        raise ValueError(f"Could not open video file: {video_path}")
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    seconds = cap.get(cv2.CAP_PROP_FRAME_COUNT) / fps if fps else 0.0
+    cap.release()
+    return min(seconds, duration) if duration else seconds